@@ -0,0 +1,169 @@
+"""Admission control: bounded concurrency per group of routes.
+
+Each group admits a number of requests at a time and queues a bounded number
+more in arrival order. Once the queue is full, or a request has waited
+ADMISSION_QUEUE_TIMEOUT seconds, it is turned away with 503 and Retry-After
+rather than left to pile up until clients time out. Routes that hash secrets
+share one group, so a login spike can't take the capacity cheap routes such
+as /auth/me need.
+
+Limits are ``<concurrent>/<queued>`` per worker process, or ``off`` to not
+limit the group at all.
+"""
+import asyncio
+import collections
+import os
+import time
+from typing import Deque, Dict, Optional, Tuple
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app import metrics, responses
+from app.auth import hashing
+
+# Enough requests to keep every hashing process busy while others wait on
+# redis and mongo. The queue timeout, rather than the queue size, bounds how
+# long a request waits when hashing is slow.
+ADMISSION_HASH = (
+    os.getenv("ADMISSION_HASH")
+    or f"{4 * hashing.HASH_POOL_SIZE}/{64 * hashing.HASH_POOL_SIZE}"
+)
+ADMISSION_DEFAULT = os.getenv("ADMISSION_DEFAULT") or "256/1024"
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 5))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 1))
+
+BUSY = responses.encode({"detail": "Server is busy, try again later."})
+
+
+class Overloaded(Exception):
+    pass
+
+
+def parse_limit(limit: str) -> Optional[Tuple[int, int]]:
+    if limit == "off":
+        return None
+    concurrency, queue_size = limit.split("/")
+    return int(concurrency), int(queue_size)
+
+
+class Limiter:
+    """Admits up to ``concurrency`` holders at a time, and queues up to
+    ``queue_size`` more first come first served"""
+
+    def __init__(
+        self,
+        name: str,
+        concurrency: int,
+        queue_size: int,
+        timeout: float = ADMISSION_QUEUE_TIMEOUT,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+        self._active = metrics.ADMISSION_ACTIVE.labels(name)
+        self._queued = metrics.ADMISSION_QUEUED.labels(name)
+        self._wait = metrics.ADMISSION_WAIT.labels(name)
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        """Wait for a slot. Raises Overloaded if the queue is full or the
+        wait times out."""
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            self._active.inc()
+            return
+        if len(self._waiters) >= self.queue_size:
+            metrics.ADMISSION_SHED.labels(self.name, "queue_full").inc()
+            raise Overloaded(self.name)
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append(future)
+        self._queued.inc()
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            metrics.ADMISSION_SHED.labels(self.name, "timeout").inc()
+            raise Overloaded(self.name)
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before the cancellation.
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            if not future.done() or future.cancelled():
+                try:
+                    self._waiters.remove(future)
+                except ValueError:
+                    pass
+            self._queued.dec()
+            self._wait.observe(time.perf_counter() - start)
+
+    def release(self):
+        """Hand the slot to the longest waiting request, or free it"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+        self._active.dec()
+
+
+def build_limiters() -> Dict[str, Limiter]:
+    limiters = {}
+    for name, limit in (("hash", ADMISSION_HASH), ("default", ADMISSION_DEFAULT)):
+        parsed = parse_limit(limit)
+        if parsed is not None:
+            limiters[name] = Limiter(name, *parsed)
+    return limiters
+
+
+class AdmissionMiddleware:
+    """Holds each request in its route group's limiter while it is handled.
+
+    Groups are looked up by exact path, so this costs one dict lookup per
+    request. Paths mapped to None, and groups without a limiter, are never
+    limited.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        limiters: Dict[str, Limiter],
+        route_groups: Dict[str, Optional[str]],
+        default_group: str = "default",
+        retry_after: int = ADMISSION_RETRY_AFTER,
+    ):
+        self.app = app
+        self.limiters = limiters
+        self.route_groups = route_groups
+        self.default_group = default_group
+        self.retry_after = str(retry_after)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        group = self.route_groups.get(scope["path"], self.default_group)
+        limiter = self.limiters.get(group)
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await limiter.acquire()
+        except Overloaded:
+            response = responses.EncodedJSONResponse(
+                BUSY, status_code=503, headers={"Retry-After": self.retry_after}
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
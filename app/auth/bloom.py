@@ -0,0 +1,244 @@
+"""Bloom filter of registered emails, so lookups of emails that were never
+registered are answered without a database query.
+
+Each worker builds its own filter in the background from a scan of the users
+and adds emails as users are created. Until it is built every email is looked
+up as before. USER_FILTER chooses how registrations reach the other workers:
+
+* ``off``: no filter.
+* ``local``: none do. Only safe with a single worker process and no other
+  process creating users.
+* ``shared``: through USER_FILTER_CHANNEL in redis. A worker that loses its
+  subscription may have missed some, so it rebuilds its filter.
+
+Every process publishes the users it creates on USER_FILTER_CHANNEL whatever
+its own mode, so users imported with the CLI reach shared filters too. Set
+the channel empty to not publish.
+
+Filters are rebuilt every USER_FILTER_REBUILD_SECONDS to drop deleted users
+and grow with the user count. Memory is set by USER_FILTER_CAPACITY and
+USER_FILTER_ERROR_RATE: about 1.8MB per million emails at 0.1%.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional
+
+from pymongo.errors import PyMongoError
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+from app import metrics
+from app.auth import store
+from app.resources import resources
+
+logger = logging.getLogger()
+
+USER_FILTER = os.getenv("USER_FILTER", "off")
+USER_FILTER_CAPACITY = int(os.getenv("USER_FILTER_CAPACITY", 1000000))
+USER_FILTER_ERROR_RATE = float(os.getenv("USER_FILTER_ERROR_RATE", 0.001))
+USER_FILTER_CHANNEL = os.getenv("USER_FILTER_CHANNEL", "users:registered")
+USER_FILTER_REBUILD_SECONDS = float(os.getenv("USER_FILTER_REBUILD_SECONDS", 3600))
+
+
+class BloomFilter:
+    """Set of strings that can answer "definitely not added" or "probably
+    added", in a fixed amount of memory"""
+
+    def __init__(self, capacity: int, error_rate: float):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        self.capacity = max(capacity, 1)
+        self.error_rate = error_rate
+        # Optimal sizes for the capacity and error rate.
+        self.size = max(
+            math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2), 8
+        )
+        self.hashes = max(round(self.size / self.capacity * math.log(2)), 1)
+        self.bits = bytearray(math.ceil(self.size / 8))
+        self.count = 0
+
+    def _positions(self, item: str) -> List[int]:
+        # Positions derived from two halves of one hash, as good as k
+        # independent hashes for a bloom filter (Kirsch and Mitzenmacher).
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.bits)
+
+    def false_positive_rate(self) -> float:
+        """Expected rate for the number of items added so far"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+class RegisteredEmails:
+    """Filter of registered emails, kept current as users are created"""
+
+    def __init__(
+        self,
+        mode: str = USER_FILTER,
+        client: aioredis.Redis = None,
+        capacity: int = USER_FILTER_CAPACITY,
+        error_rate: float = USER_FILTER_ERROR_RATE,
+        channel: str = USER_FILTER_CHANNEL,
+        rebuild_seconds: float = USER_FILTER_REBUILD_SECONDS,
+    ):
+        if mode not in ("off", "local", "shared"):
+            raise ValueError(f"Unknown user filter mode: {mode}")
+        self.mode = mode
+        self.client = client
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.channel = channel
+        self.rebuild_seconds = rebuild_seconds
+        # None until built, and whenever registrations may have been missed.
+        self.filter: Optional[BloomFilter] = None
+        self._building: Optional[BloomFilter] = None
+
+    def might_exist(self, email: str) -> bool:
+        """False only if the email is certainly not registered"""
+        if self.filter is None:
+            return True
+        if email in self.filter:
+            metrics.USER_FILTER_LOOKUPS.labels("passed").inc()
+            return True
+        metrics.USER_FILTER_LOOKUPS.labels("absent").inc()
+        return False
+
+    def missed(self):
+        """Record an email the filter let through that was not registered"""
+        if self.filter is not None:
+            metrics.USER_FILTER_LOOKUPS.labels("false_positive").inc()
+
+    async def add(self, emails: Iterable[str]):
+        """Add newly registered emails here, and publish them for workers
+        sharing their filters"""
+        emails = list(emails)
+        if not emails:
+            return
+        # Added before publishing, so this worker never turns away a user
+        # it just created while its own message is on the way back.
+        self._add_local(emails)
+        if self.client is None or not self.channel:
+            return
+        try:
+            await self.client.publish(self.channel, "\n".join(emails))
+        except RedisError as err:
+            # Other workers won't know these emails until they rebuild.
+            logger.error("Failed to share %d registered emails: %s", len(emails), err)
+
+    def _add_local(self, emails: Iterable[str]):
+        for bloom in (self.filter, self._building):
+            if bloom is not None:
+                for email in emails:
+                    bloom.add(email)
+        self._report()
+
+    async def build(self, expected: int, emails: AsyncIterator[str]):
+        """Replace the filter with one built from every registered email.
+        Emails added meanwhile go into both."""
+        start = time.perf_counter()
+        # Leave room for registrations until the next rebuild.
+        bloom = BloomFilter(max(self.capacity, 2 * expected), self.error_rate)
+        self._building = bloom
+        try:
+            async for email in emails:
+                bloom.add(email)
+        finally:
+            self._building = None
+        self.filter = bloom
+        self._report()
+        logger.info(
+            "Built filter of %d registered emails in %.1fs: %d bytes, "
+            "%.4f%% expected false positives",
+            bloom.count,
+            time.perf_counter() - start,
+            bloom.nbytes,
+            bloom.false_positive_rate() * 100,
+        )
+
+    def _report(self):
+        if self.filter is not None:
+            metrics.USER_FILTER_BYTES.set(self.filter.nbytes)
+            metrics.USER_FILTER_EMAILS.set(self.filter.count)
+            metrics.USER_FILTER_FALSE_POSITIVE_RATE.set(
+                self.filter.false_positive_rate()
+            )
+
+    async def run(
+        self,
+        count: Callable[[], Awaitable[int]],
+        scan: Callable[[], AsyncIterator[str]],
+        retry_delay: float = 5,
+    ):
+        """Build the filter from the users count and scan give, and keep it
+        current until cancelled"""
+        if self.mode == "off":
+            return
+        while True:
+            try:
+                if self.mode == "shared":
+                    await self._follow(count, scan)
+                else:
+                    await self.build(await count(), scan())
+                    await asyncio.sleep(self.rebuild_seconds)
+            except (RedisError, PyMongoError) as err:
+                logger.warning("Registered email filter out of sync: %s", err)
+                self.filter = None
+                await asyncio.sleep(retry_delay)
+
+    async def _follow(
+        self,
+        count: Callable[[], Awaitable[int]],
+        scan: Callable[[], AsyncIterator[str]],
+    ):
+        """Subscribe, then build, so registrations made while scanning are
+        not missed, and apply them until the next rebuild or a failure"""
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(self.channel)
+            loop = asyncio.get_event_loop()
+            while True:
+                # Messages published meanwhile wait in the subscription and
+                # are applied to the new filter once it is built.
+                await self.build(await count(), scan())
+                rebuild_at = loop.time() + self.rebuild_seconds
+                while loop.time() < rebuild_at:
+                    message = await pubsub.get_message(
+                        timeout=min(rebuild_at - loop.time(), 1)
+                    )
+                    if message is not None:
+                        self._add_local(message["data"].decode("utf-8").split("\n"))
+        finally:
+            await pubsub.reset()
+
+    async def close(self):
+        if self.client is not None:
+            await store.close_client(self.client)
+
+
+def create() -> RegisteredEmails:
+    if USER_FILTER != "shared" and not USER_FILTER_CHANNEL:
+        return RegisteredEmails()
+    return RegisteredEmails(client=store.create_pubsub_client())
+
+
+resources.register("registered_emails", create, close=RegisteredEmails.close)
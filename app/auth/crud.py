@@ -1,28 +1,348 @@
+import asyncio
 import logging
-from typing import Optional
+import os
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Set, Tuple
 
 import bson
+import pymongo
+from pymongo import ReadPreference
+from redis.exceptions import RedisError
 
-from app.auth import models
-from app.dependencies import db
+from app import dependencies, metrics
+from app.auth import models, store
+from app.auth.cache import TTLCache
+from app.resources import resources
+
+# Imported so the resources.registered_emails it registers exists.
+from app.auth import bloom  # noqa: F401
 
 logger = logging.getLogger()
 
+DUPLICATE_KEY = 11000
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 60))
+USER_CACHE_WATCH = bool(os.getenv("USER_CACHE_WATCH", False))
+# Emails of created or changed users are published here so every process drops
+# them from its cache and reads them from the primary. Empty to not publish.
+USER_CHANGES_CHANNEL = os.getenv("USER_CHANGES_CHANNEL", "users:changed")
+# How long reads of a user this process wrote go to the primary, which should
+# comfortably exceed replication lag.
+PRIMARY_READ_WINDOW = float(os.getenv("PRIMARY_READ_WINDOW", 10))
+USER_SCAN_BATCH = int(os.getenv("USER_SCAN_BATCH", 5000))
+
+# Only the fields the User model needs, plus the _id which mongo always returns.
+USER_PROJECTION = dict.fromkeys(models.User.__fields__, 1)
+
+# Parsed users by email, and the email of each cached user by id so change
+# stream events, which only carry the id, can be mapped back to a cache key.
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+cached_user_emails = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+# Emails of users written recently by this process or announced by another.
+# Secondaries may not have the write yet, so these are read from the primary.
+recently_written = TTLCache(maxsize=USER_CACHE_SIZE, ttl=PRIMARY_READ_WINDOW)
+
+resources.register("db", dependencies.connect, close=lambda db: db.client.close())
+resources.register(
+    "user_changes_client", store.create_pubsub_client, close=store.close_client
+)
+
+
+class UserExists(Exception):
+    pass
+
+
+def primary_users():
+    """The users collection, read from the primary rather than the default
+    MONGO_READ_PREFERENCE"""
+    return resources.db.get_collection("users", read_preference=ReadPreference.PRIMARY)
+
+
+def _written(emails: Iterable[str]):
+    for email in emails:
+        recently_written.set(email, True)
+
+
+async def _find_user(email: str) -> Optional[dict]:
+    """Find a user on a secondary unless it was written recently.
+
+    Users written by this process, or announced as created or changed by
+    another one, may not have been replicated yet, so those are read from the
+    primary. Emails the registered email filter rules out are not looked up
+    at all.
+    """
+    query = {"email": email}
+    if email in recently_written:
+        return await primary_users().find_one(query, USER_PROJECTION)
+    if not resources.registered_emails.might_exist(email):
+        return None
+    document = await resources.db.users.find_one(query, USER_PROJECTION)
+    if document is None:
+        resources.registered_emails.missed()
+    return document
+
 
+@metrics.timed("mongo", "find_user")
 async def get_user_by_email(email: str) -> Optional[models.UserInDB]:
-    user = await db.users.find_one({"email": email})
+    user = await _find_user(email)
     if not user:
         return None
     return models.UserInDB.parse_obj(user)
 
 
+@metrics.timed("mongo", "find_user")
+async def get_user_with_id(email: str) -> Optional[Tuple[str, models.UserInDB]]:
+    """Get a user along with their id, which the model does not keep"""
+    document = await _find_user(email)
+    if not document:
+        return None
+    return str(document["_id"]), models.UserInDB.parse_obj(document)
+
+
+def _cached_user(email: str) -> Optional[models.UserInDB]:
+    cached = user_cache.get(email)
+    if cached is None:
+        return None
+    user_id, user = cached
+    # Keep the id mapping as recently used as the user it points to.
+    cached_user_emails.get(user_id)
+    return user
+
+
+def _cache_user(document: dict) -> models.UserInDB:
+    user = models.UserInDB.parse_obj(document)
+    user_cache.set(user.email, (document["_id"], user))
+    cached_user_emails.set(document["_id"], user.email)
+    return user
+
+
+async def get_cached_user_by_email(email: str) -> Optional[models.UserInDB]:
+    """Get a user, served from the in process cache when possible.
+
+    Unknown emails are not cached so new registrations are seen immediately.
+    """
+    user = _cached_user(email)
+    if user is not None:
+        return user
+    document = await _find_user(email)
+    if not document:
+        return None
+    return _cache_user(document)
+
+
+@metrics.timed("mongo", "find_users")
+async def _find_users_by_email(emails: List[str]) -> List[dict]:
+    """Find users as _find_user does, in at most two queries"""
+    registered = resources.registered_emails
+    emails = [
+        email
+        for email in emails
+        if email in recently_written or registered.might_exist(email)
+    ]
+    secondary = [email for email in emails if email not in recently_written]
+    primary = [email for email in emails if email in recently_written]
+    documents = []
+    if secondary:
+        cursor = resources.db.users.find({"email": {"$in": secondary}}, USER_PROJECTION)
+        documents = await cursor.to_list(length=None)
+    if primary:
+        cursor = primary_users().find({"email": {"$in": primary}}, USER_PROJECTION)
+        documents.extend(await cursor.to_list(length=None))
+    return documents
+
+
+async def get_cached_users_by_email(
+    emails: Iterable[str]
+) -> Dict[str, models.UserInDB]:
+    """Get many users by email, fetching those that aren't cached in a single
+    query. Unknown emails are left out."""
+    users = {}
+    missing = []
+    for email in set(emails):
+        user = _cached_user(email)
+        if user is None:
+            missing.append(email)
+        else:
+            users[email] = user
+    if missing:
+        for document in await _find_users_by_email(missing):
+            user = _cache_user(document)
+            users[user.email] = user
+    return users
+
+
+def invalidate_user(email: str):
+    user_cache.delete(email)
+
+
+async def announce_changes(emails: Iterable[str]):
+    """Drop created or changed users from this process's cache, and publish
+    them so every other process does too and reads them from the primary
+    for a while"""
+    emails = list(emails)
+    for email in emails:
+        invalidate_user(email)
+    if not emails or not USER_CHANGES_CHANNEL:
+        return
+    try:
+        await resources.user_changes_client.publish(
+            USER_CHANGES_CHANNEL, "\n".join(emails)
+        )
+    except RedisError as err:
+        # Other processes serve these users from cache until they expire.
+        logger.error("Failed to announce %d changed users: %s", len(emails), err)
+
+
+@metrics.timed("mongo", "insert_user")
 async def create_user(user: models.UserInDB) -> models.UserInDB:
-    result = await db.users.insert_one(
-        user.dict(exclude={"password", "_id"}, skip_defaults=True)
+    """Insert a user, relying on the unique email index to reject duplicates"""
+    document = user.dict(exclude={"password", "_id"}, skip_defaults=True)
+    try:
+        await resources.db.users.insert_one(document)
+    except pymongo.errors.DuplicateKeyError:
+        raise UserExists(user.email)
+    _written([user.email])
+    await resources.registered_emails.add([user.email])
+    await announce_changes([user.email])
+    return models.UserInDB.parse_obj(document)
+
+
+@metrics.timed("mongo", "insert_users")
+async def create_users(users: List[models.UserInDB]) -> Set[int]:
+    """Insert users in one unordered batch.
+
+    Returns the positions of users that were not created because their email
+    is already registered.
+    """
+    if not users:
+        return set()
+    documents = [
+        user.dict(exclude={"password", "_id"}, skip_defaults=True) for user in users
+    ]
+    _written(user.email for user in users)
+    try:
+        await resources.db.users.insert_many(documents, ordered=False)
+    except pymongo.errors.BulkWriteError as err:
+        # Emails already registered are in the filter, and others may have
+        # been inserted before the batch failed.
+        await resources.registered_emails.add(user.email for user in users)
+        await announce_changes(user.email for user in users)
+        write_errors = err.details["writeErrors"]
+        if any(error["code"] != DUPLICATE_KEY for error in write_errors):
+            raise
+        return {error["index"] for error in write_errors}
+    await resources.registered_emails.add(user.email for user in users)
+    await announce_changes(user.email for user in users)
+    return set()
+
+
+@metrics.timed("mongo", "upsert_users")
+async def upsert_users(users: List[models.UserInDB]) -> int:
+    """Create or update users by email in one unordered bulk write.
+
+    Returns the number of users created.
+    """
+    if not users:
+        return 0
+    requests = [
+        pymongo.UpdateOne(
+            {"email": user.email},
+            {"$set": user.dict(exclude={"password", "_id"}, skip_defaults=True)},
+            upsert=True,
+        )
+        for user in users
+    ]
+    _written(user.email for user in users)
+    result = await resources.db.users.bulk_write(requests, ordered=False)
+    await resources.registered_emails.add(user.email for user in users)
+    await announce_changes(user.email for user in users)
+    return result.upserted_count
+
+
+def find_users(batch_size: int = 1000):
+    """Cursor over every user, fetched from mongo ``batch_size`` at a time"""
+    return resources.db.users.find(
+        {}, {**USER_PROJECTION, "_id": 0}, batch_size=batch_size
     )
-    created = await db.users.find_one({"_id": result.inserted_id})
-    return models.UserInDB.parse_obj(created)
 
 
+async def count_users() -> int:
+    return await primary_users().estimated_document_count()
+
+
+async def scan_emails(batch_size: int = USER_SCAN_BATCH) -> AsyncIterator[str]:
+    """Every registered email, from the primary so none just written are
+    missed"""
+    cursor = primary_users().find({}, {"email": 1, "_id": 0}, batch_size=batch_size)
+    async for document in cursor:
+        yield document["email"]
+
+
+@metrics.timed("mongo", "update_user")
+async def update_user(email: str, changes: dict) -> Optional[models.UserInDB]:
+    updated = await resources.db.users.find_one_and_update(
+        {"email": email},
+        {"$set": changes},
+        projection=USER_PROJECTION,
+        return_document=pymongo.ReturnDocument.AFTER,
+    )
+    _written([email])
+    await announce_changes([email])
+    if not updated:
+        return None
+    return models.UserInDB.parse_obj(updated)
+
+
+@metrics.timed("mongo", "find_user_by_id")
 async def get_user_by_id(user_id: str) -> models.UserInDB:
-    return await db.users.find_one({"_id": bson.ObjectId(user_id)})
+    return await resources.db.users.find_one({"_id": bson.ObjectId(user_id)})
+
+
+async def watch_user_changes(retry_delay: float = 5):
+    """Invalidate cached users as soon as they are changed by any process.
+
+    Change streams require mongo to run as a replica set.
+    """
+    pipeline = [{"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}}]
+    while True:
+        try:
+            async with resources.db.users.watch(pipeline) as stream:
+                # Changes may have been missed while the stream was down.
+                user_cache.clear()
+                async for change in stream:
+                    email = cached_user_emails.get(change["documentKey"]["_id"])
+                    if email is not None:
+                        invalidate_user(email)
+        except pymongo.errors.PyMongoError as err:
+            logger.warning(f"User change stream failed: {err}")
+            user_cache.clear()
+            await asyncio.sleep(retry_delay)
+
+
+async def follow_user_changes(retry_delay: float = 5):
+    """Invalidate cached users announced as created or changed by any process,
+    and read them from the primary until replicated"""
+    while True:
+        try:
+            await _follow_user_changes()
+        except RedisError as err:
+            logger.warning("User change announcements failed: %s", err)
+            user_cache.clear()
+            await asyncio.sleep(retry_delay)
+
+
+async def _follow_user_changes():
+    pubsub = resources.user_changes_client.pubsub(ignore_subscribe_messages=True)
+    try:
+        await pubsub.subscribe(USER_CHANGES_CHANNEL)
+        # Changes may have been missed while unsubscribed.
+        user_cache.clear()
+        while True:
+            message = await pubsub.get_message(timeout=1)
+            if message is not None:
+                emails = message["data"].decode("utf-8").split("\n")
+                _written(emails)
+                for email in emails:
+                    invalidate_user(email)
+    finally:
+        await pubsub.reset()
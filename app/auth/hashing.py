@@ -0,0 +1,157 @@
+import abc
+import asyncio
+import hashlib
+import hmac
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Union
+
+from passlib.context import CryptContext
+
+from app import metrics
+from app.resources import resources
+
+logger = logging.getLogger()
+
+HASH_BACKEND = os.getenv("HASH_BACKEND", "process")
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", os.cpu_count() or 1))
+HMAC_PREFIX = "hmac-sha256$"
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def _as_str(value: Union[str, bytes]) -> str:
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    return value
+
+
+def _bcrypt_hash(secret: str) -> str:
+    return pwd_context.hash(secret)
+
+
+def _bcrypt_verify(secret: str, secret_hash: Union[str, bytes]) -> bool:
+    try:
+        return pwd_context.verify(secret, secret_hash)
+    except ValueError:
+        # Not a bcrypt digest, e.g. issued while another backend was configured.
+        return False
+
+
+class HashBackend(abc.ABC):
+    """Hashes and verifies one time secrets without blocking the event loop"""
+
+    name = None
+
+    @abc.abstractmethod
+    async def hash(self, secret: str) -> str:
+        ...
+
+    @abc.abstractmethod
+    async def verify(self, secret: str, secret_hash: Union[str, bytes]) -> bool:
+        ...
+
+    def shutdown(self):
+        pass
+
+
+class InlineBackend(HashBackend):
+    """bcrypt on the calling thread. Blocks the event loop for every call."""
+
+    name = "inline"
+
+    async def hash(self, secret: str) -> str:
+        return _bcrypt_hash(secret)
+
+    async def verify(self, secret: str, secret_hash: Union[str, bytes]) -> bool:
+        return _bcrypt_verify(secret, secret_hash)
+
+
+class ProcessPoolBackend(HashBackend):
+    """bcrypt in a bounded pool of worker processes.
+
+    The pool is started on first use so that forking web server workers do not
+    inherit it.
+    """
+
+    name = "process"
+
+    def __init__(self, max_workers: int = HASH_POOL_SIZE):
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    async def hash(self, secret: str) -> str:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, _bcrypt_hash, secret)
+
+    async def verify(self, secret: str, secret_hash: Union[str, bytes]) -> bool:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, _bcrypt_verify, secret, _as_str(secret_hash)
+        )
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class HMACBackend(HashBackend):
+    """Keyed HMAC-SHA256 digests compared in constant time.
+
+    Codes are random, single use and expire after a few minutes, so a keyed
+    digest is sufficient and costs microseconds instead of bcrypt's
+    deliberate slowness.
+    """
+
+    name = "hmac"
+
+    def __init__(self, key: Union[str, bytes]):
+        if not key:
+            raise ValueError("HMAC hashing backend requires a key")
+        self._key = key.encode("utf-8") if isinstance(key, str) else key
+
+    def _digest(self, secret: str) -> str:
+        mac = hmac.new(self._key, secret.encode("utf-8"), hashlib.sha256)
+        return HMAC_PREFIX + mac.hexdigest()
+
+    async def hash(self, secret: str) -> str:
+        return self._digest(secret)
+
+    async def verify(self, secret: str, secret_hash: Union[str, bytes]) -> bool:
+        secret_hash = _as_str(secret_hash)
+        if not secret_hash.startswith(HMAC_PREFIX):
+            return False
+        return hmac.compare_digest(self._digest(secret), secret_hash)
+
+
+def get_backend(name: str = HASH_BACKEND) -> HashBackend:
+    if name == ProcessPoolBackend.name:
+        return ProcessPoolBackend()
+    if name == HMACBackend.name:
+        return HMACBackend(os.getenv("HASH_HMAC_KEY") or os.getenv("SECRET_KEY"))
+    if name == InlineBackend.name:
+        return InlineBackend()
+    raise ValueError(f"Unknown hash backend: {name}")
+
+
+resources.register(
+    "hash_backend", get_backend, close=lambda backend: backend.shutdown()
+)
+
+
+@metrics.timed("hash", "hash")
+async def hash_secret(secret: str) -> str:
+    return await resources.hash_backend.hash(secret)
+
+
+@metrics.timed("hash", "verify")
+async def verify_secret(secret: str, secret_hash: Union[str, bytes]) -> bool:
+    return await resources.hash_backend.verify(secret, secret_hash)
@@ -0,0 +1,75 @@
+import logging
+import os
+from typing import Dict, List
+
+import pymongo
+from motor import motor_asyncio
+from pymongo import IndexModel
+
+logger = logging.getLogger()
+
+INDEX_NOT_FOUND = 27
+# Also drop indexes on these collections that neither the app nor earlier
+# versions of it created, such as ones made by hand.
+INDEXES_DROP_UNDECLARED = bool(os.getenv("INDEXES_DROP_UNDECLARED", False))
+
+# Every index the app relies on, by collection.
+INDEXES: Dict[str, List[IndexModel]] = {
+    "users": [IndexModel([("email", pymongo.ASCENDING)], name="email", unique=True)]
+}
+# Indexes earlier versions of the app created and no longer use, by
+# collection. ensure_indexes drops these, and declared ones that changed.
+RETIRED_INDEXES: Dict[str, List[str]] = {"users": ["username_1"]}
+
+_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def _matches(model: IndexModel, info: dict) -> bool:
+    document = model.document
+    if list(document["key"].items()) != [tuple(key) for key in info["key"]]:
+        return False
+    return all(
+        (document.get(option) or None) == (info.get(option) or None)
+        for option in _OPTIONS
+    )
+
+
+async def ensure_indexes(
+    db: motor_asyncio.AsyncIOMotorDatabase,
+    indexes: Dict[str, List[IndexModel]] = None,
+    drop_undeclared: bool = None,
+):
+    """Reconcile the indexes in the database with the declared ones.
+
+    Indexes the app did not create are logged and kept unless
+    ``drop_undeclared``, which defaults to INDEXES_DROP_UNDECLARED.
+    """
+    indexes = INDEXES if indexes is None else indexes
+    if drop_undeclared is None:
+        drop_undeclared = INDEXES_DROP_UNDECLARED
+    for collection_name, models in indexes.items():
+        collection = db[collection_name]
+        declared = {model.document["name"]: model for model in models}
+        retired = RETIRED_INDEXES.get(collection_name, [])
+        existing = await collection.index_information()
+        for name, info in existing.items():
+            if name == "_id_":
+                continue
+            model = declared.get(name)
+            if model is not None and _matches(model, info):
+                del declared[name]
+                continue
+            if model is None and name not in retired and not drop_undeclared:
+                logger.warning(f"Keeping undeclared index {name} on {collection_name}")
+                continue
+            logger.info(f"Dropping index {name} on {collection_name}")
+            try:
+                await collection.drop_index(name)
+            except pymongo.errors.OperationFailure as err:
+                # Every worker reconciles at startup, and another may have
+                # dropped it first.
+                if err.code != INDEX_NOT_FOUND:
+                    raise
+        if declared:
+            logger.info(f"Creating indexes {list(declared)} on {collection_name}")
+            await collection.create_indexes(list(declared.values()))
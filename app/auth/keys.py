@@ -0,0 +1,199 @@
+"""Keys access tokens are signed and verified with.
+
+HS256 signs with SECRET_KEY, so only this service can verify tokens. With
+ES256, tokens carry the id of the key that signed them and the public keys
+are published as a JWKS, so other services can verify tokens themselves.
+
+Asymmetric keys are PEM files named ``{kid}.pem`` in JWT_KEYS_DIR. Tokens are
+signed with the private key JWT_SIGNING_KID, or the last kid in sort order,
+so date based kids rotate by adding a newer file. Every key in the directory,
+including public key only files, stays published and accepted until it is
+removed, which should be no sooner than the longest token lifetime.
+
+    python -m app.auth.keys generate 2019-10 --dir keys
+"""
+import argparse
+import base64
+import functools
+import hashlib
+import os
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from starlette.requests import Request
+from starlette.responses import Response
+
+from app import responses
+
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+JWT_KEYS_DIR = os.getenv("JWT_KEYS_DIR", "keys")
+JWT_SIGNING_KID = os.getenv("JWT_SIGNING_KID")
+JWKS_MAX_AGE = int(os.getenv("JWKS_MAX_AGE", 3600))
+
+SYMMETRIC = {"HS256"}
+ASYMMETRIC = {"ES256"}
+
+
+def _b64(value: int) -> str:
+    data = value.to_bytes(32, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _public(key) -> ec.EllipticCurvePublicKey:
+    if isinstance(key, ec.EllipticCurvePrivateKey):
+        return key.public_key()
+    return key
+
+
+def load_pem(data: bytes):
+    """Load a private key, or a public key if that is all the file holds"""
+    try:
+        key = serialization.load_pem_private_key(data, None, default_backend())
+    except ValueError:
+        key = serialization.load_pem_public_key(data, default_backend())
+    public_key = _public(key)
+    if not isinstance(public_key, ec.EllipticCurvePublicKey) or not isinstance(
+        public_key.curve, ec.SECP256R1
+    ):
+        raise ValueError("ES256 keys must be on the P-256 curve")
+    return key
+
+
+def public_jwk(kid: str, key) -> Dict[str, str]:
+    numbers = _public(key).public_numbers()
+    return {
+        "kty": "EC",
+        "crv": "P-256",
+        "x": _b64(numbers.x),
+        "y": _b64(numbers.y),
+        "kid": kid,
+        "use": "sig",
+        "alg": "ES256",
+    }
+
+
+class KeySet:
+    def __init__(
+        self,
+        algorithm: str,
+        signing_key: Any,
+        verifying_keys: Dict[Optional[str], Any],
+        signing_kid: str = None,
+    ):
+        self.algorithm = algorithm
+        self.signing_key = signing_key
+        self.verifying_keys = verifying_keys
+        self.signing_kid = signing_kid
+
+    def encode(self, payload: dict) -> str:
+        headers = {"kid": self.signing_kid} if self.signing_kid else None
+        return jwt.encode(
+            payload, self.signing_key, algorithm=self.algorithm, headers=headers
+        ).decode("utf-8")
+
+    def decode(self, token: str) -> dict:
+        kid = None
+        if self.signing_kid:
+            kid = jwt.get_unverified_header(token).get("kid")
+        key = self.verifying_keys.get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown key id: {kid}")
+        return jwt.decode(token, key, algorithms=[self.algorithm])
+
+    def jwks(self) -> dict:
+        """Public keys in JWKS form. Empty for shared secret algorithms."""
+        if self.algorithm in SYMMETRIC:
+            return {"keys": []}
+        return {
+            "keys": [public_jwk(kid, key) for kid, key in self.verifying_keys.items()]
+        }
+
+
+def load_keys(
+    algorithm: str = JWT_ALGORITHM,
+    secret_key: str = None,
+    keys_dir: str = JWT_KEYS_DIR,
+    signing_kid: str = JWT_SIGNING_KID,
+) -> KeySet:
+    if algorithm in SYMMETRIC:
+        return KeySet(algorithm, secret_key, {None: secret_key})
+    if algorithm not in ASYMMETRIC:
+        raise ValueError(f"Unsupported JWT algorithm: {algorithm}")
+    keys = {
+        path.stem: load_pem(path.read_bytes())
+        for path in sorted(Path(keys_dir).glob("*.pem"))
+    }
+    private = [
+        kid for kid, key in keys.items() if isinstance(key, ec.EllipticCurvePrivateKey)
+    ]
+    if not private:
+        raise ValueError(f"No private keys in {keys_dir}")
+    signing_kid = signing_kid or private[-1]
+    if signing_kid not in private:
+        raise ValueError(f"No private key for signing kid {signing_kid}")
+    verifying_keys = {kid: _public(key) for kid, key in keys.items()}
+    return KeySet(algorithm, keys[signing_kid], verifying_keys, signing_kid)
+
+
+def jwks_endpoint(
+    get_key_set: Callable[[], KeySet], max_age: int = JWKS_MAX_AGE
+) -> Callable:
+    """Serve the public keys, encoded on first use since they only change on
+    restart.
+
+    Verifiers may cache them for max_age, so a new signing key should be
+    published at least that long before it is used.
+    """
+
+    @functools.lru_cache(maxsize=1)
+    def encode():
+        body = responses.encode(get_key_set().jwks())
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        headers = {"Cache-Control": f"public, max-age={max_age}", "ETag": etag}
+        return body, etag, headers
+
+    async def endpoint(request: Request) -> Response:
+        body, etag, headers = encode()
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return responses.EncodedJSONResponse(body, headers=headers)
+
+    return endpoint
+
+
+def generate(kid: str, keys_dir: str = JWT_KEYS_DIR) -> Path:
+    path = Path(keys_dir) / f"{kid}.pem"
+    if path.exists():
+        raise FileExistsError(path)
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(
+        key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    path.chmod(0o600)
+    return path
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+    generate_parser = commands.add_parser("generate", help="Generate a P-256 key")
+    generate_parser.add_argument("kid", help="Key id, e.g. the date it was made")
+    generate_parser.add_argument("--dir", default=JWT_KEYS_DIR)
+    args = parser.parse_args(argv)
+    print(generate(args.kid, args.dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Any, List, Optional
 
 from pydantic import BaseModel, EmailStr, Schema
 
@@ -23,6 +23,19 @@ class UserInDB(User):
         return self._id
 
 
+class SecretRecord(BaseModel):
+    """What is stored for an issued one time secret.
+
+    The user is bound to the secret when it is issued, so confirming it
+    doesn't need to look them up again.
+    """
+
+    secret_hash: str
+    user_id: Optional[str] = None
+    email: Optional[str] = None
+    disabled: bool = False
+
+
 class OTP(BaseModel):
     email: EmailStr = Schema(..., title="Email")
     code: str = Schema(
@@ -37,3 +50,30 @@ class Magic(BaseModel):
 
 class AuthRequest(BaseModel):
     email: EmailStr = Schema(..., title="Email", description="Email of registered user")
+
+
+class RegistrationResult(BaseModel):
+    email: Optional[str] = Schema(None, title="Email")
+    status: str = Schema(
+        ..., title="Status", description="One of created, duplicate or invalid"
+    )
+    detail: Any = Schema(None, title="Detail", description="Why a user is invalid")
+
+
+class IntrospectRequest(BaseModel):
+    tokens: List[str] = Schema(..., title="Access tokens to check")
+
+
+class RevokeRequest(BaseModel):
+    tokens: List[str] = Schema(..., title="Access tokens to revoke")
+
+
+class TokenIntrospection(BaseModel):
+    active: bool = Schema(
+        ...,
+        title="Active",
+        description="Whether the token is valid and its user exists and is enabled",
+    )
+    claims: Optional[dict] = Schema(
+        None, title="Claims", description="Claims of an active token"
+    )
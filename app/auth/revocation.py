@@ -0,0 +1,158 @@
+"""Revoked access tokens, checked without a round trip to redis.
+
+Access tokens carry a random ``jti``. Revoking one adds it to a sorted set
+in redis, scored by when the token expires, and publishes it on
+REVOKED_CHANNEL. Each worker keeps a copy of the set in memory: it
+subscribes, loads the set, then applies whatever is published, so checking
+a token is a dict lookup. Expired entries are swept from the copy every
+REVOKED_SWEEP_SECONDS, since expired tokens are rejected anyway.
+
+While a worker's copy is out of sync, such as before it has loaded or after
+losing its subscription, it checks tokens in redis instead.
+"""
+import asyncio
+import heapq
+import logging
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+from app import metrics
+from app.auth import store
+from app.resources import resources
+
+logger = logging.getLogger()
+
+REVOKED_REDIS_DB = int(os.getenv("REVOKED_REDIS_DB", 5))
+REVOKED_KEY = os.getenv("REVOKED_KEY", "revoked_tokens")
+REVOKED_CHANNEL = os.getenv("REVOKED_CHANNEL", "tokens:revoked")
+REVOKED_SWEEP_SECONDS = float(os.getenv("REVOKED_SWEEP_SECONDS", 60))
+
+# Adds a token, drops expired ones, keeps the set until its last token
+# expires, and tells every worker. One script so a revocation is never
+# stored without being published.
+REVOKE = """
+redis.call("ZADD", KEYS[1], ARGV[2], ARGV[1])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", ARGV[3])
+local last = redis.call("ZRANGE", KEYS[1], -1, -1, "WITHSCORES")
+redis.call("EXPIREAT", KEYS[1], math.ceil(tonumber(last[2])))
+redis.call("PUBLISH", ARGV[4], ARGV[1] .. " " .. ARGV[2])
+"""
+
+
+class RevokedTokens:
+    """Token ids revoked before they expire, mirrored in every worker"""
+
+    def __init__(
+        self,
+        client: aioredis.Redis,
+        subscriber: aioredis.Redis,
+        key: str = REVOKED_KEY,
+        channel: str = REVOKED_CHANNEL,
+        sweep_seconds: float = REVOKED_SWEEP_SECONDS,
+    ):
+        self.client = client
+        self.subscriber = subscriber
+        self.key = key
+        self.channel = channel
+        self.sweep_seconds = sweep_seconds
+        self._revoke = client.register_script(REVOKE)
+        # When each revoked token expires by id, and the same ordered by
+        # expiry for sweeping. None while out of sync with redis.
+        self.revoked: Optional[Dict[str, float]] = None
+        self._expiries: List[Tuple[float, str]] = []
+
+    @metrics.timed("redis", "revoke_token")
+    async def revoke(self, jti: str, expires_at: float):
+        now = time.time()
+        if expires_at <= now:
+            return
+        await self._revoke(keys=[self.key], args=[jti, expires_at, now, self.channel])
+        # Seen here straight away, without waiting for the message.
+        self._add(jti, expires_at)
+
+    async def is_revoked(self, jti: str) -> bool:
+        if self.revoked is not None:
+            return jti in self.revoked
+        return await self._is_revoked_in_redis(jti)
+
+    @metrics.timed("redis", "check_revoked")
+    async def _is_revoked_in_redis(self, jti: str) -> bool:
+        expires_at = await self.client.zscore(self.key, jti)
+        return expires_at is not None and expires_at > time.time()
+
+    def _add(self, jti: str, expires_at: float):
+        if self.revoked is None:
+            return
+        self.revoked[jti] = expires_at
+        heapq.heappush(self._expiries, (expires_at, jti))
+        metrics.REVOKED_TOKENS.set(len(self.revoked))
+
+    def sweep(self, now: float = None):
+        """Forget tokens that have expired"""
+        if self.revoked is None:
+            return
+        now = time.time() if now is None else now
+        while self._expiries and self._expiries[0][0] <= now:
+            _expires_at, jti = heapq.heappop(self._expiries)
+            self.revoked.pop(jti, None)
+        metrics.REVOKED_TOKENS.set(len(self.revoked))
+
+    async def load(self):
+        """Replace the copy with the tokens in redis that have not expired"""
+        entries = await self.client.zrangebyscore(
+            self.key, time.time(), "+inf", withscores=True
+        )
+        self.revoked = {jti.decode("utf-8"): expires_at for jti, expires_at in entries}
+        self._expiries = [(expires_at, jti) for jti, expires_at in self.revoked.items()]
+        heapq.heapify(self._expiries)
+        metrics.REVOKED_TOKENS.set(len(self.revoked))
+
+    async def run(self, retry_delay: float = 5):
+        """Keep the copy in sync and swept until cancelled"""
+        while True:
+            try:
+                await self._follow()
+            except RedisError as err:
+                logger.warning("Revoked tokens out of sync: %s", err)
+                self.revoked = None
+                self._expiries = []
+                await asyncio.sleep(retry_delay)
+
+    async def _follow(self):
+        """Subscribe, then load, so revocations made while loading are not
+        missed, and apply them as they are published"""
+        pubsub = self.subscriber.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(self.channel)
+            await self.load()
+            loop = asyncio.get_event_loop()
+            sweep_at = loop.time() + self.sweep_seconds
+            while True:
+                message = await pubsub.get_message(
+                    timeout=max(min(sweep_at - loop.time(), 1), 0)
+                )
+                if message is not None:
+                    jti, expires_at = message["data"].decode("utf-8").split(" ")
+                    self._add(jti, float(expires_at))
+                if loop.time() >= sweep_at:
+                    self.sweep()
+                    sweep_at = loop.time() + self.sweep_seconds
+        finally:
+            await pubsub.reset()
+
+    async def close(self):
+        await store.close_client(self.client)
+        await store.close_client(self.subscriber)
+
+
+resources.register(
+    "revoked_tokens",
+    lambda: RevokedTokens(
+        store.create_client(db=REVOKED_REDIS_DB), store.create_pubsub_client()
+    ),
+    close=RevokedTokens.close,
+)
@@ -1,105 +1,163 @@
 import datetime
 import logging
 import os
+from typing import List, Tuple
 
-import aiohttp
-from fastapi import APIRouter, Depends, Body, HTTPException, Form
-from starlette.responses import UJSONResponse
-from starlette.status import HTTP_201_CREATED, HTTP_400_BAD_REQUEST
+from fastapi import Depends, Body, HTTPException
+from pydantic import ValidationError
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.status import (
+    HTTP_201_CREATED,
+    HTTP_400_BAD_REQUEST,
+    HTTP_401_UNAUTHORIZED,
+    HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+)
 
-from app.auth import models, security, crud
+from app import responses
+from app.auth import models, security, crud, throttle
 from app.auth.security import oauth2_scheme
+from app.resources import resources
+
+# Imported so the resources.outbox and resources.refresh_tokens they register
+# exist wherever the routes do.
+from app import outbox  # noqa: F401
+from app.auth import sessions  # noqa: F401
 
-auth_router = APIRouter()
+auth_router = responses.Router()
 
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
-mailgun_key = os.getenv("MAILGUN_KEY")
-mailgun_enpoint = os.getenv("MAILGUN_ENDPOINT")
-from_name = os.getenv("MAILGUN_FROM_NAME")
-from_address = os.getenv("MAILGUN_FROM_ADDRESS")
+BULK_REGISTER_MAX = int(os.getenv("BULK_REGISTER_MAX", 10000))
+INTROSPECT_MAX = int(os.getenv("INTROSPECT_MAX", 1000))
 DEBUG = bool(os.getenv("DEBUG", False))
 secure_cookies = not DEBUG
+REFRESH_COOKIE = "refresh_token"
+# Sent with every request under /auth, which covers the refresh and sign out
+# endpoints, and never to the rest of the site.
+REFRESH_COOKIE_PATH = "/auth"
 
 logger = logging.getLogger()
 
+# Constant bodies are encoded once rather than on every request.
+CHECK_EMAIL_OTP = responses.encode("Please check your email for a single use password.")
+CHECK_EMAIL_MAGIC = responses.encode("Please check your email for your sign in link.")
+AUTHENTICATED = responses.encode({"status": "authenticated"})
+SIGNED_OUT = responses.encode({"status": "signed out"})
+
 
 async def send_email(to: str, subject: str, text: str):
-    async with aiohttp.ClientSession() as session:
-        res = await session.post(
-            mailgun_enpoint,
-            auth=aiohttp.BasicAuth("api", mailgun_key),
-            data={
-                "from": f"{from_name} <{from_address}>",
-                "to": to,
-                "subject": subject,
-                "text": text,
-            },
-        )
-        if res.status != 200:
-            raise HTTPException(status_code=500, detail="Could not send email.")
+    """Queue an email for the outbox workers to deliver"""
+    await resources.outbox.enqueue(to, subject, text)
 
 
-@auth_router.post("/request")
-async def request_login(data: models.AuthRequest = Body(...)):
-    user = await crud.get_user_by_email(data.email)
-    if not user:
+async def find_user(email: str) -> Tuple[str, models.UserInDB]:
+    found = await crud.get_user_with_id(email)
+    if not found:
         raise HTTPException(
             status_code=HTTP_400_BAD_REQUEST, detail="No user with that email."
         )
-    otp = security.generate_otp(data.email)
-    await send_email(data.email, "Your One Time Password", f"Your password is {otp}")
-    return "Please check your email for a single use password."
+    return found
 
 
-@auth_router.post("/request-magic")
-async def request_magic(data: models.AuthRequest = Body(...)):
-    user = await crud.get_user_by_email(data.email)
-    if not user:
-        raise HTTPException(
-            status_code=HTTP_400_BAD_REQUEST, detail="No user with that email."
-        )
-    magic_link = security.generate_magic_link(data.email)
+async def send_otp(email: str):
+    user_id, user = await find_user(email)
+    otp = await security.generate_otp(email, user_id, user)
+    await send_email(email, "Your One Time Password", f"Your password is {otp}")
+
+
+async def send_magic_link(email: str):
+    user_id, user = await find_user(email)
+    magic_link = await security.generate_magic_link(email, user_id, user)
     await send_email(
-        data.email,
-        "Your magic sign in link",
-        f"Click this link to sign in\n{magic_link}",
+        email, "Your magic sign in link", f"Click this link to sign in\n{magic_link}"
     )
-    return "Please check your email for your sign in link."
 
 
-@auth_router.post("/confirm-magic")
-async def verify_magic(data: models.Magic = Body(...)):
-    user = await security.authenticate_user_magic(data.email, data.secret)
-    if not user:
-        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Invalid Link")
+def signed_in(email: str, refresh_token: str) -> Response:
     access_token_expires = datetime.timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = security.create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
+        data={"sub": email}, expires_delta=access_token_expires
     )
-    response = UJSONResponse({"status": "authenticated"})
+    response = responses.EncodedJSONResponse(AUTHENTICATED)
     response.set_cookie(
         oauth2_scheme.token_name, access_token, httponly=True, secure=secure_cookies
     )
+    response.set_cookie(
+        REFRESH_COOKIE,
+        refresh_token,
+        max_age=int(resources.refresh_tokens.lifetime.total_seconds()),
+        path=REFRESH_COOKIE_PATH,
+        httponly=True,
+        secure=secure_cookies,
+    )
     return response
 
 
-@auth_router.post("/confirm")
-async def confirm_login(data: models.OTP = Body(...)):
+@auth_router.post("/request", responses={429: {"description": "Too many requests"}})
+async def request_login(request: Request, data: models.AuthRequest = Body(...)):
+    await throttle.enforce("request", data.email, throttle.client_address(request))
+    await throttle.issue_once("otp", data.email, lambda: send_otp(data.email))
+    return responses.EncodedJSONResponse(CHECK_EMAIL_OTP)
+
+
+@auth_router.post(
+    "/request-magic", responses={429: {"description": "Too many requests"}}
+)
+async def request_magic(request: Request, data: models.AuthRequest = Body(...)):
+    await throttle.enforce(
+        "request-magic", data.email, throttle.client_address(request)
+    )
+    await throttle.issue_once("magic", data.email, lambda: send_magic_link(data.email))
+    return responses.EncodedJSONResponse(CHECK_EMAIL_MAGIC)
+
+
+@auth_router.post(
+    "/confirm-magic", responses={429: {"description": "Too many requests"}}
+)
+async def verify_magic(request: Request, data: models.Magic = Body(...)):
+    await throttle.enforce("confirm", data.email, throttle.client_address(request))
+    user = await security.authenticate_user_magic(data.email, data.secret)
+    if not user:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Invalid Link")
+    if user.disabled:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Inactive user")
+    return signed_in(user.email, await resources.refresh_tokens.issue(user.email))
+
+
+@auth_router.post("/confirm", responses={429: {"description": "Too many requests"}})
+async def confirm_login(request: Request, data: models.OTP = Body(...)):
+    await throttle.enforce("confirm", data.email, throttle.client_address(request))
     user = await security.authenticate_user(data.email, data.code)
     logger.debug(user)
     if not user:
         raise HTTPException(
             status_code=HTTP_400_BAD_REQUEST, detail="Invalid Email or Code"
         )
-    access_token_expires = datetime.timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = security.create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
-    response = UJSONResponse({"status": "authenticated"})
-    response.set_cookie(
-        oauth2_scheme.token_name, access_token, httponly=True, secure=secure_cookies
+    if user.disabled:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail="Inactive user")
+    return signed_in(user.email, await resources.refresh_tokens.issue(user.email))
+
+
+@auth_router.post(
+    "/refresh", responses={401: {"description": "Invalid or reused refresh token"}}
+)
+async def refresh(request: Request):
+    """Exchange the refresh token cookie for a new access token and refresh
+    token, without signing in again"""
+    credentials_exception = HTTPException(
+        status_code=HTTP_401_UNAUTHORIZED, detail="Not Authorized"
     )
-    return response
+    token = request.cookies.get(REFRESH_COOKIE)
+    if not token:
+        raise credentials_exception
+    rotated = await resources.refresh_tokens.rotate(token)
+    if not rotated:
+        raise credentials_exception
+    user = await crud.get_cached_user_by_email(rotated.email)
+    if not user or user.disabled:
+        await resources.refresh_tokens.revoke(rotated.token)
+        raise credentials_exception
+    return signed_in(user.email, rotated.token)
 
 
 @auth_router.post(
@@ -109,21 +167,121 @@ async def confirm_login(data: models.OTP = Body(...)):
     responses={400: {"description": "Email is invalid"}},
 )
 async def register(user: models.User = Body(...)):
-    if await crud.get_user_by_email(user.email):
+    new_user = models.UserInDB.parse_obj(user)
+    try:
+        created_user = await crud.create_user(new_user)
+    except crud.UserExists:
         raise HTTPException(
             status_code=400, detail="A user with that email already exists"
         )
-    new_user = models.UserInDB.parse_obj(user)
-    created_user = await crud.create_user(new_user)
-    return created_user
+    return responses.model_response(created_user, models.User, HTTP_201_CREATED)
+
+
+@auth_router.post(
+    "/register/bulk",
+    response_model=List[models.RegistrationResult],
+    responses={413: {"description": "Too many users in one request"}},
+)
+async def register_bulk(users: List[dict] = Body(...)):
+    """Register many users at once, with a result for each"""
+    if len(users) > BULK_REGISTER_MAX:
+        raise HTTPException(
+            status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {BULK_REGISTER_MAX} users can be registered at once",
+        )
+    results = []
+    new_users = []
+    for data in users:
+        try:
+            new_user = models.UserInDB.parse_obj(models.User.parse_obj(data))
+        except ValidationError as err:
+            results.append(
+                models.RegistrationResult(
+                    email=data.get("email"), status="invalid", detail=err.errors()
+                )
+            )
+            continue
+        results.append(
+            models.RegistrationResult(email=new_user.email, status="created")
+        )
+        new_users.append((len(results) - 1, new_user))
+    duplicates = await crud.create_users([new_user for _, new_user in new_users])
+    for position in duplicates:
+        results[new_users[position][0]].status = "duplicate"
+    return responses.ORJSONResponse([result.dict() for result in results])
+
+
+@auth_router.post(
+    "/introspect",
+    response_model=List[models.TokenIntrospection],
+    responses={
+        401: {"description": "Missing or wrong introspection secret"},
+        413: {"description": "Too many tokens in one request"},
+    },
+)
+async def introspect(
+    data: models.IntrospectRequest = Body(...),
+    _client: None = Depends(security.verify_introspection_client),
+):
+    """Check many access tokens at once, with a result for each in order.
+
+    Users of every valid token are looked up together, so a gateway can check
+    all the requests it is holding in one call. Gateways authenticate with
+    INTROSPECT_SECRET as a bearer token.
+    """
+    if len(data.tokens) > INTROSPECT_MAX:
+        raise HTTPException(
+            status_code=HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {INTROSPECT_MAX} tokens can be checked at once",
+        )
+    claims = [security.try_decode_token(token) for token in data.tokens]
+    claims = [
+        None if payload is None or await security.is_revoked(payload) else payload
+        for payload in claims
+    ]
+    users = await crud.get_cached_users_by_email(
+        payload["sub"] for payload in claims if payload and payload.get("sub")
+    )
+    results = []
+    for payload in claims:
+        user = users.get(payload.get("sub")) if payload else None
+        if user is None or user.disabled:
+            results.append({"active": False})
+        else:
+            results.append({"active": True, "claims": payload})
+    return responses.ORJSONResponse(results)
+
+
+@auth_router.post("/revoke", responses={403: {"description": "Admins only"}})
+async def revoke(
+    data: models.RevokeRequest = Body(...),
+    _admin: models.User = Depends(security.get_current_admin_user),
+):
+    """Revoke access tokens before they expire, e.g. ones that have leaked.
+    Invalid and expired tokens are skipped."""
+    revoked = 0
+    for token in data.tokens:
+        payload = security.try_decode_token(token)
+        if payload is not None and payload.get("jti"):
+            await security.revoke_token(payload)
+            revoked += 1
+    return {"revoked": revoked}
 
 
 @auth_router.get("/sign-out")
 async def sign_out(
-    _current_user: models.User = Depends(security.get_current_active_user)
+    request: Request,
+    token: str = Depends(oauth2_scheme),
+    _current_user: models.User = Depends(security.get_current_active_user),
 ):
-    response = UJSONResponse({"status": "signed out"})
+    # The user dependency has already checked the token.
+    await security.revoke_token(security.decode_token(token))
+    refresh_token = request.cookies.get(REFRESH_COOKIE)
+    if refresh_token:
+        await resources.refresh_tokens.revoke(refresh_token)
+    response = responses.EncodedJSONResponse(SIGNED_OUT)
     response.set_cookie(oauth2_scheme.token_name, "", httponly=True)
+    response.set_cookie(REFRESH_COOKIE, "", path=REFRESH_COOKIE_PATH, httponly=True)
     return response
 
 
@@ -132,4 +290,4 @@ async def read_users_me(
     current_user: models.User = Depends(security.get_current_active_user)
 ):
     """Get User data"""
-    return current_user
+    return responses.model_response(current_user, models.User)
@@ -1,20 +1,26 @@
 import datetime
+import hashlib
+import hmac
 import logging
 import os
 import secrets
 import string
-from typing import Union
+import time
+from typing import Optional, Union
 
 import jwt
-import redis
 from fastapi import HTTPException, Security, Depends
 from fastapi.openapi.models import OAuthFlows
-from fastapi.security import OAuth2
-from passlib.context import CryptContext
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer, OAuth2
 from starlette.requests import Request
-from starlette.status import HTTP_401_UNAUTHORIZED
+from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
 
-from app.auth import models, crud
+from app.auth import models, crud, hashing, keys, store
+from app.auth.cache import TTLCache
+from app.resources import resources
+
+# Imported so the resources.revoked_tokens it registers exists.
+from app.auth import revocation  # noqa: F401
 
 logger = logging.getLogger()
 
@@ -59,71 +65,122 @@ def get_secret_key():
     return secret
 
 
-SECRET_KEY = get_secret_key()
-ALGORITHM = "HS256"
-OTPS = redis.Redis(host=os.getenv("REDIS_HOST"), port=os.getenv("REDIS_PORT"), db=0)
-URL_SECRETS = redis.Redis(
-    host=os.getenv("REDIS_HOST"), port=os.getenv("REDIS_PORT"), db=1
+resources.register("signing_keys", lambda: keys.load_keys(secret_key=get_secret_key()))
+resources.register(
+    "otps",
+    lambda: store.SecretStore("otp", store.create_client(db=0)),
+    close=store.SecretStore.close,
+)
+resources.register(
+    "url_secrets",
+    lambda: store.SecretStore("url_secret", store.create_client(db=1)),
+    close=store.SecretStore.close,
 )
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+TOKEN_CACHE_ENABLED = bool(os.getenv("TOKEN_CACHE_ENABLED", False))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+ADMIN_EMAILS = set(filter(None, os.getenv("ADMIN_EMAILS", "").split(",")))
+# Shared secret gateways send as a bearer token to introspect tokens.
+# Introspection is disabled while it is unset.
+INTROSPECT_SECRET = os.getenv("INTROSPECT_SECRET")
+# Claims of tokens this process has already verified, by token digest.
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE)
+
 oauth2_scheme = Passwordless(tokenUrl="/auth/confirm", authorizationUrl="/auth/request")
+introspection_scheme = HTTPBearer(scheme_name="Introspection", auto_error=False)
+
+
+SECRET_LIFETIME = datetime.timedelta(minutes=5)
+
 
+def secret_record(
+    secret_hash: str, user_id: Optional[str], user: Optional[models.UserInDB]
+) -> str:
+    if user_id is None or user is None:
+        return secret_hash
+    return models.SecretRecord(
+        secret_hash=secret_hash,
+        user_id=user_id,
+        email=user.email,
+        disabled=user.disabled,
+    ).json()
 
-def generate_otp(email: str) -> str:
+
+def parse_secret_record(value: bytes) -> models.SecretRecord:
+    if value.startswith(b"{"):
+        return models.SecretRecord.parse_raw(value)
+    # Only the hash was stored before secrets were bound to their user.
+    return models.SecretRecord(secret_hash=value.decode("utf-8"))
+
+
+async def generate_otp(
+    email: str, user_id: str = None, user: models.UserInDB = None
+) -> str:
+    """Issue a one time password. When the user is given it is stored with the
+    code so confirming it doesn't need to look them up again."""
     alphabet = string.ascii_letters + string.digits
     code = "".join(secrets.choice(alphabet) for _ in range(8))
-    code_hash = pwd_context.hash(code)
-    OTPS.set(f"otp:{email}", code_hash)
-    OTPS.expire(f"otp:{email}", datetime.timedelta(minutes=5))
+    code_hash = await hashing.hash_secret(code)
+    await resources.otps.set(
+        email, secret_record(code_hash, user_id, user), SECRET_LIFETIME
+    )
     return code
 
 
-def generate_magic_link(email: str) -> str:
+async def generate_magic_link(
+    email: str, user_id: str = None, user: models.UserInDB = None
+) -> str:
     url_secret = secrets.token_urlsafe()
-    secret_hash = pwd_context.hash(url_secret)
-    URL_SECRETS.set(f"url_secret:{email}", secret_hash)
-    URL_SECRETS.expire(f"url_secret:{email}", datetime.timedelta(minutes=5))
+    secret_hash = await hashing.hash_secret(url_secret)
+    await resources.url_secrets.set(
+        email, secret_record(secret_hash, user_id, user), SECRET_LIFETIME
+    )
     host = os.getenv("HOSTNAME", "localhost")
     return f"{host}?secret={url_secret}"
 
 
-def verify_magic_link(email: str, secret: str):
-    secret_hash = URL_SECRETS.get(f"url_secret:{email}")
-    if not secret_hash:
-        return False
-    success = pwd_context.verify(secret, secret_hash)
-    if success:
-        URL_SECRETS.expire(f"url_secret:{email}", datetime.timedelta(seconds=1))
-    return success
+async def consume_secret(
+    secret_store: store.SecretStore, email: str, secret: str
+) -> Optional[models.SecretRecord]:
+    """Check a one time secret, consuming it so it can't be replayed"""
+    consumed = await secret_store.consume(email)
+    if consumed is None:
+        return None
+    record = parse_secret_record(consumed.value)
+    if await hashing.verify_secret(secret, record.secret_hash):
+        return record
+    await secret_store.reject(email, consumed)
+    return None
 
 
-def verify_otp(email: str, code: str) -> bool:
-    code_hash = OTPS.get(f"otp:{email}")
-    if not code_hash:
+async def verify_magic_link(email: str, secret: str) -> bool:
+    return await consume_secret(resources.url_secrets, email, secret) is not None
+
+
+async def verify_otp(email: str, code: str) -> bool:
+    return await consume_secret(resources.otps, email, code) is not None
+
+
+async def record_user(
+    email: str, record: Optional[models.SecretRecord]
+) -> Union[models.UserInDB, bool]:
+    if record is None:
         return False
-    success = pwd_context.verify(code, code_hash)
-    if success:
-        OTPS.expire(f"otp:{email}", datetime.timedelta(seconds=1))
-    return success
+    if record.user_id is None:
+        return await crud.get_user_by_email(email) or False
+    return models.UserInDB(email=record.email, disabled=record.disabled)
 
 
 async def authenticate_user(email: str, code: str) -> Union[models.UserInDB, bool]:
-    user = await crud.get_user_by_email(email)
-    if not user:
-        return False
-    if not verify_otp(email, code):
-        return False
-    return user
+    return await record_user(email, await consume_secret(resources.otps, email, code))
 
 
-async def authenticate_user_magic(email: str, secret: str):
-    user = await crud.get_user_by_email(email)
-    if not user:
-        return False
-    if not verify_magic_link(email, secret):
-        return False
-    return user
+async def authenticate_user_magic(
+    email: str, secret: str
+) -> Union[models.UserInDB, bool]:
+    return await record_user(
+        email, await consume_secret(resources.url_secrets, email, secret)
+    )
 
 
 def create_access_token(*, data: dict, expires_delta: datetime.timedelta = None):
@@ -133,16 +190,57 @@ def create_access_token(*, data: dict, expires_delta: datetime.timedelta = None)
     else:
         expire = datetime.datetime.utcnow() + datetime.timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM).decode("utf-8")
-    return encoded_jwt
+    # Lets the token be revoked before it expires.
+    to_encode.setdefault("jti", secrets.token_urlsafe(12))
+    return resources.signing_keys.encode(to_encode)
+
+
+def decode_token(token: str) -> dict:
+    """Verify a token and return its claims.
+
+    With the token cache enabled, claims are kept until the token expires so
+    repeat requests with the same cookie skip signature verification.
+    """
+    if not TOKEN_CACHE_ENABLED:
+        return resources.signing_keys.decode(token)
+    key = hashlib.sha256(token.encode("utf-8")).digest()
+    payload = token_cache.get(key)
+    if payload is None:
+        payload = resources.signing_keys.decode(token)
+        if "exp" in payload:
+            expires_at = token_cache.timer() + payload["exp"] - time.time()
+            token_cache.set(key, payload, expires_at=expires_at)
+    return payload
+
+
+def try_decode_token(token: str) -> Optional[dict]:
+    """Claims of a valid token, None for an invalid or expired one"""
+    try:
+        return decode_token(token)
+    except jwt.PyJWTError:
+        return None
+
+
+async def is_revoked(payload: dict) -> bool:
+    """Whether a token has been revoked. Checked after the token cache too,
+    since cached claims outlive a revocation."""
+    jti = payload.get("jti")
+    return jti is not None and await resources.revoked_tokens.is_revoked(jti)
+
+
+async def revoke_token(payload: dict):
+    """Revoke a token until it expires. Tokens issued without an id can't be."""
+    jti = payload.get("jti")
+    if jti is not None and "exp" in payload:
+        await resources.revoked_tokens.revoke(jti, payload["exp"])
 
 
 async def get_current_user(token: str = Security(oauth2_scheme)) -> models.UserInDB:
     credentials_exception = HTTPException(
-        status_code=HTTP_401_UNAUTHORIZED, detail=f"Could not validate credentials"
+        status_code=HTTP_401_UNAUTHORIZED, detail="Could not validate credentials"
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_token(token)
         logger.debug(payload)
         email: str = payload.get("sub")
         if email is None:
@@ -150,7 +248,9 @@ async def get_current_user(token: str = Security(oauth2_scheme)) -> models.UserI
     except jwt.PyJWTError as err:
         logger.debug(err)
         raise credentials_exception
-    user = await crud.get_user_by_email(email)
+    if await is_revoked(payload):
+        raise credentials_exception
+    user = await crud.get_cached_user_by_email(email)
     if not user:
         raise credentials_exception
     return user
@@ -162,3 +262,29 @@ async def get_current_active_user(
     if current_user.disabled:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
+
+
+async def get_current_admin_user(
+    current_user: models.User = Depends(get_current_active_user)
+) -> models.User:
+    if current_user.email not in ADMIN_EMAILS:
+        raise HTTPException(status_code=HTTP_403_FORBIDDEN, detail="Admins only")
+    return current_user
+
+
+async def verify_introspection_client(
+    credentials: Optional[HTTPAuthorizationCredentials] = Security(introspection_scheme)
+):
+    """Only let gateways holding INTROSPECT_SECRET introspect tokens"""
+    if not INTROSPECT_SECRET:
+        raise HTTPException(
+            status_code=HTTP_403_FORBIDDEN, detail="Introspection is disabled"
+        )
+    if credentials is None or not hmac.compare_digest(
+        credentials.credentials.encode("utf-8"), INTROSPECT_SECRET.encode("utf-8")
+    ):
+        raise HTTPException(
+            status_code=HTTP_401_UNAUTHORIZED,
+            detail="Invalid introspection credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
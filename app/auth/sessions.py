@@ -0,0 +1,137 @@
+import datetime
+import hashlib
+import logging
+import os
+import secrets
+from typing import NamedTuple, Optional
+
+from redis import asyncio as aioredis
+
+from app import metrics
+from app.auth import store
+from app.resources import resources
+
+logger = logging.getLogger()
+
+REFRESH_REDIS_DB = int(os.getenv("REFRESH_REDIS_DB", 3))
+REFRESH_TOKEN_EXPIRE_DAYS = float(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 30))
+
+# Starts a session. A script rather than MULTI so it also runs on a cluster.
+ISSUE = """
+redis.call("HSET", KEYS[1], "current", ARGV[1], "email", ARGV[2])
+redis.call("PEXPIRE", KEYS[1], ARGV[3])
+"""
+
+# Swaps the session's current token digest for a new one if the presented
+# token is the current one. Any other token of the session is an old one
+# being replayed, so the whole session is revoked.
+ROTATE = """
+local current = redis.call("HGET", KEYS[1], "current")
+if not current then
+    return false
+end
+if current ~= ARGV[1] then
+    redis.call("DEL", KEYS[1])
+    return {0}
+end
+redis.call("HSET", KEYS[1], "current", ARGV[2])
+redis.call("PEXPIRE", KEYS[1], ARGV[3])
+return {1, redis.call("HGET", KEYS[1], "email")}
+"""
+
+
+def _digest(secret: str) -> str:
+    # Refresh tokens are long and random, so a plain digest is enough.
+    return hashlib.sha256(secret.encode("utf-8")).hexdigest()
+
+
+class ParsedToken(NamedTuple):
+    session: str
+    secret: str
+
+
+def parse_token(token: str) -> Optional[ParsedToken]:
+    session, _, secret = token.partition(".")
+    if not session or not secret:
+        return None
+    return ParsedToken(session, secret)
+
+
+class Rotated(NamedTuple):
+    email: str
+    token: str
+
+
+class RefreshTokens:
+    """Rotating refresh tokens, one redis hash per sign in session.
+
+    A token is ``{session}.{secret}`` and can be used once; each use returns
+    the session's next token. Presenting a token that has already been used
+    revokes the session, so a stolen token stops working for both the thief
+    and the user as soon as either uses it after the other.
+    """
+
+    def __init__(
+        self,
+        client: aioredis.Redis,
+        lifetime: datetime.timedelta = datetime.timedelta(
+            days=REFRESH_TOKEN_EXPIRE_DAYS
+        ),
+    ):
+        self.client = client
+        self.lifetime = lifetime
+        self._issue = client.register_script(ISSUE)
+        self._rotate = client.register_script(ROTATE)
+
+    @staticmethod
+    def key(session: str) -> str:
+        return f"refresh:{session}"
+
+    @property
+    def lifetime_ms(self) -> int:
+        return int(self.lifetime.total_seconds() * 1000)
+
+    @metrics.timed("redis", "refresh_issue")
+    async def issue(self, email: str) -> str:
+        """Start a session, returning its first token"""
+        session = secrets.token_urlsafe(16)
+        secret = secrets.token_urlsafe(32)
+        await self._issue(
+            keys=[self.key(session)], args=[_digest(secret), email, self.lifetime_ms]
+        )
+        return f"{session}.{secret}"
+
+    @metrics.timed("redis", "refresh_rotate")
+    async def rotate(self, token: str) -> Optional[Rotated]:
+        """Use a token, returning the session's email and next token. Returns
+        None if the token is invalid, expired or has been used before."""
+        parsed = parse_token(token)
+        if parsed is None:
+            return None
+        secret = secrets.token_urlsafe(32)
+        result = await self._rotate(
+            keys=[self.key(parsed.session)],
+            args=[_digest(parsed.secret), _digest(secret), self.lifetime_ms],
+        )
+        if not result:
+            return None
+        if not result[0]:
+            logger.warning("Refresh token reused, revoked session %s", parsed.session)
+            return None
+        return Rotated(result[1].decode("utf-8"), f"{parsed.session}.{secret}")
+
+    @metrics.timed("redis", "refresh_revoke")
+    async def revoke(self, token: str):
+        parsed = parse_token(token)
+        if parsed is not None:
+            await self.client.delete(self.key(parsed.session))
+
+    async def close(self):
+        await store.close_client(self.client)
+
+
+resources.register(
+    "refresh_tokens",
+    lambda: RefreshTokens(store.create_client(db=REFRESH_REDIS_DB)),
+    close=RefreshTokens.close,
+)
@@ -0,0 +1,190 @@
+import datetime
+import os
+from typing import List, NamedTuple, Optional, Tuple, Union
+
+from redis import asyncio as aioredis
+from redis.asyncio.cluster import RedisCluster
+from redis.asyncio.sentinel import Sentinel
+
+from app import metrics
+
+REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+# standalone, cluster or sentinel
+REDIS_MODE = os.getenv("REDIS_MODE", "standalone")
+REDIS_SENTINELS = os.getenv("REDIS_SENTINELS", "localhost:26379")
+REDIS_SENTINEL_MASTER = os.getenv("REDIS_SENTINEL_MASTER", "mymaster")
+REDIS_POOL_SIZE = int(os.getenv("REDIS_POOL_SIZE", 50))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+SECRET_MAX_ATTEMPTS = int(os.getenv("SECRET_MAX_ATTEMPTS", 5))
+
+Expiry = Union[int, datetime.timedelta]
+
+# Stores a new secret and clears failed attempts made against the previous
+# one. A script rather than MULTI, which redis cluster does not support.
+SET = """
+redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+redis.call("DEL", KEYS[2])
+"""
+
+# Takes a secret so it can only be used once. Nothing is returned once the
+# failed attempt limit is reached, so guesses stop before any hash is checked.
+CONSUME = """
+local attempts = tonumber(redis.call("GET", KEYS[2]) or "0")
+if attempts >= tonumber(ARGV[1]) then
+    return false
+end
+local value = redis.call("GET", KEYS[1])
+if not value then
+    return false
+end
+local ttl = redis.call("PTTL", KEYS[1])
+redis.call("DEL", KEYS[1])
+return {value, ttl}
+"""
+
+# Counts a failed attempt and puts the secret back for another try, unless
+# the limit is reached or a new secret has been issued in the meantime.
+REJECT = """
+local attempts = redis.call("INCR", KEYS[2])
+redis.call("PEXPIRE", KEYS[2], ARGV[2])
+if attempts < tonumber(ARGV[3]) then
+    redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2], "NX")
+end
+return attempts
+"""
+
+
+def parse_sentinels(value: str) -> List[Tuple[str, int]]:
+    """Parse ``host:port,host:port`` into sentinel addresses"""
+    sentinels = []
+    for address in value.split(","):
+        host, _, port = address.strip().rpartition(":")
+        sentinels.append((host, int(port)))
+    return sentinels
+
+
+def create_client(db: int = 0, mode: str = None) -> aioredis.Redis:
+    """Redis client on a bounded pool. Callers wait for a free connection
+    instead of opening new ones once the pool is exhausted.
+
+    In cluster mode REDIS_HOST is any node of the cluster and db is ignored,
+    since a cluster only has db 0; stores keep apart by key prefix instead.
+    In sentinel mode the master is looked up from REDIS_SENTINELS and again
+    whenever a connection to it fails, so clients follow a failover.
+    """
+    mode = mode or REDIS_MODE
+    if mode == "cluster":
+        return RedisCluster(
+            host=REDIS_HOST, port=REDIS_PORT, max_connections=REDIS_POOL_SIZE
+        )
+    if mode == "sentinel":
+        sentinel = Sentinel(parse_sentinels(REDIS_SENTINELS))
+        return sentinel.master_for(
+            REDIS_SENTINEL_MASTER, db=db, max_connections=REDIS_POOL_SIZE
+        )
+    if mode != "standalone":
+        raise ValueError(f"Unknown redis mode: {mode}")
+    pool = aioredis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        port=REDIS_PORT,
+        db=db,
+        max_connections=REDIS_POOL_SIZE,
+        timeout=REDIS_POOL_TIMEOUT,
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+def create_pubsub_client(mode: str = None) -> aioredis.Redis:
+    """Client to publish and subscribe with. A cluster forwards messages
+    published on any node to every node, so in cluster mode this connects to
+    the REDIS_HOST node alone."""
+    mode = mode or REDIS_MODE
+    if mode == "cluster":
+        return aioredis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+    return create_client(mode=mode)
+
+
+async def close_client(client: aioredis.Redis):
+    await client.close()
+    pool = getattr(client, "connection_pool", None)
+    if pool is not None:
+        await pool.disconnect()
+
+
+class Consumed(NamedTuple):
+    value: bytes
+    ttl_ms: int
+
+
+class SecretStore:
+    """Short lived, single use secrets stored in redis, e.g. under
+    ``otp:{test@example.com}``
+
+    Failed attempts for each secret are counted under
+    ``otp_attempts:{test@example.com}``. The braces are a cluster hash tag,
+    which keeps a secret and its attempts in the same slot so the scripts
+    that touch both can run on one node.
+    """
+
+    def __init__(
+        self,
+        prefix: str,
+        client: aioredis.Redis,
+        max_attempts: int = SECRET_MAX_ATTEMPTS,
+    ):
+        self.prefix = prefix
+        self.client = client
+        self.max_attempts = max_attempts
+        self._set = client.register_script(SET)
+        self._consume = client.register_script(CONSUME)
+        self._reject = client.register_script(REJECT)
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}:{{{name}}}"
+
+    def attempts_key(self, name: str) -> str:
+        return f"{self.prefix}_attempts:{{{name}}}"
+
+    @metrics.timed("redis", "set")
+    async def set(self, name: str, value: Union[str, bytes], ttl: Expiry):
+        """Store a new secret with its expiry and clear failed attempts made
+        against the previous one, in a single round trip"""
+        if isinstance(ttl, datetime.timedelta):
+            ttl = ttl.total_seconds()
+        await self._set(
+            keys=[self.key(name), self.attempts_key(name)],
+            args=[value, int(ttl * 1000)],
+        )
+
+    @metrics.timed("redis", "get")
+    async def get(self, name: str) -> Optional[bytes]:
+        return await self.client.get(self.key(name))
+
+    @metrics.timed("redis", "consume")
+    async def consume(self, name: str) -> Optional[Consumed]:
+        """Atomically take a secret. Returns None if there is none, or if too
+        many failed attempts have been made against it."""
+        result = await self._consume(
+            keys=[self.key(name), self.attempts_key(name)], args=[self.max_attempts]
+        )
+        if not result:
+            return None
+        value, ttl_ms = result
+        return Consumed(value, int(ttl_ms))
+
+    @metrics.timed("redis", "reject")
+    async def reject(self, name: str, consumed: Consumed) -> int:
+        """Record a failed attempt against a consumed secret, restoring it for
+        another try while attempts remain. Returns the attempt count."""
+        return await self._reject(
+            keys=[self.key(name), self.attempts_key(name)],
+            args=[consumed.value, max(consumed.ttl_ms, 1), self.max_attempts],
+        )
+
+    @metrics.timed("redis", "delete")
+    async def delete(self, name: str):
+        await self.client.delete(self.key(name), self.attempts_key(name))
+
+    async def close(self):
+        await close_client(self.client)
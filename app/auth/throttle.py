@@ -0,0 +1,190 @@
+import asyncio
+import ipaddress
+import math
+import os
+import secrets
+import time
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from fastapi import HTTPException
+from redis import asyncio as aioredis
+from starlette.requests import Request
+from starlette.status import HTTP_429_TOO_MANY_REQUESTS
+
+from app import metrics
+from app.auth import store
+from app.resources import resources
+
+RATE_LIMIT_REDIS_DB = int(os.getenv("RATE_LIMIT_REDIS_DB", 2))
+# Limits are "<requests>/<seconds>", applied per email and per client address.
+RATE_LIMIT_REQUEST = os.getenv("RATE_LIMIT_REQUEST", "5/300")
+RATE_LIMIT_REQUEST_MAGIC = os.getenv("RATE_LIMIT_REQUEST_MAGIC", "5/300")
+RATE_LIMIT_CONFIRM = os.getenv("RATE_LIMIT_CONFIRM", "10/300")
+ISSUE_WINDOW = float(os.getenv("ISSUE_WINDOW", 30))
+# Comma separated addresses or networks of the load balancers in front of the
+# app, or * for any. Requests through them are limited by the address they
+# add to X-Forwarded-For rather than their own.
+TRUSTED_PROXIES = os.getenv("TRUSTED_PROXIES", "")
+
+# Drops hits older than the window, then records this hit unless the limit
+# has been reached. Returns how many milliseconds until the next hit would be
+# allowed, 0 if this one was.
+SLIDING_WINDOW = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - window)
+if redis.call("ZCARD", KEYS[1]) >= limit then
+    local oldest = redis.call("ZRANGE", KEYS[1], 0, 0, "WITHSCORES")
+    return math.max(tonumber(oldest[2]) + window - now, 1)
+end
+redis.call("ZADD", KEYS[1], now, ARGV[4])
+redis.call("PEXPIRE", KEYS[1], window)
+return 0
+"""
+
+
+def parse_limit(limit: str) -> Tuple[int, float]:
+    requests, seconds = limit.split("/")
+    return int(requests), float(seconds)
+
+
+class SlidingWindowLimiter:
+    """Allows ``limit`` hits per key in any ``window`` seconds.
+
+    Each check is a single atomic script call, so limits hold across workers.
+    """
+
+    def __init__(self, client: aioredis.Redis, name: str, limit: int, window: float):
+        self.name = name
+        self.limit = limit
+        self.window_ms = int(window * 1000)
+        self._script = client.register_script(SLIDING_WINDOW)
+
+    @metrics.timed("redis", "rate_limit")
+    async def hit(self, key: str) -> float:
+        """Record a hit. Returns 0 if it is allowed, otherwise the number of
+        seconds until it would be."""
+        now_ms = int(time.time() * 1000)
+        retry_after_ms = await self._script(
+            keys=[f"ratelimit:{self.name}:{key}"],
+            args=[
+                now_ms,
+                self.window_ms,
+                self.limit,
+                f"{now_ms}:{secrets.token_hex(4)}",
+            ],
+        )
+        return int(retry_after_ms) / 1000
+
+
+def parse_proxies(proxies: str) -> List[str]:
+    return [proxy.strip() for proxy in proxies.split(",") if proxy.strip()]
+
+
+def is_trusted(address: str, proxies: List[str]) -> bool:
+    if "*" in proxies:
+        return True
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in ipaddress.ip_network(proxy, strict=False) for proxy in proxies)
+
+
+def client_address(request: Request, proxies: str = None) -> Optional[str]:
+    """The address a request came from, following X-Forwarded-For back
+    through trusted proxies"""
+    if request.client is None:
+        return None
+    proxies = parse_proxies(TRUSTED_PROXIES if proxies is None else proxies)
+    address = request.client.host
+    forwarded = ",".join(request.headers.getlist("x-forwarded-for")).split(",")
+    # Each proxy appends the address it received the request from.
+    for hop in reversed([hop.strip() for hop in forwarded if hop.strip()]):
+        if not is_trusted(address, proxies):
+            break
+        address = hop
+    return address
+
+
+class SingleFlight:
+    """Runs concurrent calls with the same key once, sharing the result"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable]):
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(future)
+
+
+def build_limiters(client: aioredis.Redis) -> Dict[str, SlidingWindowLimiter]:
+    return {
+        name: SlidingWindowLimiter(client, name, *parse_limit(limit))
+        for name, limit in (
+            ("request", RATE_LIMIT_REQUEST),
+            ("request-magic", RATE_LIMIT_REQUEST_MAGIC),
+            ("confirm", RATE_LIMIT_CONFIRM),
+        )
+    }
+
+
+resources.register(
+    "throttle_client",
+    lambda: store.create_client(db=RATE_LIMIT_REDIS_DB),
+    close=store.close_client,
+)
+resources.register("limiters", lambda: build_limiters(resources.throttle_client))
+issuing = SingleFlight()
+
+
+async def enforce(name: str, *keys: Optional[str]):
+    """Count a hit against each key, rejecting it with 429 if any is over limit"""
+    limiter = resources.limiters[name]
+    for key in keys:
+        if key is None:
+            continue
+        retry_after = await limiter.hit(key)
+        if retry_after:
+            raise HTTPException(
+                status_code=HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests, try again later.",
+                headers={"Retry-After": str(math.ceil(retry_after))},
+            )
+
+
+async def issue_once(flow: str, email: str, issue: Callable[[], Awaitable]) -> bool:
+    """Issue a one time secret unless one was issued for this email and flow
+    within the last ``ISSUE_WINDOW`` seconds.
+
+    Concurrent calls in this process share one issuance, and a redis claim
+    extends that to other workers and to the rest of the window. Returns
+    whether a new secret was issued.
+    """
+
+    @metrics.timed("redis", "issue_claim")
+    async def claim(key: str) -> bool:
+        return await resources.throttle_client.set(
+            key, 1, px=int(ISSUE_WINDOW * 1000), nx=True
+        )
+
+    async def claim_and_issue() -> bool:
+        key = f"issued:{flow}:{email}"
+        if ISSUE_WINDOW <= 0:
+            await issue()
+            return True
+        if not await claim(key):
+            return False
+        try:
+            await issue()
+        except BaseException:
+            await resources.throttle_client.delete(key)
+            raise
+        return True
+
+    return await issuing.do((flow, email), claim_and_issue)
@@ -0,0 +1,217 @@
+"""Stream users into and out of the users collection.
+
+    python -m app.cli import users.ndjson
+    python -m app.cli import users.csv --upsert --rejects rejected.ndjson
+    python -m app.cli export --format csv > users.csv
+
+Records are validated against the User model and written in chunks, so
+memory use is bounded by the chunk size no matter how large the file is.
+"""
+import argparse
+import asyncio
+import csv
+import json
+import sys
+import time
+from typing import IO, Iterable, Iterator, List, NamedTuple, Union
+
+from pydantic import ValidationError
+
+from app.auth import crud, models
+
+FIELDS = list(models.User.__fields__)
+
+
+class MalformedRecord(NamedTuple):
+    line: str
+    error: str
+
+
+def read_records(stream: IO, fmt: str) -> Iterator[Union[dict, MalformedRecord]]:
+    """Records in the stream. Lines that are not JSON are given as
+    MalformedRecord so they can be rejected without ending the import."""
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            # Empty CSV cells mean the field was not given.
+            yield {key: value for key, value in row.items() if value != ""}
+    else:
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as err:
+                    yield MalformedRecord(line.rstrip("\n"), str(err))
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def detect_format(path: str, fmt: str = None) -> str:
+    if fmt:
+        return fmt
+    return "csv" if path.endswith(".csv") else "ndjson"
+
+
+class Progress:
+    def __init__(self, action: str, stream: IO = sys.stderr):
+        self.action = action
+        self.stream = stream
+        self.start = time.perf_counter()
+        self.counts = {}
+
+    def add(self, **counts: int):
+        for name, count in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + count
+
+    def report(self, final: bool = False):
+        total = sum(self.counts.values())
+        elapsed = time.perf_counter() - self.start
+        details = ", ".join(f"{count} {name}" for name, count in self.counts.items())
+        self.stream.write(
+            f"\r{self.action} {total} records ({details}) "
+            f"{total / elapsed if elapsed else 0:.0f} records/s"
+        )
+        if final:
+            self.stream.write("\n")
+        self.stream.flush()
+
+
+async def write_chunk(users: List[models.UserInDB], upsert: bool) -> dict:
+    if upsert:
+        created = await crud.upsert_users(users)
+        return {"created": created, "updated": len(users) - created}
+    duplicates = await crud.create_users(users)
+    return {"created": len(users) - len(duplicates), "duplicate": len(duplicates)}
+
+
+async def import_users(
+    stream: IO,
+    fmt: str,
+    chunk_size: int = 1000,
+    upsert: bool = False,
+    rejects: IO = None,
+    progress: Progress = None,
+) -> dict:
+    """Validate and write records, reading the next chunk while the previous
+    one is being written."""
+    progress = progress or Progress("imported")
+    pending = None
+    try:
+        for chunk in chunked(read_records(stream, fmt), chunk_size):
+            users = []
+            invalid = 0
+            for record in chunk:
+                if isinstance(record, MalformedRecord):
+                    errors = [
+                        {"loc": [], "msg": record.error, "type": "value_error.json"}
+                    ]
+                    record = record.line
+                else:
+                    try:
+                        users.append(
+                            models.UserInDB.parse_obj(models.User.parse_obj(record))
+                        )
+                        continue
+                    except ValidationError as err:
+                        errors = err.errors()
+                invalid += 1
+                if rejects is not None:
+                    rejects.write(
+                        json.dumps({"record": record, "errors": errors}) + "\n"
+                    )
+            if pending is not None:
+                progress.add(**await pending)
+                progress.report()
+            progress.add(invalid=invalid)
+            pending = asyncio.ensure_future(write_chunk(users, upsert))
+        if pending is not None:
+            progress.add(**await pending)
+    finally:
+        # Let a chunk already being written finish if reading failed.
+        if pending is not None and not pending.done():
+            await asyncio.wait([pending])
+    progress.report(final=True)
+    return progress.counts
+
+
+async def export_users(
+    stream: IO, fmt: str, batch_size: int = 1000, progress: Progress = None
+) -> int:
+    progress = progress or Progress("exported")
+    if fmt == "csv":
+        writer = csv.DictWriter(stream, FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        write = writer.writerow
+    else:
+
+        def write(record: dict):
+            stream.write(json.dumps(record) + "\n")
+
+    exported = 0
+    async for record in crud.find_users(batch_size=batch_size):
+        write(record)
+        exported += 1
+        if exported % batch_size == 0:
+            progress.add(users=batch_size)
+            progress.report()
+    progress.add(users=exported % batch_size)
+    progress.report(final=True)
+    return exported
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    import_parser = commands.add_parser("import", help="Import users from a file")
+    import_parser.add_argument("path", help="NDJSON or CSV file, - for stdin")
+    import_parser.add_argument("--format", choices=["ndjson", "csv"])
+    import_parser.add_argument("--chunk-size", type=int, default=1000)
+    import_parser.add_argument(
+        "--upsert", action="store_true", help="Update users that already exist"
+    )
+    import_parser.add_argument(
+        "--rejects", help="Write invalid records and their errors to this file"
+    )
+
+    export_parser = commands.add_parser("export", help="Export users to a file")
+    export_parser.add_argument("path", nargs="?", default="-", help="- for stdout")
+    export_parser.add_argument("--format", choices=["ndjson", "csv"])
+    export_parser.add_argument("--batch-size", type=int, default=1000)
+
+    args = parser.parse_args(argv)
+    fmt = detect_format(args.path, args.format)
+    loop = asyncio.get_event_loop()
+
+    if args.command == "import":
+        stream = sys.stdin if args.path == "-" else open(args.path, newline="")
+        rejects = open(args.rejects, "w") if args.rejects else None
+        try:
+            loop.run_until_complete(
+                import_users(stream, fmt, args.chunk_size, args.upsert, rejects)
+            )
+        finally:
+            stream.close()
+            if rejects is not None:
+                rejects.close()
+    else:
+        stream = sys.stdout if args.path == "-" else open(args.path, "w", newline="")
+        try:
+            loop.run_until_complete(export_users(stream, fmt, args.batch_size))
+        finally:
+            stream.close()
+
+
+if __name__ == "__main__":
+    main()
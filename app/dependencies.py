@@ -1,21 +1,103 @@
+import logging
 import os
 from urllib.parse import quote_plus
 
 from motor import motor_asyncio
+from pymongo import monitoring
+
+from app import metrics
+
+logger = logging.getLogger()
+
+
+def _optional_int(name: str):
+    value = os.getenv(name)
+    return int(value) if value else None
+
 
 DB_NAME = os.getenv("DB_NAME", "app")
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+MONGO_MAX_IDLE_TIME_MS = _optional_int("MONGO_MAX_IDLE_TIME_MS")
+MONGO_WAIT_QUEUE_TIMEOUT_MS = _optional_int("MONGO_WAIT_QUEUE_TIMEOUT_MS")
+MONGO_CONNECT_TIMEOUT_MS = _optional_int("MONGO_CONNECT_TIMEOUT_MS")
+MONGO_SOCKET_TIMEOUT_MS = _optional_int("MONGO_SOCKET_TIMEOUT_MS")
+MONGO_SERVER_SELECTION_TIMEOUT_MS = _optional_int("MONGO_SERVER_SELECTION_TIMEOUT_MS")
+# Comma separated, in order of preference, e.g. zstd,snappy,zlib. zlib needs
+# no extra packages.
+MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS") or None
+# Reads that can be a little stale go to secondaries when there are any, and
+# to the primary otherwise, e.g. on a single node. Unset, a MONGODB_URI's own
+# readPreference applies.
+MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE") or None
+MONGO_MAX_STALENESS_SECONDS = _optional_int("MONGO_MAX_STALENESS_SECONDS")
+MONGO_LOG_QUERIES = bool(os.getenv("MONGO_LOG_QUERIES", False))
 db_uri = os.getenv("MONGODB_URI", False)
-db = None
+# A MONGODB_URI names its own database.
+db_name = None
 
-if db_uri:
-    db_client = motor_asyncio.AsyncIOMotorClient(db_uri)
-    db = db_client.get_database()
-else:
+if not db_uri:
     db_uri = "mongodb://{username}:{password}@{host}:{port}".format(
         username=quote_plus(os.getenv("DB_USERNAME", "root")),
         password=quote_plus(os.getenv("DB_PASSWORD", "root")),
         host=quote_plus(os.getenv("DB_HOST", "localhost")),
         port=quote_plus(os.getenv("DB_PORT", "27017")),
     )
-    db_client = motor_asyncio.AsyncIOMotorClient(db_uri)
-    db: motor_asyncio.AsyncIOMotorDatabase = db_client[DB_NAME]
+    db_name = DB_NAME
+    MONGO_READ_PREFERENCE = MONGO_READ_PREFERENCE or "secondaryPreferred"
+
+
+class QueryListener(monitoring.CommandListener):
+    """Count each command by the node that handled it, and log them when
+    MONGO_LOG_QUERIES is set, to see how reads are spread across the replica
+    set."""
+
+    def __init__(self, log_queries: bool = MONGO_LOG_QUERIES):
+        self.log_queries = log_queries
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self._record(event, "ok")
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self._record(event, "failed")
+
+    def _record(self, event, outcome: str):
+        host, port = event.connection_id
+        node = f"{host}:{port}"
+        metrics.MONGO_COMMANDS.labels(event.command_name, node, outcome).inc()
+        if self.log_queries:
+            logger.info(
+                "mongo %s on %s %s in %.2fms",
+                event.command_name,
+                node,
+                outcome,
+                event.duration_micros / 1000,
+            )
+
+
+def client_options() -> dict:
+    """Options for the mongo client. Unset ones are left to the driver's
+    defaults or the MONGODB_URI."""
+    options = {
+        "maxPoolSize": MONGO_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "maxIdleTimeMS": MONGO_MAX_IDLE_TIME_MS,
+        "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT_MS,
+        "connectTimeoutMS": MONGO_CONNECT_TIMEOUT_MS,
+        "socketTimeoutMS": MONGO_SOCKET_TIMEOUT_MS,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "compressors": MONGO_COMPRESSORS,
+        "readPreference": MONGO_READ_PREFERENCE,
+        "maxStalenessSeconds": MONGO_MAX_STALENESS_SECONDS,
+    }
+    return {name: value for name, value in options.items() if value is not None}
+
+
+def connect() -> motor_asyncio.AsyncIOMotorDatabase:
+    db_client = motor_asyncio.AsyncIOMotorClient(
+        db_uri, event_listeners=[QueryListener()], **client_options()
+    )
+    return db_client.get_database(db_name)
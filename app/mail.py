@@ -0,0 +1,177 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Dict, Optional
+
+import aiohttp
+
+from app import metrics
+from app.resources import resources
+
+logger = logging.getLogger()
+
+MAILGUN_KEY = os.getenv("MAILGUN_KEY")
+MAILGUN_ENDPOINT = os.getenv("MAILGUN_ENDPOINT")
+MAILGUN_FROM_NAME = os.getenv("MAILGUN_FROM_NAME")
+MAILGUN_FROM_ADDRESS = os.getenv("MAILGUN_FROM_ADDRESS")
+MAIL_POOL_SIZE = int(os.getenv("MAIL_POOL_SIZE", 20))
+MAIL_KEEPALIVE_TIMEOUT = float(os.getenv("MAIL_KEEPALIVE_TIMEOUT", 30))
+# Seconds to wait for Mailgun to accept a message.
+MAIL_TIMEOUT = float(os.getenv("MAIL_TIMEOUT", 30))
+MAIL_BATCH_WINDOW_MS = float(os.getenv("MAIL_BATCH_WINDOW_MS", 0))
+# Mailgun accepts at most 1000 recipients per batch message.
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", 1000))
+
+
+class MailError(Exception):
+    pass
+
+
+class _Batch:
+    def __init__(self, subject: str, future: asyncio.Future):
+        self.subject = subject
+        self.future = future
+        self.recipients: Dict[str, str] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MailClient:
+    """Sends email through Mailgun over a shared keep-alive connection pool.
+
+    With a batch window, emails with the same subject sent within the window
+    are merged into one Mailgun batch message. Each recipient's text is passed
+    through ``recipient-variables`` so recipients only ever see their own
+    message and address.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        key: str,
+        sender: str,
+        pool_size: int = MAIL_POOL_SIZE,
+        batch_window: float = MAIL_BATCH_WINDOW_MS / 1000,
+        batch_size: int = MAIL_BATCH_SIZE,
+        timeout: float = MAIL_TIMEOUT,
+    ):
+        self.endpoint = endpoint
+        self.key = key
+        self.sender = sender
+        self.pool_size = pool_size
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._batches: Dict[str, _Batch] = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size, keepalive_timeout=MAIL_KEEPALIVE_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                auth=aiohttp.BasicAuth("api", self.key or ""),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def start(self):
+        """Open the connection pool ahead of the first email"""
+        return self.session
+
+    async def close(self):
+        pending = [batch.future for batch in self._batches.values()]
+        for batch in list(self._batches.values()):
+            self._flush(batch)
+        if pending:
+            await asyncio.wait(pending)
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def send(self, to: str, subject: str, text: str):
+        if self.batch_window <= 0:
+            await self._post([("to", to), ("subject", subject), ("text", text)])
+            return
+        batch = self._batches.get(subject)
+        if batch is not None and to in batch.recipients:
+            # A recipient can only appear once per batch, send the earlier one.
+            self._flush(batch)
+            batch = None
+        if batch is None:
+            batch = self._open_batch(subject)
+        batch.recipients[to] = text
+        if len(batch.recipients) >= self.batch_size:
+            self._flush(batch)
+        await asyncio.shield(batch.future)
+
+    def _open_batch(self, subject: str) -> _Batch:
+        loop = asyncio.get_event_loop()
+        batch = _Batch(subject, loop.create_future())
+        batch.timer = loop.call_later(self.batch_window, self._flush, batch)
+        self._batches[subject] = batch
+        return batch
+
+    def _flush(self, batch: _Batch):
+        if self._batches.get(batch.subject) is batch:
+            del self._batches[batch.subject]
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        asyncio.ensure_future(self._send_batch(batch))
+
+    async def _send_batch(self, batch: _Batch):
+        if batch.future.done():
+            return
+        if len(batch.recipients) == 1:
+            [(to, text)] = batch.recipients.items()
+            data = [("to", to), ("subject", batch.subject), ("text", text)]
+        else:
+            data = [("to", to) for to in batch.recipients]
+            data += [
+                ("subject", batch.subject),
+                ("text", "%recipient.text%"),
+                (
+                    "recipient-variables",
+                    json.dumps(
+                        {to: {"text": text} for to, text in batch.recipients.items()}
+                    ),
+                ),
+            ]
+        try:
+            await self._post(data)
+        except Exception as err:
+            # Every sender in the batch waits on the future, so it is settled
+            # whatever went wrong.
+            batch.future.set_exception(err)
+            # Mark the exception retrieved in case every sender was cancelled.
+            batch.future.exception()
+        else:
+            batch.future.set_result(None)
+
+    @metrics.timed("mailgun", "send")
+    async def _post(self, data: list):
+        data = [("from", self.sender)] + data
+        try:
+            async with self.session.post(self.endpoint, data=data) as res:
+                if res.status != 200:
+                    logger.warning(f"Mailgun returned {res.status}")
+                    raise MailError(f"Mailgun returned {res.status}")
+        except aiohttp.ClientError as err:
+            raise MailError(str(err)) from err
+        except asyncio.TimeoutError as err:
+            raise MailError("Mailgun timed out") from err
+
+
+resources.register(
+    "mail",
+    lambda: MailClient(
+        MAILGUN_ENDPOINT, MAILGUN_KEY, f"{MAILGUN_FROM_NAME} <{MAILGUN_FROM_ADDRESS}>"
+    ),
+    # Not started with the other resources: web workers only queue emails,
+    # and the outbox workers that send them open the pool themselves.
+    close=MailClient.close,
+)
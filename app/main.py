@@ -1,15 +1,83 @@
+import asyncio
+import logging
+
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
+from app import admission, metrics, profiler
+from app.auth import crud, indexes, keys, security
 from app.auth.router import auth_router
-from app.dependencies import db
+from app.resources import resources
+
+logger = logging.getLogger()
 
 app = FastAPI(title="Passwordless", version="19.8.1")
+background_tasks = []
+
+# Routes whose cost is dominated by hashing one time secrets.
+HASH_ROUTES = [
+    "/auth/request",
+    "/auth/request-magic",
+    "/auth/confirm",
+    "/auth/confirm-magic",
+]
+
+
+@app.on_event("startup")
+async def start_resources():
+    await resources.start()
 
 
 @app.on_event("startup")
 async def setup_db():
-    await db.users.create_index("username", unique=True)
+    await indexes.ensure_indexes(resources.db)
+
+
+@app.on_event("startup")
+async def watch_user_changes():
+    if crud.USER_CHANGES_CHANNEL:
+        background_tasks.append(asyncio.ensure_future(crud.follow_user_changes()))
+    if crud.USER_CACHE_WATCH:
+        background_tasks.append(asyncio.ensure_future(crud.watch_user_changes()))
+    else:
+        logger.warning(
+            "USER_CACHE_WATCH is off: users changed directly in mongo stay "
+            "cached for up to USER_CACHE_TTL=%ss",
+            crud.USER_CACHE_TTL,
+        )
+
+
+@app.on_event("startup")
+async def follow_registered_emails():
+    if resources.registered_emails.mode != "off":
+        background_tasks.append(
+            asyncio.ensure_future(
+                resources.registered_emails.run(crud.count_users, crud.scan_emails)
+            )
+        )
+
+
+@app.on_event("startup")
+async def follow_revoked_tokens():
+    background_tasks.append(asyncio.ensure_future(resources.revoked_tokens.run()))
+
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+
+@app.on_event("shutdown")
+async def stop_profiler():
+    profiler.profiler.stop()
+
+
+@app.on_event("shutdown")
+async def close_resources():
+    await resources.close()
 
 
 app.include_router(
@@ -18,7 +86,29 @@ app.include_router(
     tags=["auth"],
     responses={401: {"description": "Authentication Failure"}},
 )
+app.include_router(profiler.router, prefix="/admin", tags=["admin"])
+
+app.add_route("/metrics", metrics.metrics_endpoint, include_in_schema=False)
+app.add_route(
+    "/.well-known/jwks.json",
+    keys.jwks_endpoint(lambda: resources.signing_keys),
+    include_in_schema=False,
+)
+metrics.register_cache("users", crud.user_cache)
+metrics.register_cache("tokens", security.token_cache)
 
+app.add_middleware(
+    admission.AdmissionMiddleware,
+    limiters=admission.build_limiters(),
+    route_groups={
+        **dict.fromkeys(HASH_ROUTES, "hash"),
+        # Scrapes and key fetches must get through when the app is busiest.
+        "/metrics": None,
+        "/.well-known/jwks.json": None,
+    },
+)
+app.add_middleware(profiler.ProfilerMiddleware, routes=app.routes)
+app.add_middleware(metrics.MetricsMiddleware, routes=app.routes)
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -0,0 +1,250 @@
+import functools
+import os
+import time
+from typing import Iterable, Sequence
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import BaseRoute, Match
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app.auth.cache import TTLCache
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time to respond to a request",
+    ["method", "route", "status"],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests currently being handled",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+DEPENDENCY_LATENCY = Histogram(
+    "dependency_duration_seconds",
+    "Time spent waiting on an external dependency",
+    ["dependency", "operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+RESOURCE_STARTUP = Gauge(
+    "resource_startup_seconds",
+    "Time taken to create each resource when the worker started",
+    ["resource"],
+    multiprocess_mode="max",
+)
+DEPENDENCY_ERRORS = Counter(
+    "dependency_errors_total",
+    "Calls to an external dependency that raised",
+    ["dependency", "operation"],
+)
+
+MONGO_COMMANDS = Counter(
+    "mongo_commands_total",
+    "Commands sent to mongo, by the node that handled them",
+    ["command", "node", "outcome"],
+)
+
+OUTBOX_DELIVERIES = Counter(
+    "outbox_deliveries_total",
+    "Attempts to deliver a queued email, by outcome",
+    ["outcome"],
+)
+OUTBOX_DELIVERY_LAG = Histogram(
+    "outbox_delivery_lag_seconds",
+    "Time from queueing an email to delivering it",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900),
+)
+# Every worker reports the same stream, so keep the largest value rather than
+# a sum across processes.
+OUTBOX_BACKLOG = Gauge(
+    "outbox_backlog", "Queued emails no worker has read yet", multiprocess_mode="max"
+)
+OUTBOX_PENDING = Gauge(
+    "outbox_pending",
+    "Emails read by a worker and not yet delivered, including ones awaiting retry",
+    multiprocess_mode="max",
+)
+OUTBOX_OLDEST = Gauge(
+    "outbox_oldest_seconds",
+    "Age of the oldest undelivered email",
+    multiprocess_mode="max",
+)
+OUTBOX_DEAD_LETTERS = Gauge(
+    "outbox_dead_letters",
+    "Emails given up on and moved to the dead letter stream",
+    multiprocess_mode="max",
+)
+
+ADMISSION_ACTIVE = Gauge(
+    "admission_active",
+    "Requests admitted and being handled, by route group",
+    ["group"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_QUEUED = Gauge(
+    "admission_queued",
+    "Requests waiting to be admitted, by route group",
+    ["group"],
+    multiprocess_mode="livesum",
+)
+ADMISSION_WAIT = Histogram(
+    "admission_wait_seconds",
+    "Time queued requests waited to be admitted or turned away",
+    ["group"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+ADMISSION_SHED = Counter(
+    "admission_shed_total",
+    "Requests turned away with 503, by route group and reason",
+    ["group", "reason"],
+)
+
+
+USER_FILTER_LOOKUPS = Counter(
+    "user_filter_lookups_total",
+    "Email lookups checked against the registered email filter, by result",
+    ["result"],
+)
+USER_FILTER_BYTES = Gauge(
+    "user_filter_bytes",
+    "Memory held by the registered email filter",
+    multiprocess_mode="livesum",
+)
+USER_FILTER_EMAILS = Gauge(
+    "user_filter_emails",
+    "Emails added to the registered email filter",
+    multiprocess_mode="max",
+)
+USER_FILTER_FALSE_POSITIVE_RATE = Gauge(
+    "user_filter_false_positive_rate",
+    "Expected share of unregistered emails the filter lets through",
+    multiprocess_mode="max",
+)
+
+REVOKED_TOKENS = Gauge(
+    "revoked_tokens",
+    "Revoked access tokens yet to expire, as mirrored by the worker",
+    multiprocess_mode="max",
+)
+
+
+def timed(dependency: str, operation: str):
+    """Time calls to a coroutine function that waits on a dependency.
+
+    The labelled metrics are resolved once when decorating, so each call only
+    pays for two clock reads and an observation.
+    """
+    latency = DEPENDENCY_LATENCY.labels(dependency, operation)
+    errors = DEPENDENCY_ERRORS.labels(dependency, operation)
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - start)
+
+        return wrapper
+
+    return decorator
+
+
+class CacheCollector:
+    """Exports the hit, miss and size counts the caches already keep"""
+
+    def __init__(self):
+        self.caches = {}
+
+    def collect(self) -> Iterable:
+        hits = CounterMetricFamily(
+            "cache_hits", "Cache lookups that hit", labels=["cache"]
+        )
+        misses = CounterMetricFamily(
+            "cache_misses", "Cache lookups that missed", labels=["cache"]
+        )
+        size = GaugeMetricFamily(
+            "cache_entries", "Entries in the cache", labels=["cache"]
+        )
+        for name, cache in self.caches.items():
+            hits.add_metric([name], cache.hits)
+            misses.add_metric([name], cache.misses)
+            size.add_metric([name], len(cache))
+        return [hits, misses, size]
+
+
+cache_collector = CacheCollector()
+REGISTRY.register(cache_collector)
+
+
+def register_cache(name: str, cache: TTLCache):
+    cache_collector.caches[name] = cache
+
+
+def route_name(routes: Sequence[BaseRoute], scope: Scope) -> str:
+    for route in routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", route.name)
+    # Unmatched paths share a label so scanners can't blow up cardinality.
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """Records latency and in flight requests per route template"""
+
+    def __init__(self, app: ASGIApp, routes: Sequence[BaseRoute]):
+        self.app = app
+        self.routes = routes
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        route = route_name(self.routes, scope)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_flight = REQUESTS_IN_FLIGHT.labels(method, route)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_LATENCY.labels(method, route, status).observe(
+                time.perf_counter() - start
+            )
+            in_flight.dec()
+
+
+async def metrics_endpoint(_request: Request) -> Response:
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Aggregate the metrics of every worker process.
+        # Cache counts are those of the worker serving the scrape.
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(cache_collector)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
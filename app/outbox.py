@@ -0,0 +1,324 @@
+"""Outgoing email, queued in a redis stream and delivered by workers.
+
+The auth endpoints add emails to the stream and respond without waiting on
+Mailgun. Workers read the stream through a consumer group, so any number of
+them can run side by side and each email is delivered by one of them:
+
+    python -m app.outbox
+
+An email that fails stays pending and the worker that read it retries it
+with exponential backoff. After OUTBOX_MAX_ATTEMPTS failed deliveries it is
+moved to the dead letter stream. Emails left pending by a worker that died
+are claimed by another one after OUTBOX_CLAIM_IDLE_MS, which should be
+longer than a delivery can take.
+"""
+import asyncio
+import logging
+import os
+import signal
+import socket
+import time
+from typing import Dict, List, NamedTuple, Optional, Set
+
+from prometheus_client import start_http_server
+from redis import asyncio as aioredis
+from redis.exceptions import ResponseError
+
+from app import mail, metrics
+from app.auth import store
+from app.resources import resources
+
+logger = logging.getLogger()
+
+OUTBOX_REDIS_DB = int(os.getenv("OUTBOX_REDIS_DB", 4))
+OUTBOX_STREAM = os.getenv("OUTBOX_STREAM", "mail:outbox")
+OUTBOX_DEAD_STREAM = os.getenv("OUTBOX_DEAD_STREAM", "mail:dead")
+OUTBOX_GROUP = os.getenv("OUTBOX_GROUP", "mailers")
+# Caps the stream if no worker is running. Delivered emails are deleted, so it
+# only grows while they are down.
+OUTBOX_MAX_LENGTH = int(os.getenv("OUTBOX_MAX_LENGTH", 1000000))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", 20))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))
+OUTBOX_RETRY_DELAY_MS = int(os.getenv("OUTBOX_RETRY_DELAY_MS", 1000))
+OUTBOX_RETRY_MAX_DELAY_MS = int(os.getenv("OUTBOX_RETRY_MAX_DELAY_MS", 60000))
+OUTBOX_CLAIM_IDLE_MS = int(os.getenv("OUTBOX_CLAIM_IDLE_MS", 300000))
+OUTBOX_POLL_MS = int(os.getenv("OUTBOX_POLL_MS", 1000))
+OUTBOX_METRICS_PORT = int(os.getenv("OUTBOX_METRICS_PORT", 9100))
+
+
+class Email(NamedTuple):
+    to: str
+    subject: str
+    text: str
+
+
+class Entry(NamedTuple):
+    id: bytes
+    fields: Dict[bytes, bytes]
+
+    @property
+    def queued_at(self) -> float:
+        """When the email was queued, from the time stamp in its id"""
+        return int(self.id.split(b"-")[0]) / 1000
+
+    def email(self) -> Email:
+        return Email(
+            self.fields[b"to"].decode("utf-8"),
+            self.fields[b"subject"].decode("utf-8"),
+            self.fields[b"text"].decode("utf-8"),
+        )
+
+
+class Stats(NamedTuple):
+    backlog: int
+    pending: int
+    oldest_seconds: float
+    dead_letters: int
+
+
+class Outbox:
+    """Emails waiting to be sent, in a redis stream read by a consumer group"""
+
+    def __init__(
+        self,
+        client: aioredis.Redis,
+        stream: str = OUTBOX_STREAM,
+        dead_stream: str = OUTBOX_DEAD_STREAM,
+        group: str = OUTBOX_GROUP,
+        max_length: int = OUTBOX_MAX_LENGTH,
+    ):
+        self.client = client
+        self.stream = stream
+        self.dead_stream = dead_stream
+        self.group = group
+        self.max_length = max_length
+
+    @metrics.timed("redis", "outbox_enqueue")
+    async def enqueue(self, to: str, subject: str, text: str) -> bytes:
+        return await self.client.xadd(
+            self.stream,
+            {"to": to, "subject": subject, "text": text},
+            maxlen=self.max_length,
+            approximate=True,
+        )
+
+    async def ensure_group(self):
+        """Create the consumer group, starting from the beginning of the
+        stream so emails queued before the first worker ran are sent"""
+        try:
+            await self.client.xgroup_create(
+                self.stream, self.group, id="0", mkstream=True
+            )
+        except ResponseError as err:
+            if "BUSYGROUP" not in str(err):
+                raise
+
+    async def read(self, consumer: str, count: int, block_ms: int) -> List[Entry]:
+        """Emails no consumer has read yet, waiting up to block_ms for some"""
+        response = await self.client.xreadgroup(
+            self.group, consumer, {self.stream: ">"}, count=count, block=block_ms
+        )
+        if not response:
+            return []
+        [(_stream, entries)] = response
+        return [Entry(*entry) for entry in entries]
+
+    async def pending(self, count: int) -> List[dict]:
+        """The oldest emails read but not yet delivered, with who read them,
+        how many times and how long ago"""
+        return await self.client.xpending_range(
+            self.stream, self.group, "-", "+", count
+        )
+
+    async def claim(
+        self, consumer: str, min_idle_ms: int, entry_id: bytes
+    ) -> Optional[Entry]:
+        """Take over a pending email unless another consumer has read it in
+        the last min_idle_ms. Returns None if it is not taken."""
+        claimed = await self.client.xclaim(
+            self.stream, self.group, consumer, min_idle_ms, [entry_id]
+        )
+        if not claimed:
+            return None
+        return Entry(*claimed[0])
+
+    async def ack(self, entry_id: bytes):
+        """Mark an email done and delete it, so the stream only holds emails
+        that still need sending"""
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.xack(self.stream, self.group, entry_id)
+            pipe.xdel(self.stream, entry_id)
+            await pipe.execute()
+
+    async def bury(self, entry: Entry, attempts: int):
+        """Give up on an email, moving it to the dead letter stream"""
+        await self.client.xadd(
+            self.dead_stream,
+            {**entry.fields, b"id": entry.id, b"attempts": attempts},
+            maxlen=self.max_length,
+            approximate=True,
+        )
+        await self.ack(entry.id)
+
+    async def stats(self) -> Stats:
+        length = await self.client.xlen(self.stream)
+        pending = (await self.client.xpending(self.stream, self.group))["pending"]
+        oldest = await self.client.xrange(self.stream, count=1)
+        oldest_seconds = time.time() - Entry(*oldest[0]).queued_at if oldest else 0
+        dead_letters = await self.client.xlen(self.dead_stream)
+        return Stats(length - pending, pending, max(oldest_seconds, 0), dead_letters)
+
+    async def close(self):
+        await store.close_client(self.client)
+
+
+class Worker:
+    """Delivers emails from the outbox, up to concurrency at a time"""
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        mailer: mail.MailClient,
+        consumer: str = None,
+        concurrency: int = OUTBOX_CONCURRENCY,
+        max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+        retry_delay_ms: int = OUTBOX_RETRY_DELAY_MS,
+        retry_max_delay_ms: int = OUTBOX_RETRY_MAX_DELAY_MS,
+        claim_idle_ms: int = OUTBOX_CLAIM_IDLE_MS,
+        poll_ms: int = OUTBOX_POLL_MS,
+    ):
+        self.outbox = outbox
+        self.mailer = mailer
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay_ms = retry_delay_ms
+        self.retry_max_delay_ms = retry_max_delay_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.poll_ms = poll_ms
+        self._in_flight: Set[bytes] = set()
+        self._tasks: Set[asyncio.Future] = set()
+        self._stopping = False
+
+    def retry_delay(self, attempts: int) -> int:
+        """Milliseconds to wait after a number of failed attempts"""
+        return min(self.retry_delay_ms * 2 ** (attempts - 1), self.retry_max_delay_ms)
+
+    def stop(self):
+        """Stop reading new emails. run returns once those in flight are done."""
+        self._stopping = True
+
+    async def run(self):
+        await self.outbox.ensure_group()
+        loop = asyncio.get_event_loop()
+        next_check = 0.0
+        while not self._stopping:
+            if loop.time() >= next_check:
+                await self.retry_pending()
+                await self.report()
+                next_check = loop.time() + self.poll_ms / 1000
+            free = self.concurrency - len(self._in_flight)
+            if free <= 0:
+                await asyncio.wait(
+                    self._tasks,
+                    timeout=self.poll_ms / 1000,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                continue
+            for entry in await self.outbox.read(self.consumer, free, self.poll_ms):
+                self._start(entry, 1)
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    async def retry_pending(self):
+        """Retry this worker's failed emails once their backoff has passed,
+        and take over those of workers that have stopped. Only as many as
+        there are free delivery slots are retried; the rest wait for the
+        next poll."""
+        pending = await self.outbox.pending(self.concurrency + 100)
+        free = self.concurrency - len(self._in_flight)
+        for item in pending:
+            if free <= 0:
+                break
+            entry_id = item["message_id"]
+            if entry_id in self._in_flight:
+                continue
+            attempts = item["times_delivered"]
+            min_idle_ms = self.retry_delay(attempts)
+            if item["consumer"].decode("utf-8") != self.consumer:
+                min_idle_ms = max(min_idle_ms, self.claim_idle_ms)
+            if item["time_since_delivered"] < min_idle_ms:
+                continue
+            entry = await self.outbox.claim(self.consumer, min_idle_ms, entry_id)
+            if entry is None:
+                continue
+            if not entry.fields:
+                # Trimmed from the stream while pending.
+                await self.outbox.ack(entry.id)
+            elif attempts >= self.max_attempts:
+                logger.error(
+                    "Giving up on email %s after %d attempts", entry.id, attempts
+                )
+                metrics.OUTBOX_DELIVERIES.labels("dead").inc()
+                await self.outbox.bury(entry, attempts)
+            else:
+                self._start(entry, attempts + 1)
+                free -= 1
+
+    async def report(self):
+        stats = await self.outbox.stats()
+        metrics.OUTBOX_BACKLOG.set(stats.backlog)
+        metrics.OUTBOX_PENDING.set(stats.pending)
+        metrics.OUTBOX_OLDEST.set(stats.oldest_seconds)
+        metrics.OUTBOX_DEAD_LETTERS.set(stats.dead_letters)
+
+    def _start(self, entry: Entry, attempt: int):
+        self._in_flight.add(entry.id)
+        task = asyncio.ensure_future(self._deliver(entry, attempt))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, entry: Entry, attempt: int):
+        try:
+            await self.mailer.send(*entry.email())
+        except Exception as err:
+            # Left pending, to be retried by retry_pending.
+            logger.warning("Email %s failed on attempt %d: %s", entry.id, attempt, err)
+            metrics.OUTBOX_DELIVERIES.labels("failed").inc()
+        else:
+            await self.outbox.ack(entry.id)
+            metrics.OUTBOX_DELIVERIES.labels("sent").inc()
+            metrics.OUTBOX_DELIVERY_LAG.observe(time.time() - entry.queued_at)
+        finally:
+            self._in_flight.discard(entry.id)
+
+
+resources.register(
+    "outbox",
+    lambda: Outbox(store.create_client(db=OUTBOX_REDIS_DB)),
+    close=Outbox.close,
+)
+
+
+async def work():
+    await resources.start()
+    await resources.mail.start()
+    worker = Worker(resources.outbox, resources.mail)
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, worker.stop)
+    logger.info("Delivering email as %s", worker.consumer)
+    try:
+        await worker.run()
+    finally:
+        await resources.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    start_http_server(OUTBOX_METRICS_PORT)
+    asyncio.get_event_loop().run_until_complete(work())
+
+
+if __name__ == "__main__":
+    main()
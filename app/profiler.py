@@ -0,0 +1,284 @@
+"""Sampling profiler for a fraction of requests, aggregated per route.
+
+A background thread wakes every PROFILER_INTERVAL_MS while profiled requests
+are in progress and records, for each of them, where it is: the stack of the
+event loop thread if the request is the task running, otherwise the chain of
+coroutines it is suspended in. Time spent waiting on bcrypt, mongo or redis
+therefore shows up under the call that awaited it, not only time on the CPU.
+
+PROFILER_SAMPLE_RATE picks a fraction of requests at random, and requests
+with the PROFILER_HEADER header set are always profiled. Stacks are kept per
+worker process and served from /admin/profile to ADMIN_EMAILS as collapsed
+stacks (for flamegraph.pl and similar) or speedscope JSON.
+"""
+import asyncio
+import collections
+import os
+import random
+import sys
+import threading
+from typing import Counter, Dict, List, Optional, Sequence, Tuple
+
+from fastapi import Depends, HTTPException
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import BaseRoute
+from starlette.status import HTTP_400_BAD_REQUEST
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from app import metrics, responses
+from app.auth import models, security
+
+PROFILER_SAMPLE_RATE = float(os.getenv("PROFILER_SAMPLE_RATE", 0))
+PROFILER_HEADER = os.getenv("PROFILER_HEADER", "")
+PROFILER_INTERVAL_MS = float(os.getenv("PROFILER_INTERVAL_MS", 5))
+# Distinct stacks kept per route; further new stacks are counted as truncated.
+PROFILER_MAX_STACKS = int(os.getenv("PROFILER_MAX_STACKS", 5000))
+
+# (function, file, first line)
+Frame = Tuple[str, str, int]
+Stack = Tuple[Frame, ...]
+
+TRUNCATED: Stack = (("(truncated)", "", 0),)
+_SITE_PACKAGES = "site-packages/"
+
+
+def _frame_key(frame) -> Frame:
+    code = frame.f_code
+    filename = code.co_filename
+    _, _, short = filename.rpartition(_SITE_PACKAGES)
+    return code.co_name, short or filename, code.co_firstlineno
+
+
+def _running_stack(frame) -> List:
+    """Frames of a running thread, outermost first"""
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _suspended_stack(task: asyncio.Task) -> List:
+    """Frames of the coroutines a suspended task is waiting in, outermost
+    first, followed by what the innermost one awaits"""
+    frames = []
+    awaitable = getattr(task, "_coro", None)
+    while awaitable is not None:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(
+            awaitable, "gi_frame", None
+        )
+        if frame is None:
+            break
+        frames.append(frame)
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(
+            awaitable, "gi_yieldfrom", None
+        )
+    return frames
+
+
+class Profiler:
+    def __init__(
+        self,
+        interval: float = PROFILER_INTERVAL_MS / 1000,
+        max_stacks: int = PROFILER_MAX_STACKS,
+    ):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.stacks: Dict[str, Counter[Stack]] = collections.defaultdict(
+            collections.Counter
+        )
+        self._lock = threading.Lock()
+        self._active: Dict[asyncio.Task, Tuple[str, object]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def begin(self, route: str, root_code) -> asyncio.Task:
+        """Start profiling the current task. Frames below the one running
+        root_code are left out of its stacks."""
+        task = asyncio.current_task()
+        if self._thread is None:
+            self._loop = asyncio.get_event_loop()
+            self._loop_thread = threading.get_ident()
+            self._stopping.clear()
+            self._thread = threading.Thread(
+                target=self._sample_forever, name="profiler", daemon=True
+            )
+            self._thread.start()
+        self._active[task] = (route, root_code)
+        return task
+
+    def end(self, task: asyncio.Task):
+        self._active.pop(task, None)
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def clear(self):
+        with self._lock:
+            self.stacks.clear()
+
+    def _sample_forever(self):
+        while not self._stopping.wait(self.interval):
+            if self._active:
+                self.sample()
+
+    def sample(self):
+        """Record where each profiled request is"""
+        running = asyncio.tasks._current_tasks.get(self._loop)
+        loop_frame = sys._current_frames().get(self._loop_thread)
+        for task, (route, root_code) in list(self._active.items()):
+            if task is running and loop_frame is not None:
+                frames = _running_stack(loop_frame)
+            else:
+                frames = _suspended_stack(task)
+            self._record(route, _below(frames, root_code))
+
+    def _record(self, route: str, frames: Sequence):
+        stack = tuple(_frame_key(frame) for frame in frames)
+        with self._lock:
+            counts = self.stacks[route]
+            if stack not in counts and len(counts) >= self.max_stacks:
+                stack = TRUNCATED
+            counts[stack] += 1
+
+    def snapshot(self, route: str = None) -> Dict[str, Counter[Stack]]:
+        with self._lock:
+            return {
+                name: collections.Counter(counts)
+                for name, counts in self.stacks.items()
+                if route is None or name == route
+            }
+
+    def collapsed(self, route: str = None) -> str:
+        """One ``route;outer;...;inner count`` line per distinct stack"""
+        lines = []
+        for name, counts in sorted(self.snapshot(route).items()):
+            for stack, count in counts.most_common():
+                names = [name] + [_frame_name(frame) for frame in stack]
+                lines.append(";".join(names) + f" {count}")
+        return "\n".join(lines) + "\n"
+
+    def speedscope(self, route: str = None) -> dict:
+        """A speedscope file with one sampled profile per route"""
+        frame_index: Dict[Frame, int] = {}
+        frames = []
+        profiles = []
+        interval_ms = self.interval * 1000
+        for name, counts in sorted(self.snapshot(route).items()):
+            samples = []
+            weights = []
+            for stack, count in counts.most_common():
+                sample = []
+                for frame in stack:
+                    if frame not in frame_index:
+                        frame_index[frame] = len(frames)
+                        function, file, line = frame
+                        frames.append({"name": function, "file": file, "line": line})
+                    sample.append(frame_index[frame])
+                samples.append(sample)
+                weights.append(count * interval_ms)
+            profiles.append(
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "milliseconds",
+                    "startValue": 0,
+                    "endValue": sum(weights),
+                    "samples": samples,
+                    "weights": weights,
+                }
+            )
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": "passwordless",
+            "exporter": "passwordless",
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+
+def _below(frames: Sequence, root_code) -> Sequence:
+    for position, frame in enumerate(frames):
+        if frame.f_code is root_code:
+            return frames[position + 1 :]
+    return frames
+
+
+def _frame_name(frame: Frame) -> str:
+    function, file, line = frame
+    if not file:
+        return function
+    return f"{function} ({file}:{line})"
+
+
+profiler = Profiler()
+
+
+class ProfilerMiddleware:
+    """Profiles PROFILER_SAMPLE_RATE of requests, and those carrying
+    PROFILER_HEADER. Others pass straight through."""
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        routes: Sequence[BaseRoute],
+        profiler: Profiler = profiler,
+        sample_rate: float = PROFILER_SAMPLE_RATE,
+        header: str = PROFILER_HEADER,
+    ):
+        self.app = app
+        self.routes = routes
+        self.profiler = profiler
+        self.sample_rate = sample_rate
+        self.header = header.lower().encode("latin-1")
+
+    def wants(self, scope: Scope) -> bool:
+        if self.sample_rate and random.random() < self.sample_rate:
+            return True
+        if self.header:
+            return any(name == self.header for name, _ in scope["headers"])
+        return False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.wants(scope):
+            await self.app(scope, receive, send)
+            return
+        route = f'{scope["method"]} {metrics.route_name(self.routes, scope)}'
+        task = self.profiler.begin(route, ProfilerMiddleware.__call__.__code__)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.profiler.end(task)
+
+
+router = responses.Router()
+
+
+@router.get("/profile", include_in_schema=False)
+async def get_profile(
+    format: str = "speedscope",
+    route: str = None,
+    _admin: models.User = Depends(security.get_current_admin_user),
+) -> Response:
+    """Stacks sampled so far by this worker, for one route or all of them,
+    e.g. ?format=collapsed&route=POST /auth/confirm"""
+    if format == "collapsed":
+        return PlainTextResponse(profiler.collapsed(route))
+    if format == "speedscope":
+        return responses.ORJSONResponse(profiler.speedscope(route))
+    raise HTTPException(
+        status_code=HTTP_400_BAD_REQUEST,
+        detail="Format must be speedscope or collapsed",
+    )
+
+
+@router.delete("/profile", include_in_schema=False)
+async def clear_profile(_admin: models.User = Depends(security.get_current_admin_user)):
+    profiler.clear()
+    return {"status": "cleared"}
@@ -0,0 +1,98 @@
+"""Clients for the app's external dependencies, created on first use.
+
+Modules register a factory for each client they need instead of creating it
+at import, so importing the app has no side effects and every worker process
+creates its own clients after it forks. The app creates them all at startup
+and closes them at shutdown; tests and benchmarks swap them with
+``monkeypatch.setattr(resources, name, fake)``.
+"""
+import inspect
+import logging
+import time
+from typing import Any, Callable, Dict, Optional
+
+from app import metrics
+
+logger = logging.getLogger()
+
+
+class Resources:
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Any]] = {}
+        self._closers: Dict[str, Callable[[Any], Any]] = {}
+        self._starters: Dict[str, Callable[[Any], Any]] = {}
+        self._created: Dict[str, Any] = {}
+        self.startup_seconds: Optional[float] = None
+
+    def register(
+        self,
+        name: str,
+        factory: Callable[[], Any],
+        start: Callable[[Any], Any] = None,
+        close: Callable[[Any], Any] = None,
+    ):
+        """Declare how to create a resource, and optionally how to warm it up
+        at startup and release it at shutdown"""
+        self._factories[name] = factory
+        if start is not None:
+            self._starters[name] = start
+        if close is not None:
+            self._closers[name] = close
+
+    def __getattr__(self, name: str) -> Any:
+        factories = self.__dict__.get("_factories", {})
+        if name not in factories:
+            raise AttributeError(name)
+        created = self._created
+        if name not in created:
+            created[name] = factories[name]()
+        return created[name]
+
+    def __setattr__(self, name: str, value: Any):
+        if name in self.__dict__.get("_factories", {}):
+            self._created[name] = value
+        else:
+            super().__setattr__(name, value)
+
+    def __delattr__(self, name: str):
+        if name in self._factories:
+            self._created.pop(name, None)
+        else:
+            super().__delattr__(name)
+
+    async def start(self):
+        """Create every resource, timing each one"""
+        start = time.perf_counter()
+        for name in self._factories:
+            resource_start = time.perf_counter()
+            resource = getattr(self, name)
+            starter = self._starters.get(name)
+            if starter is not None:
+                await _maybe_await(starter(resource))
+            metrics.RESOURCE_STARTUP.labels(name).set(
+                time.perf_counter() - resource_start
+            )
+        self.startup_seconds = time.perf_counter() - start
+        logger.info(
+            "Started %d resources in %.3fs", len(self._factories), self.startup_seconds
+        )
+
+    async def close(self):
+        """Release every resource that was created, newest first"""
+        for name in reversed(list(self._created)):
+            resource = self._created.pop(name)
+            closer = self._closers.get(name)
+            if closer is None:
+                continue
+            try:
+                await _maybe_await(closer(resource))
+            except Exception:
+                logger.exception("Failed to close %s", name)
+
+
+async def _maybe_await(result):
+    if inspect.isawaitable(result):
+        await result
+
+
+resources = Resources()
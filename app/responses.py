@@ -0,0 +1,43 @@
+from typing import Any, Type
+
+import orjson
+from fastapi import APIRouter
+from pydantic import BaseModel
+from starlette.responses import JSONResponse, Response
+
+
+def encode(content: Any) -> bytes:
+    return orjson.dumps(content)
+
+
+class ORJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
+
+class EncodedJSONResponse(Response):
+    """A body that is already JSON, such as a constant encoded at import"""
+
+    media_type = "application/json"
+
+
+def model_response(
+    model: BaseModel, response_model: Type[BaseModel] = None, status_code: int = 200
+) -> Response:
+    """Serialise a model straight to bytes.
+
+    FastAPI revalidates a returned model against the response_model and walks
+    it with jsonable_encoder. Endpoints returning a model they built themselves
+    can skip both; only the fields of response_model are sent, as FastAPI would.
+    """
+    fields = (response_model or type(model)).__fields__
+    return ORJSONResponse(model.dict(include=set(fields)), status_code=status_code)
+
+
+class Router(APIRouter):
+    """APIRouter whose routes default to ORJSONResponse"""
+
+    def add_api_route(self, *args, response_class: Type[Response] = None, **kwargs):
+        if response_class is None or response_class is JSONResponse:
+            response_class = ORJSONResponse
+        super().add_api_route(*args, response_class=response_class, **kwargs)
@@ -1,14 +1,30 @@
+import asyncio
 import os
+import random
+import shutil
+import socket
+import subprocess
+import time
 import uuid
 from urllib.parse import quote_plus
 
+import fakeredis
 import pymongo
 import pytest
+from fakeredis import aioredis as fake_aioredis
 from motor import motor_asyncio
 
 from starlette.testclient import TestClient
 
+from app import outbox
+from app.auth import bloom, crud, revocation, security, sessions, store, throttle
 from app.main import app
+from app.resources import resources
+
+
+def run(coroutine):
+    """Run a coroutine to completion on the event loop"""
+    return asyncio.get_event_loop().run_until_complete(coroutine)
 
 
 @pytest.fixture
@@ -43,3 +59,211 @@ def async_db(db_name):
 @pytest.fixture
 def test_client():
     return TestClient(app)
+
+
+@pytest.fixture
+def introspect_headers(monkeypatch):
+    """Headers a gateway sends to introspect tokens"""
+    monkeypatch.setattr(security, "INTROSPECT_SECRET", "introspect-secret")
+    return {"Authorization": "Bearer introspect-secret"}
+
+
+@pytest.fixture
+def fake_redis_server():
+    return fakeredis.FakeServer()
+
+
+@pytest.fixture
+def secret_stores(fake_redis_server, monkeypatch):
+    """Replace the redis backed secret stores with in memory fakes"""
+    otps = store.SecretStore(
+        "otp", fake_aioredis.FakeRedis(server=fake_redis_server, db=0)
+    )
+    url_secrets = store.SecretStore(
+        "url_secret", fake_aioredis.FakeRedis(server=fake_redis_server, db=1)
+    )
+    monkeypatch.setattr(resources, "otps", otps)
+    monkeypatch.setattr(resources, "url_secrets", url_secrets)
+    return otps, url_secrets
+
+
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    crud.user_cache.clear()
+    crud.cached_user_emails.clear()
+    crud.recently_written.clear()
+
+
+@pytest.fixture(autouse=True)
+def throttle_client(monkeypatch):
+    """Give every test fresh rate limits and issuance claims"""
+    client = fake_aioredis.FakeRedis(server=fakeredis.FakeServer())
+    monkeypatch.setattr(resources, "throttle_client", client)
+    monkeypatch.setattr(resources, "limiters", throttle.build_limiters(client))
+    return client
+
+
+@pytest.fixture(autouse=True)
+def refresh_tokens(monkeypatch):
+    """Keep refresh token sessions in memory"""
+    tokens = sessions.RefreshTokens(
+        fake_aioredis.FakeRedis(server=fakeredis.FakeServer())
+    )
+    monkeypatch.setattr(resources, "refresh_tokens", tokens)
+    return tokens
+
+
+@pytest.fixture(autouse=True)
+def mail_outbox(monkeypatch):
+    """Queue emails in memory instead of redis"""
+    queued = outbox.Outbox(fake_aioredis.FakeRedis(server=fakeredis.FakeServer()))
+    monkeypatch.setattr(resources, "outbox", queued)
+    return queued
+
+
+@pytest.fixture(autouse=True)
+def registered_emails(monkeypatch):
+    """Publish registrations to an in memory redis"""
+    client = fake_aioredis.FakeRedis(server=fakeredis.FakeServer())
+    emails = bloom.RegisteredEmails("off", client)
+    monkeypatch.setattr(resources, "registered_emails", emails)
+    return emails
+
+
+@pytest.fixture(autouse=True)
+def user_changes_client(monkeypatch):
+    """Announce changed users to an in memory redis"""
+    client = fake_aioredis.FakeRedis(server=fakeredis.FakeServer())
+    monkeypatch.setattr(resources, "user_changes_client", client)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def revoked_tokens(monkeypatch):
+    """Keep revoked tokens in memory"""
+    client = fake_aioredis.FakeRedis(server=fakeredis.FakeServer())
+    revoked = revocation.RevokedTokens(client, client)
+    monkeypatch.setattr(resources, "revoked_tokens", revoked)
+    return revoked
+
+
+def port_is_free(port: int) -> bool:
+    with socket.socket() as sock:
+        try:
+            sock.bind(("127.0.0.1", port))
+        except OSError:
+            return False
+    return True
+
+
+def free_port() -> int:
+    """A free port whose cluster bus port, 10000 higher, is also free"""
+    while True:
+        port = random.randint(20000, 50000)
+        if port_is_free(port) and port_is_free(port + 10000):
+            return port
+
+
+def redis_cli(port: int, *args: str) -> str:
+    return subprocess.run(
+        ["redis-cli", "-p", str(port), *args],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    ).stdout
+
+
+def wait_for(check, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if check():
+                return
+        except subprocess.CalledProcessError:
+            pass
+        if time.monotonic() > deadline:
+            raise TimeoutError("redis did not become ready")
+        time.sleep(0.1)
+
+
+class RedisProcesses:
+    """redis-server processes on free local ports, stopped together"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.processes = []
+
+    def start(self, *args: str) -> int:
+        port = free_port()
+        self.processes.append(
+            subprocess.Popen(
+                ["redis-server", *args, "--port", str(port), "--save", ""],
+                cwd=str(self.directory),
+                stdout=subprocess.DEVNULL,
+            )
+        )
+        wait_for(lambda: redis_cli(port, "ping").strip() == "PONG")
+        return port
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+
+@pytest.fixture(scope="session")
+def redis_processes(tmp_path_factory):
+    if shutil.which("redis-server") is None or shutil.which("redis-cli") is None:
+        pytest.skip("redis-server is not installed")
+    processes = RedisProcesses(tmp_path_factory.mktemp("redis"))
+    yield processes
+    processes.stop()
+
+
+@pytest.fixture(scope="session")
+def redis_server(redis_processes):
+    """A local standalone redis server. Returns its port."""
+    return redis_processes.start()
+
+
+@pytest.fixture(scope="session")
+def redis_cluster(redis_processes):
+    """A local three node redis cluster. Returns the port of one node."""
+    ports = [
+        redis_processes.start(
+            "--cluster-enabled", "yes", "--cluster-config-file", f"nodes-{i}.conf"
+        )
+        for i in range(3)
+    ]
+    nodes = [f"127.0.0.1:{port}" for port in ports]
+    redis_cli(ports[0], "--cluster", "create", *nodes, "--cluster-yes")
+    wait_for(
+        lambda: all(
+            "cluster_state:ok" in redis_cli(port, "cluster", "info") for port in ports
+        )
+    )
+    return ports[0]
+
+
+@pytest.fixture(scope="session")
+def redis_sentinel(redis_processes):
+    """A local master and replica watched by a sentinel. Returns the
+    sentinel's port."""
+    master = redis_processes.start()
+    redis_processes.start("--replicaof", "127.0.0.1", str(master))
+    config = redis_processes.directory / "sentinel.conf"
+    config.write_text(
+        f"sentinel monitor mymaster 127.0.0.1 {master} 1\n"
+        "sentinel down-after-milliseconds mymaster 1000\n"
+        "sentinel failover-timeout mymaster 2000\n"
+    )
+    sentinel = redis_processes.start(str(config), "--sentinel")
+    # Ready once the sentinel has seen the replica in sync, which it must
+    # before it will promote it.
+    wait_for(
+        lambda: "master-link-status\nok"
+        in redis_cli(sentinel, "sentinel", "slaves", "mymaster")
+    )
+    return sentinel
@@ -0,0 +1,67 @@
+"""A local stand-in for the Mailgun messages API.
+
+Records every message it receives and the client connections it was sent
+over. Used by the mail tests and the benchmarks.
+"""
+import asyncio
+import json
+
+from aiohttp import web
+
+
+class FakeMailgun:
+    def __init__(self, latency: float = 0, status: int = 200):
+        self.latency = latency
+        self.status = status
+        self.requests = []
+        self.connections = set()
+        self.app = web.Application()
+        self.app.router.add_post("/v3/{domain}/messages", self.messages)
+        self._runner = None
+        self.url = None
+
+    async def messages(self, request: web.Request) -> web.Response:
+        self.connections.add(request.transport.get_extra_info("peername"))
+        form = await request.post()
+        self.requests.append(
+            {
+                "to": form.getall("to"),
+                "from": form.get("from"),
+                "subject": form.get("subject"),
+                "text": form.get("text"),
+                "recipient-variables": json.loads(
+                    form.get("recipient-variables", "{}")
+                ),
+            }
+        )
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response(
+            {"id": f"<{len(self.requests)}@fake>", "message": "Queued. Thank you."},
+            status=self.status,
+        )
+
+    @property
+    def emails(self) -> list:
+        """Every delivered email as (to, subject, text) after substitution"""
+        emails = []
+        for message in self.requests:
+            variables = message["recipient-variables"]
+            for to in message["to"]:
+                text = message["text"]
+                for name, value in variables.get(to, {}).items():
+                    text = text.replace(f"%recipient.{name}%", value)
+                emails.append((to, message["subject"], text))
+        return emails
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/v3/fake.example.com/messages"
+        return self.url
+
+    async def stop(self):
+        await self._runner.cleanup()
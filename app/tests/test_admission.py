@@ -0,0 +1,143 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+from starlette.responses import PlainTextResponse
+
+from app import admission
+from app.tests.conftest import run
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+async def call(app, path: str) -> dict:
+    """Make a GET request straight to an ASGI app, returning the response
+    start message"""
+    scope = {"type": "http", "method": "GET", "path": path, "headers": []}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = messages[0]
+    return {"status": start["status"], "headers": dict(start["headers"])}
+
+
+def slow_app(release: asyncio.Event):
+    async def app(scope, receive, send):
+        await release.wait()
+        await PlainTextResponse("ok")(scope, receive, send)
+
+    return app
+
+
+def test_limiter_queues_beyond_concurrency_in_order():
+    limiter = admission.Limiter("test-order", 1, 10)
+    admitted = []
+
+    async def hold(name):
+        await limiter.acquire()
+        admitted.append(name)
+        await asyncio.sleep(0)
+        limiter.release()
+
+    run(asyncio.gather(*(hold(i) for i in range(5))))
+
+    assert admitted == [0, 1, 2, 3, 4]
+    assert (limiter.active, limiter.queued) == (0, 0)
+
+
+def test_full_queue_is_shed():
+    limiter = admission.Limiter("test-full", 1, 1)
+    before = sample("admission_shed_total", group="test-full", reason="queue_full")
+
+    async def overfill():
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(admission.Overloaded):
+            await limiter.acquire()
+        limiter.release()
+        await waiting
+        limiter.release()
+
+    run(overfill())
+
+    assert (
+        sample("admission_shed_total", group="test-full", reason="queue_full")
+        == before + 1
+    )
+    assert (limiter.active, limiter.queued) == (0, 0)
+
+
+def test_wait_times_out():
+    limiter = admission.Limiter("test-timeout", 1, 10, timeout=0.01)
+
+    async def wait_too_long():
+        await limiter.acquire()
+        with pytest.raises(admission.Overloaded):
+            await limiter.acquire()
+        limiter.release()
+
+    run(wait_too_long())
+
+    assert (limiter.active, limiter.queued) == (0, 0)
+    assert sample("admission_shed_total", group="test-timeout", reason="timeout")
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    limiter = admission.Limiter("test-cancel", 1, 1)
+
+    async def cancel_waiter():
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert limiter.queued == 0
+        limiter.release()
+
+    run(cancel_waiter())
+
+    assert limiter.active == 0
+
+
+def test_middleware_sheds_busy_group_only():
+    release = asyncio.Event()
+    limiters = {
+        "hash": admission.Limiter("test-hash", 1, 1),
+        "default": admission.Limiter("test-default", 1, 1),
+    }
+    app = admission.AdmissionMiddleware(
+        slow_app(release),
+        limiters,
+        {"/auth/confirm": "hash", "/metrics": None},
+        retry_after=2,
+    )
+
+    async def spike():
+        held = [asyncio.ensure_future(call(app, "/auth/confirm")) for _ in range(2)]
+        await asyncio.sleep(0)
+        shed = await call(app, "/auth/confirm")
+        cheap = asyncio.ensure_future(call(app, "/auth/me"))
+        unlimited = asyncio.ensure_future(call(app, "/metrics"))
+        await asyncio.sleep(0)
+        release.set()
+        return shed, await asyncio.gather(*held, cheap, unlimited)
+
+    shed, handled = run(spike())
+
+    assert shed["status"] == 503
+    assert shed["headers"][b"retry-after"] == b"2"
+    assert [response["status"] for response in handled] == [200] * 4
+
+
+def test_parse_limit():
+    assert admission.parse_limit("8/64") == (8, 64)
+    assert admission.parse_limit("off") is None
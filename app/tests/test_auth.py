@@ -5,7 +5,9 @@ import pytest
 from _pytest.monkeypatch import MonkeyPatch
 from starlette.testclient import TestClient
 
-from app.auth import security
+from app.auth import crud, indexes, models, security
+from app.resources import resources
+from app.tests.conftest import run
 
 
 @pytest.fixture
@@ -23,7 +25,7 @@ def test_register(
     test_client: TestClient, user_data: dict, monkeypatch: MonkeyPatch, async_db, db
 ):
     """Test creating a new user"""
-    monkeypatch.setattr("app.auth.crud.db", async_db)
+    monkeypatch.setattr(resources, "db", async_db)
     response = test_client.post("/auth/register", json=user_data)
 
     assert response.status_code == 201
@@ -32,11 +34,52 @@ def test_register(
     assert user_in_db["full_name"] == user_data["full_name"]
 
 
+def test_register_duplicate_fails(
+    test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db, db
+):
+    monkeypatch.setattr(resources, "db", async_db)
+    run(indexes.ensure_indexes(async_db))
+    response = test_client.post(
+        "/auth/register", json={"email": user1["email"], "full_name": "Other"}
+    )
+
+    assert response.status_code == 400
+    assert db.users.count_documents({}) == 1
+
+
+def test_register_bulk(
+    test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db, db
+):
+    monkeypatch.setattr(resources, "db", async_db)
+    run(indexes.ensure_indexes(async_db))
+    response = test_client.post(
+        "/auth/register/bulk",
+        json=[
+            {"email": "new@rickhenry.dev", "full_name": "New Person"},
+            {"email": user1["email"]},
+            {"email": "not an email"},
+            {"email": "new@rickhenry.dev"},
+        ],
+    )
+
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()] == [
+        "created",
+        "duplicate",
+        "invalid",
+        "duplicate",
+    ]
+    assert db.users.count_documents({}) == 2
+    assert (
+        db.users.find_one({"email": "new@rickhenry.dev"})["full_name"] == "New Person"
+    )
+
+
 def test_request_login(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
     """Test request login sends email"""
-    monkeypatch.setattr("app.auth.crud.db", async_db)
+    monkeypatch.setattr(resources, "db", async_db)
     monkeypatch.setattr(secrets, "choice", lambda args: "1")
 
     async def fake_send_email(to, subject, text):
@@ -53,7 +96,7 @@ def test_request_login(
 def test_request_magic_link(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
+    monkeypatch.setattr(resources, "db", async_db)
     monkeypatch.setattr(secrets, "token_urlsafe", lambda: "123456789")
     hostname = os.getenv("HOSTNAME", "localhost")
 
@@ -72,8 +115,8 @@ def test_request_magic_link(
 def test_confirm_login(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
-    otp = security.generate_otp(user1["email"])
+    monkeypatch.setattr(resources, "db", async_db)
+    otp = run(security.generate_otp(user1["email"]))
 
     response = test_client.post(
         "/auth/confirm", json={"email": user1["email"], "code": otp}
@@ -86,8 +129,8 @@ def test_confirm_login(
 def test_confirm_login_wrong_code_fails(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
-    _otp = security.generate_otp(user1["email"])
+    monkeypatch.setattr(resources, "db", async_db)
+    _otp = run(security.generate_otp(user1["email"]))
 
     response = test_client.post(
         "/auth/confirm", json={"email": user1["email"], "code": "123456"}
@@ -100,8 +143,8 @@ def test_confirm_login_wrong_code_fails(
 def test_confirm_login_wrong_email_fails(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
-    otp = security.generate_otp(user1["email"])
+    monkeypatch.setattr(resources, "db", async_db)
+    otp = run(security.generate_otp(user1["email"]))
 
     response = test_client.post(
         "/auth/confirm", json={"email": "fail@rickhenry.dev", "code": otp}
@@ -114,8 +157,8 @@ def test_confirm_login_wrong_email_fails(
 def test_confirm_magic(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
-    magic_url = security.generate_magic_link(user1["email"])
+    monkeypatch.setattr(resources, "db", async_db)
+    magic_url = run(security.generate_magic_link(user1["email"]))
     url_secret = magic_url.split("=")[-1]
     response = test_client.post(
         "/auth/confirm-magic", json={"email": user1["email"], "secret": url_secret}
@@ -128,8 +171,8 @@ def test_confirm_magic(
 def test_confirm_magic_wrong_email_fails(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
-    magic_url = security.generate_magic_link(user1["email"])
+    monkeypatch.setattr(resources, "db", async_db)
+    magic_url = run(security.generate_magic_link(user1["email"]))
     url_secret = magic_url.split("=")[-1]
     response = test_client.post(
         "/auth/confirm-magic",
@@ -143,8 +186,8 @@ def test_confirm_magic_wrong_email_fails(
 def test_confirm_magic_wrong_secret_fails(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
-    magic_url = security.generate_magic_link(user1["email"])
+    monkeypatch.setattr(resources, "db", async_db)
+    magic_url = run(security.generate_magic_link(user1["email"]))
     url_secret = magic_url.split("=")[-1]
     response = test_client.post(
         "/auth/confirm-magic", json={"email": user1["email"], "secret": "123456789"}
@@ -157,8 +200,8 @@ def test_confirm_magic_wrong_secret_fails(
 def test_logged_in_get_user_info(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
-    otp = security.generate_otp(user1["email"])
+    monkeypatch.setattr(resources, "db", async_db)
+    otp = run(security.generate_otp(user1["email"]))
 
     _response = test_client.post(
         "/auth/confirm", json={"email": user1["email"], "code": otp}
@@ -172,7 +215,7 @@ def test_logged_in_get_user_info(
 def test_not_logged_in_cant_get_user_info(
     test_client: TestClient, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
+    monkeypatch.setattr(resources, "db", async_db)
     response = test_client.get("/auth/me")
 
     assert response.status_code == 401
@@ -181,8 +224,8 @@ def test_not_logged_in_cant_get_user_info(
 def test_log_out(
     test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
 ):
-    monkeypatch.setattr("app.auth.crud.db", async_db)
-    otp = security.generate_otp(user1["email"])
+    monkeypatch.setattr(resources, "db", async_db)
+    otp = run(security.generate_otp(user1["email"]))
 
     response = test_client.post(
         "/auth/confirm", json={"email": user1["email"], "code": otp}
@@ -198,3 +241,82 @@ def test_log_out(
     response3 = test_client.get("/auth/me")
 
     assert response3.status_code == 401
+
+
+def test_disabled_user_loses_access(
+    test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
+):
+    monkeypatch.setattr(resources, "db", async_db)
+    otp = run(security.generate_otp(user1["email"]))
+    test_client.post("/auth/confirm", json={"email": user1["email"], "code": otp})
+
+    assert test_client.get("/auth/me").status_code == 200
+    assert user1["email"] in crud.user_cache
+
+    run(crud.update_user(user1["email"], {"disabled": True}))
+
+    assert test_client.get("/auth/me").status_code == 400
+
+
+def test_introspect(
+    test_client: TestClient,
+    user1: dict,
+    monkeypatch: MonkeyPatch,
+    async_db,
+    db,
+    introspect_headers,
+):
+    monkeypatch.setattr(resources, "db", async_db)
+    db.users.insert_one({"email": "disabled@rickhenry.dev", "disabled": True})
+    tokens = [
+        security.create_access_token(data={"sub": email})
+        for email in (
+            user1["email"],
+            "disabled@rickhenry.dev",
+            "nobody@rickhenry.dev",
+            user1["email"],
+        )
+    ]
+
+    response = test_client.post(
+        "/auth/introspect",
+        json={"tokens": tokens + ["not-a-token"]},
+        headers=introspect_headers,
+    )
+
+    results = response.json()
+    assert response.status_code == 200
+    assert [result["active"] for result in results] == [True, False, False, True, False]
+    assert results[0]["claims"]["sub"] == user1["email"]
+
+
+def test_request_then_confirm_login(
+    test_client: TestClient, user1: dict, monkeypatch: MonkeyPatch, async_db
+):
+    monkeypatch.setattr(resources, "db", async_db)
+    sent = {}
+
+    async def fake_send_email(to, subject, text):
+        sent["otp"] = text.split()[-1]
+
+    monkeypatch.setattr("app.auth.router.send_email", fake_send_email)
+    test_client.post("/auth/request", json={"email": user1["email"]})
+    stored = run(resources.otps.get(user1["email"]))
+
+    response = test_client.post(
+        "/auth/confirm", json={"email": user1["email"], "code": sent["otp"]}
+    )
+
+    assert models.SecretRecord.parse_raw(stored).email == user1["email"]
+    assert response.status_code == 200
+    assert response.cookies.get("token") is not None
+
+
+def test_registered_user_is_read_from_primary(
+    test_client: TestClient, user_data: dict, monkeypatch: MonkeyPatch, async_db
+):
+    monkeypatch.setattr(resources, "db", async_db)
+    test_client.post("/auth/register", json=user_data)
+
+    assert user_data["email"] in crud.recently_written
+    assert run(crud.get_user_by_email(user_data["email"])).email == user_data["email"]
@@ -0,0 +1,149 @@
+import asyncio
+import uuid
+
+import pytest
+from redis import asyncio as aioredis
+
+from app.auth import bloom, crud
+from app.resources import resources
+from app.tests.conftest import run
+
+
+async def count_users() -> int:
+    return 1
+
+
+async def scan_emails():
+    yield "old@example.com"
+
+
+class NoDatabase:
+    def __getattr__(self, name):
+        raise AssertionError("The database was queried")
+
+
+def test_added_items_are_always_found():
+    emails = [f"{i}@example.com" for i in range(1000)]
+    bloom_filter = bloom.BloomFilter(1000, 0.01)
+    for email in emails:
+        bloom_filter.add(email)
+
+    assert all(email in bloom_filter for email in emails)
+
+
+def test_false_positives_stay_near_the_error_rate():
+    bloom_filter = bloom.BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom_filter.add(f"{i}@example.com")
+
+    false_positives = sum(f"{i}@other.com" in bloom_filter for i in range(10000))
+
+    assert false_positives / 10000 < 0.02
+    assert bloom_filter.false_positive_rate() == pytest.approx(0.01, rel=0.1)
+    # 9.6 bits and 7 hashes per item are optimal for 1%.
+    assert bloom_filter.nbytes == pytest.approx(12000, rel=0.01)
+    assert bloom_filter.hashes == 7
+
+
+def test_every_email_might_exist_until_built():
+    emails = bloom.RegisteredEmails("local", capacity=100)
+
+    assert emails.might_exist("new@example.com")
+
+    run(emails.build(1, scan_emails()))
+
+    assert emails.might_exist("old@example.com")
+    assert not emails.might_exist("new@example.com")
+
+
+def test_local_registrations_are_added():
+    emails = bloom.RegisteredEmails("local", capacity=100)
+    run(emails.build(1, scan_emails()))
+
+    run(emails.add(["new@example.com"]))
+
+    assert emails.might_exist("new@example.com")
+
+
+def test_shared_registrations_are_added_before_being_published(registered_emails):
+    emails = bloom.RegisteredEmails("shared", registered_emails.client, capacity=100)
+    run(emails.build(1, scan_emails()))
+
+    run(emails.add(["new@example.com"]))
+
+    assert emails.might_exist("new@example.com")
+
+
+def test_registrations_are_published_whatever_the_mode(registered_emails):
+    async def add_and_listen():
+        pubsub = registered_emails.client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(registered_emails.channel)
+        await registered_emails.add(["new@example.com", "other@example.com"])
+        for _ in range(10):
+            message = await pubsub.get_message(timeout=0.1)
+            if message is not None:
+                return message["data"]
+
+    assert run(add_and_listen()) == b"new@example.com\nother@example.com"
+
+
+def test_recently_written_emails_skip_the_filter(monkeypatch):
+    emails = bloom.RegisteredEmails("local", capacity=100)
+    run(emails.build(1, scan_emails()))
+    monkeypatch.setattr(resources, "registered_emails", emails)
+
+    class Primary:
+        async def find_one(self, query, projection):
+            return {"email": query["email"]}
+
+    monkeypatch.setattr(crud, "primary_users", Primary)
+    crud._written(["new@example.com"])
+
+    assert run(crud.get_user_by_email("new@example.com")).email == "new@example.com"
+
+
+def test_unknown_email_is_not_looked_up(monkeypatch):
+    emails = bloom.RegisteredEmails("local", capacity=100)
+    run(emails.build(1, scan_emails()))
+    monkeypatch.setattr(resources, "registered_emails", emails)
+    monkeypatch.setattr(resources, "db", NoDatabase())
+
+    assert run(crud.get_user_by_email("new@example.com")) is None
+    assert run(crud.get_cached_users_by_email(["new@example.com"])) == {}
+
+
+def test_shared_registrations_reach_every_worker(redis_server):
+    channel = str(uuid.uuid4())
+    workers = [
+        bloom.RegisteredEmails(
+            "shared", aioredis.Redis(port=redis_server), capacity=100, channel=channel
+        )
+        for _ in range(2)
+    ]
+
+    async def wait_until(condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise TimeoutError
+
+    async def register():
+        tasks = [
+            asyncio.ensure_future(worker.run(count_users, scan_emails))
+            for worker in workers
+        ]
+        await wait_until(lambda: all(worker.filter for worker in workers))
+        await workers[0].add(["new@example.com"])
+        await wait_until(
+            lambda: all(worker.might_exist("new@example.com") for worker in workers)
+        )
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for worker in workers:
+            await worker.close()
+
+    run(register())
+
+    assert not workers[1].might_exist("other@example.com")
@@ -0,0 +1,76 @@
+from app.auth.cache import TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_get_and_set():
+    cache = TTLCache(maxsize=10)
+    cache.set("a", 1)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.hit_rate == 0.5
+
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert len(cache) == 2
+
+
+def test_entries_expire_after_ttl():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+    cache.set("a", 1)
+    timer.now = 4.9
+
+    assert cache.get("a") == 1
+
+    timer.now = 5
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_explicit_expiry_overrides_ttl():
+    timer = FakeTimer()
+    cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+    cache.set("a", 1, expires_at=1)
+    timer.now = 1
+
+    assert cache.get("a") is None
+
+
+def test_delete_and_clear():
+    cache = TTLCache(maxsize=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.delete("a")
+    cache.delete("missing")
+
+    assert "a" not in cache
+
+    cache.clear()
+
+    assert len(cache) == 0
+
+
+def test_zero_size_disables_cache():
+    cache = TTLCache(maxsize=0)
+    cache.set("a", 1)
+
+    assert cache.get("a") is None
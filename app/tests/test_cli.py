@@ -0,0 +1,108 @@
+import io
+import json
+
+from _pytest.monkeypatch import MonkeyPatch
+
+from app import cli
+from app.auth import indexes
+from app.resources import resources
+from app.tests.conftest import run
+
+
+NDJSON = """{"email": "one@rickhenry.dev", "full_name": "One"}
+
+{"email": "two@rickhenry.dev", "disabled": true}
+{"email": "not an email"}
+"""
+
+CSV = """email,full_name,disabled
+one@rickhenry.dev,One,
+two@rickhenry.dev,,true
+"""
+
+
+def test_read_ndjson():
+    records = list(cli.read_records(io.StringIO(NDJSON), "ndjson"))
+
+    assert records == [
+        {"email": "one@rickhenry.dev", "full_name": "One"},
+        {"email": "two@rickhenry.dev", "disabled": True},
+        {"email": "not an email"},
+    ]
+
+
+def test_malformed_lines_are_rejected():
+    rejects = io.StringIO()
+    progress = cli.Progress("imported", io.StringIO())
+
+    counts = run(
+        cli.import_users(
+            io.StringIO('{"email": \nnot json\n'),
+            "ndjson",
+            rejects=rejects,
+            progress=progress,
+        )
+    )
+
+    assert counts == {"invalid": 2, "created": 0, "duplicate": 0}
+    assert [json.loads(line)["record"] for line in rejects.getvalue().splitlines()] == [
+        '{"email": ',
+        "not json",
+    ]
+
+
+def test_read_csv_skips_empty_cells():
+    records = list(cli.read_records(io.StringIO(CSV), "csv"))
+
+    assert records == [
+        {"email": "one@rickhenry.dev", "full_name": "One"},
+        {"email": "two@rickhenry.dev", "disabled": "true"},
+    ]
+
+
+def test_chunked():
+    assert list(cli.chunked(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_import_and_export(monkeypatch: MonkeyPatch, async_db, db):
+    monkeypatch.setattr(resources, "db", async_db)
+    run(indexes.ensure_indexes(async_db))
+    db.users.insert_one({"email": "one@rickhenry.dev"})
+    rejects = io.StringIO()
+    progress = cli.Progress("imported", io.StringIO())
+
+    counts = run(
+        cli.import_users(
+            io.StringIO(NDJSON),
+            "ndjson",
+            chunk_size=1,
+            rejects=rejects,
+            progress=progress,
+        )
+    )
+
+    assert counts == {"created": 1, "duplicate": 1, "invalid": 1}
+    assert json.loads(rejects.getvalue())["record"] == {"email": "not an email"}
+    assert db.users.find_one({"email": "two@rickhenry.dev"})["disabled"]
+
+    exported = io.StringIO()
+    run(cli.export_users(exported, "csv", progress=cli.Progress("", io.StringIO())))
+
+    assert exported.getvalue().splitlines() == [
+        "email,full_name,disabled",
+        "one@rickhenry.dev,,",
+        "two@rickhenry.dev,,True",
+    ]
+
+
+def test_import_upsert(monkeypatch: MonkeyPatch, async_db, db):
+    monkeypatch.setattr(resources, "db", async_db)
+    db.users.insert_one({"email": "one@rickhenry.dev"})
+    progress = cli.Progress("imported", io.StringIO())
+
+    counts = run(
+        cli.import_users(io.StringIO(CSV), "csv", upsert=True, progress=progress)
+    )
+
+    assert counts == {"invalid": 0, "created": 1, "updated": 1}
+    assert db.users.find_one({"email": "one@rickhenry.dev"})["full_name"] == "One"
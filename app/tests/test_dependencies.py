@@ -0,0 +1,67 @@
+import logging
+from types import SimpleNamespace
+
+from motor import motor_asyncio
+from prometheus_client import REGISTRY
+
+from app import dependencies
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_unset_options_are_left_to_the_driver(monkeypatch):
+    monkeypatch.setattr(dependencies, "MONGO_COMPRESSORS", "zlib")
+
+    options = dependencies.client_options()
+
+    assert options["compressors"] == "zlib"
+    assert options["readPreference"] == "secondaryPreferred"
+    assert "socketTimeoutMS" not in options
+
+
+def test_client_accepts_options(monkeypatch):
+    monkeypatch.setattr(dependencies, "MONGO_COMPRESSORS", "zlib")
+    monkeypatch.setattr(dependencies, "MONGO_MAX_STALENESS_SECONDS", 120)
+    monkeypatch.setattr(dependencies, "MONGO_WAIT_QUEUE_TIMEOUT_MS", 500)
+
+    client = motor_asyncio.AsyncIOMotorClient(
+        "mongodb://localhost", connect=False, **dependencies.client_options()
+    )
+
+    assert client.read_preference.document == {
+        "mode": "secondaryPreferred",
+        "maxStalenessSeconds": 120,
+    }
+
+
+def test_uri_read_preference_is_kept_when_unset(monkeypatch):
+    monkeypatch.setattr(dependencies, "MONGO_READ_PREFERENCE", None)
+
+    client = motor_asyncio.AsyncIOMotorClient(
+        "mongodb://localhost/?readPreference=nearest",
+        connect=False,
+        **dependencies.client_options(),
+    )
+
+    assert client.read_preference.document == {"mode": "nearest"}
+
+
+def test_query_listener_counts_commands_by_node(caplog):
+    listener = dependencies.QueryListener(log_queries=True)
+    event = SimpleNamespace(
+        command_name="find", connection_id=("db-2", 27017), duration_micros=1500
+    )
+    before = sample(
+        "mongo_commands_total", command="find", node="db-2:27017", outcome="ok"
+    )
+
+    with caplog.at_level(logging.INFO):
+        listener.succeeded(event)
+
+    assert (
+        sample("mongo_commands_total", command="find", node="db-2:27017", outcome="ok")
+        == before + 1
+    )
+    assert "mongo find on db-2:27017 ok in 1.50ms" in caplog.text
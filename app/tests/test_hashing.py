@@ -0,0 +1,73 @@
+import pytest
+
+from app.auth import hashing
+from app.resources import resources
+from app.tests.conftest import run
+
+
+@pytest.fixture(params=["inline", "process", "hmac"])
+def backend(request, monkeypatch):
+    monkeypatch.setenv("HASH_HMAC_KEY", "test-key")
+    backend = hashing.get_backend(request.param)
+    yield backend
+    backend.shutdown()
+
+
+def test_hash_and_verify(backend: hashing.HashBackend):
+    secret_hash = run(backend.hash("abcd1234"))
+
+    assert secret_hash != "abcd1234"
+    assert run(backend.verify("abcd1234", secret_hash))
+    assert run(backend.verify("abcd1234", secret_hash.encode("utf-8")))
+
+
+def test_wrong_secret_fails(backend: hashing.HashBackend):
+    secret_hash = run(backend.hash("abcd1234"))
+
+    assert not run(backend.verify("abcd1235", secret_hash))
+
+
+def test_backends_must_hash_and_verify():
+    class HashOnly(hashing.HashBackend):
+        async def hash(self, secret: str) -> str:
+            return secret
+
+    with pytest.raises(TypeError):
+        HashOnly()
+
+
+def test_digest_from_other_backend_fails():
+    hmac_backend = hashing.HMACBackend("test-key")
+    inline_backend = hashing.InlineBackend()
+
+    bcrypt_hash = run(inline_backend.hash("abcd1234"))
+    hmac_hash = run(hmac_backend.hash("abcd1234"))
+
+    assert not run(hmac_backend.verify("abcd1234", bcrypt_hash))
+    assert not run(inline_backend.verify("abcd1234", hmac_hash))
+
+
+def test_hmac_depends_on_key():
+    secret_hash = run(hashing.HMACBackend("key-one").hash("abcd1234"))
+
+    assert not run(hashing.HMACBackend("key-two").verify("abcd1234", secret_hash))
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        hashing.get_backend("md5")
+
+
+def test_process_pool_is_shut_down_with_resources(monkeypatch):
+    # Only this backend is closed, not the resources other tests replaced.
+    monkeypatch.setattr(resources, "_created", {})
+    backend = hashing.get_backend("process")
+    resources.hash_backend = backend
+    run(backend.hash("abcd1234"))
+    executor = backend.executor
+
+    run(resources.close())
+
+    assert backend._executor is None
+    with pytest.raises(RuntimeError):
+        executor.submit(print)
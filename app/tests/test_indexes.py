@@ -0,0 +1,86 @@
+import pymongo
+import pytest
+
+from app.auth import indexes
+from app.tests.conftest import run
+
+
+def test_creates_declared_indexes(db, async_db):
+    run(indexes.ensure_indexes(async_db))
+
+    info = db.users.index_information()
+    assert info["email"]["key"] == [("email", 1)]
+    assert info["email"]["unique"]
+
+
+def test_drops_retired_and_changed_indexes(db, async_db):
+    db.users.create_index("username", unique=True)
+    db.users.create_index("email", name="email")
+
+    run(indexes.ensure_indexes(async_db))
+
+    info = db.users.index_information()
+    assert set(info) == {"_id_", "email"}
+    assert info["email"]["unique"]
+
+
+def test_reconcile_is_idempotent(db, async_db):
+    run(indexes.ensure_indexes(async_db))
+    run(indexes.ensure_indexes(async_db))
+
+    db.users.insert_one({"email": "test@rickhenry.dev"})
+    with pytest.raises(pymongo.errors.DuplicateKeyError):
+        db.users.insert_one({"email": "test@rickhenry.dev"})
+
+
+class Users:
+    """Users collection holding the declared index, a retired one and one
+    made by hand"""
+
+    def __init__(self):
+        self.dropped = []
+        self.created = []
+
+    async def index_information(self):
+        return {
+            "_id_": {"key": [("_id", 1)]},
+            "email": {"key": [("email", 1)], "unique": True},
+            "username_1": {"key": [("username", 1)]},
+            "by_hand": {"key": [("full_name", 1)]},
+        }
+
+    async def drop_index(self, name):
+        self.dropped.append(name)
+
+    async def create_indexes(self, models):
+        self.created.extend(models)
+
+
+def test_indexes_made_by_hand_are_kept(caplog):
+    users = Users()
+
+    run(indexes.ensure_indexes({"users": users}, drop_undeclared=False))
+
+    assert users.dropped == ["username_1"]
+    assert users.created == []
+    assert "Keeping undeclared index by_hand on users" in caplog.text
+
+
+def test_undeclared_indexes_can_be_dropped():
+    users = Users()
+
+    run(indexes.ensure_indexes({"users": users}, drop_undeclared=True))
+
+    assert users.dropped == ["username_1", "by_hand"]
+
+
+def test_index_dropped_by_another_worker_is_ignored():
+    class Raced(Users):
+        async def drop_index(self, name):
+            raise pymongo.errors.OperationFailure("index not found", code=27)
+
+    users = Raced()
+
+    run(indexes.ensure_indexes({"users": users}))
+
+    assert users.created == []
@@ -0,0 +1,120 @@
+import base64
+
+import jwt
+import pytest
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from starlette.requests import Request
+
+from app.auth import keys
+from app.tests.conftest import run
+
+
+def get(endpoint, headers: dict = None):
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/.well-known/jwks.json",
+        "headers": [
+            (name.lower().encode(), value.encode())
+            for name, value in (headers or {}).items()
+        ],
+    }
+    return run(endpoint(Request(scope)))
+
+
+def decode_coordinate(value: str) -> int:
+    return int.from_bytes(base64.urlsafe_b64decode(value + "=="), "big")
+
+
+def publish_only(keys_dir, kid: str):
+    """Replace a private key with its public key, as when retiring it"""
+    path = keys_dir / f"{kid}.pem"
+    key = keys.load_pem(path.read_bytes())
+    path.write_bytes(
+        key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+    )
+
+
+def test_es256_tokens_name_their_key(tmp_path):
+    keys.generate("2019-09", tmp_path)
+    key_set = keys.load_keys("ES256", keys_dir=tmp_path)
+
+    token = key_set.encode({"sub": "test@rickhenry.dev"})
+
+    assert jwt.get_unverified_header(token)["kid"] == "2019-09"
+    assert key_set.decode(token)["sub"] == "test@rickhenry.dev"
+
+
+def test_rotation_keeps_old_keys_verifying(tmp_path):
+    keys.generate("2019-09", tmp_path)
+    old_token = keys.load_keys("ES256", keys_dir=tmp_path).encode({"sub": "old"})
+    keys.generate("2019-10", tmp_path)
+    publish_only(tmp_path, "2019-09")
+
+    key_set = keys.load_keys("ES256", keys_dir=tmp_path)
+
+    assert key_set.signing_kid == "2019-10"
+    assert key_set.decode(old_token)["sub"] == "old"
+    assert [key["kid"] for key in key_set.jwks()["keys"]] == ["2019-09", "2019-10"]
+
+
+def test_signing_kid_must_have_private_key(tmp_path):
+    keys.generate("2019-09", tmp_path)
+    publish_only(tmp_path, "2019-09")
+
+    with pytest.raises(ValueError):
+        keys.load_keys("ES256", keys_dir=tmp_path)
+
+
+def test_unknown_kid_is_rejected(tmp_path):
+    keys.generate("2019-09", tmp_path / "other")
+    keys.generate("2019-09", tmp_path / "ours")
+    token = keys.load_keys("ES256", keys_dir=tmp_path / "other").encode({"sub": "x"})
+    forged = keys.load_keys("ES256", keys_dir=tmp_path / "ours")
+
+    with pytest.raises(jwt.InvalidTokenError):
+        forged.decode(token)
+    with pytest.raises(jwt.InvalidTokenError):
+        forged.decode(jwt.encode({"sub": "x"}, "secret").decode("utf-8"))
+
+
+def test_jwks_verifies_tokens(tmp_path):
+    keys.generate("2019-09", tmp_path)
+    key_set = keys.load_keys("ES256", keys_dir=tmp_path)
+    token = key_set.encode({"sub": "test@rickhenry.dev"})
+    (jwk,) = key_set.jwks()["keys"]
+
+    public_key = ec.EllipticCurvePublicNumbers(
+        decode_coordinate(jwk["x"]), decode_coordinate(jwk["y"]), ec.SECP256R1()
+    ).public_key(default_backend())
+
+    assert jwt.decode(token, public_key, algorithms=["ES256"])["sub"]
+
+
+def test_shared_secret_publishes_nothing():
+    key_set = keys.load_keys("HS256", secret_key="secret")
+
+    token = key_set.encode({"sub": "test@rickhenry.dev"})
+
+    assert "kid" not in jwt.get_unverified_header(token)
+    assert key_set.decode(token)["sub"] == "test@rickhenry.dev"
+    assert key_set.jwks() == {"keys": []}
+
+
+def test_jwks_endpoint_is_cacheable(tmp_path):
+    keys.generate("2019-09", tmp_path)
+    endpoint = keys.jwks_endpoint(
+        lambda: keys.load_keys("ES256", keys_dir=tmp_path), 600
+    )
+
+    response = get(endpoint)
+    not_modified = get(endpoint, {"If-None-Match": response.headers["etag"]})
+
+    assert response.status_code == 200
+    assert response.headers["cache-control"] == "public, max-age=600"
+    assert b'"kid":"2019-09"' in response.body
+    assert not_modified.status_code == 304
@@ -0,0 +1,139 @@
+import asyncio
+
+import pytest
+
+from app import mail
+from app.resources import resources
+from app.tests.fake_mailgun import FakeMailgun
+from app.tests.conftest import run
+
+
+@pytest.fixture
+def mailgun():
+    server = FakeMailgun()
+    run(server.start())
+    yield server
+    run(server.stop())
+
+
+def make_client(mailgun: FakeMailgun, **kwargs) -> mail.MailClient:
+    return mail.MailClient(mailgun.url, "key", "Test <test@example.com>", **kwargs)
+
+
+def send_all(client: mail.MailClient, messages: list):
+    async def send():
+        try:
+            return await asyncio.gather(
+                *(client.send(*message) for message in messages), return_exceptions=True
+            )
+        finally:
+            await client.close()
+
+    return run(send())
+
+
+def test_send_single_email(mailgun: FakeMailgun):
+    client = make_client(mailgun)
+    send_all(client, [("a@example.com", "Subject", "Hello")])
+
+    assert mailgun.emails == [("a@example.com", "Subject", "Hello")]
+    assert mailgun.requests[0]["from"] == "Test <test@example.com>"
+
+
+def test_connection_is_reused(mailgun: FakeMailgun):
+    client = make_client(mailgun)
+
+    async def send_sequentially():
+        for i in range(5):
+            await client.send(f"{i}@example.com", "Subject", "Hello")
+        await client.close()
+
+    run(send_sequentially())
+
+    assert len(mailgun.requests) == 5
+    assert len(mailgun.connections) == 1
+
+
+def test_concurrent_emails_are_coalesced(mailgun: FakeMailgun):
+    client = make_client(mailgun, batch_window=0.05)
+    messages = [(f"{i}@example.com", "Subject", f"Code {i}") for i in range(10)]
+    send_all(client, messages)
+
+    assert len(mailgun.requests) == 1
+    assert mailgun.requests[0]["text"] == "%recipient.text%"
+    assert sorted(mailgun.emails) == sorted(messages)
+
+
+def test_batches_are_split_by_subject_and_size(mailgun: FakeMailgun):
+    client = make_client(mailgun, batch_window=0.05, batch_size=3)
+    messages = [(f"{i}@example.com", "One", "Hello") for i in range(4)]
+    messages.append(("a@example.com", "Two", "Hello"))
+    send_all(client, messages)
+
+    assert len(mailgun.requests) == 3
+    assert sorted(mailgun.emails) == sorted(messages)
+
+
+def test_repeat_recipient_gets_both_emails(mailgun: FakeMailgun):
+    client = make_client(mailgun, batch_window=0.05)
+    messages = [
+        ("a@example.com", "Subject", "First"),
+        ("a@example.com", "Subject", "Second"),
+    ]
+    send_all(client, messages)
+
+    assert mailgun.emails == messages
+
+
+@pytest.mark.parametrize("batch_window", [0, 0.05])
+def test_failed_send_raises(mailgun: FakeMailgun, batch_window: float):
+    mailgun.status = 500
+    client = make_client(mailgun, batch_window=batch_window)
+    results = send_all(client, [("a@example.com", "Subject", "Hello")] * 2)
+
+    assert all(isinstance(result, mail.MailError) for result in results)
+
+
+def test_batch_fails_when_mailgun_times_out():
+    slow = FakeMailgun(latency=1)
+    run(slow.start())
+    client = make_client(slow, batch_window=0.01, timeout=0.1)
+    try:
+        results = send_all(
+            client, [(f"{i}@example.com", "Subject", "Hello") for i in range(3)]
+        )
+    finally:
+        run(slow.stop())
+
+    assert [type(result) for result in results] == [mail.MailError] * 3
+
+
+def test_batch_fails_on_unexpected_errors(mailgun: FakeMailgun):
+    client = make_client(mailgun, batch_window=0.01)
+
+    async def closed_session(data):
+        raise RuntimeError("Session is closed")
+
+    client._post = closed_session
+
+    async def send():
+        return await asyncio.wait_for(
+            asyncio.gather(
+                client.send("a@example.com", "Subject", "Hello"),
+                client.send("b@example.com", "Subject", "Hello"),
+                return_exceptions=True,
+            ),
+            timeout=1,
+        )
+
+    assert [type(result) for result in run(send())] == [RuntimeError] * 2
+
+
+def test_starting_resources_opens_no_mail_session(monkeypatch):
+    # Web workers start every resource but only queue emails.
+    monkeypatch.setattr(resources, "_created", {})
+    monkeypatch.setattr(resources, "_factories", {"mail": resources._factories["mail"]})
+
+    run(resources.start())
+
+    assert resources.mail._session is None
@@ -0,0 +1,57 @@
+import pytest
+from prometheus_client import REGISTRY
+from starlette.testclient import TestClient
+
+from app import metrics
+from app.tests.conftest import run
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_timed_records_latency_and_errors():
+    @metrics.timed("test", "ok")
+    async def ok():
+        return 1
+
+    @metrics.timed("test", "fail")
+    async def fail():
+        raise ValueError
+
+    labels = {"dependency": "test", "operation": "fail"}
+    before = sample("dependency_errors_total", **labels)
+
+    assert run(ok()) == 1
+    with pytest.raises(ValueError):
+        run(fail())
+
+    assert sample(
+        "dependency_duration_seconds_count", dependency="test", operation="ok"
+    )
+    assert sample("dependency_errors_total", **labels) == before + 1
+
+
+def test_requests_are_labelled_by_route(test_client: TestClient):
+    labels = {"method": "GET", "route": "/auth/me", "status": "401"}
+    before = sample("http_request_duration_seconds_count", **labels)
+    unmatched = {"method": "GET", "route": "unmatched", "status": "404"}
+    unmatched_before = sample("http_request_duration_seconds_count", **unmatched)
+
+    test_client.get("/auth/me")
+    test_client.get("/no/such/path")
+
+    assert sample("http_request_duration_seconds_count", **labels) == before + 1
+    assert (
+        sample("http_request_duration_seconds_count", **unmatched)
+        == unmatched_before + 1
+    )
+    assert sample("http_requests_in_flight", method="GET", route="/auth/me") == 0
+
+
+def test_metrics_endpoint(test_client: TestClient):
+    response = test_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'cache_hits_total{cache="users"}' in response.text
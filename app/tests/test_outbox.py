@@ -0,0 +1,178 @@
+import asyncio
+import inspect
+import uuid
+
+import pytest
+from redis import asyncio as aioredis
+
+from app import mail, outbox
+from app.tests.fake_mailgun import FakeMailgun
+from app.tests.conftest import run
+
+
+@pytest.fixture
+def mailgun():
+    server = FakeMailgun()
+    run(server.start())
+    yield server
+    run(server.stop())
+
+
+@pytest.fixture
+def mailer(mailgun: FakeMailgun):
+    client = mail.MailClient(mailgun.url, "key", "Test <test@example.com>")
+    yield client
+    run(client.close())
+
+
+@pytest.fixture
+def queue(redis_server):
+    """An outbox on its own streams of the local redis server"""
+    name = str(uuid.uuid4())
+    queue = outbox.Outbox(
+        aioredis.Redis(port=redis_server), f"{name}:outbox", f"{name}:dead", name
+    )
+    run(queue.ensure_group())
+    yield queue
+    run(queue.close())
+
+
+def make_worker(queue: outbox.Outbox, mailer: mail.MailClient, **kwargs):
+    options = {"retry_delay_ms": 10, "poll_ms": 10, **kwargs}
+    return outbox.Worker(queue, mailer, "test", **options)
+
+
+def work_until(worker: outbox.Worker, done, timeout: float = 5):
+    """Run a worker until done returns true, or awaits to true"""
+
+    async def is_done():
+        result = done()
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def work():
+        task = asyncio.ensure_future(worker.run())
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        while not await is_done() and loop.time() < deadline:
+            await asyncio.sleep(0.01)
+        worker.stop()
+        await task
+
+    run(work())
+
+
+def test_enqueue_adds_email_to_stream(mail_outbox: outbox.Outbox):
+    run(mail_outbox.enqueue("a@example.com", "Subject", "Hello"))
+
+    [entry] = run(mail_outbox.client.xrange(mail_outbox.stream))
+
+    assert outbox.Entry(*entry).email() == ("a@example.com", "Subject", "Hello")
+
+
+def test_worker_delivers_queued_emails(queue, mailer, mailgun):
+    for i in range(3):
+        run(queue.enqueue(f"{i}@example.com", "Subject", f"Hello {i}"))
+
+    work_until(make_worker(queue, mailer), lambda: len(mailgun.emails) == 3)
+
+    assert sorted(mailgun.emails) == [
+        (f"{i}@example.com", "Subject", f"Hello {i}") for i in range(3)
+    ]
+    assert run(queue.stats()) == (0, 0, 0, 0)
+
+
+def test_failed_email_is_retried(queue, mailer, mailgun):
+    mailgun.status = 500
+    run(queue.enqueue("a@example.com", "Subject", "Hello"))
+
+    def fail_twice():
+        if len(mailgun.requests) >= 2:
+            mailgun.status = 200
+        return len(mailgun.requests) == 3
+
+    work_until(make_worker(queue, mailer), fail_twice)
+
+    assert len(mailgun.requests) == 3
+    assert run(queue.stats()).pending == 0
+
+
+def test_email_is_dead_lettered_after_max_attempts(queue, mailer, mailgun):
+    mailgun.status = 500
+    run(queue.enqueue("a@example.com", "Subject", "Hello"))
+
+    work_until(
+        make_worker(queue, mailer, max_attempts=3),
+        lambda: queue.client.xlen(queue.dead_stream),
+    )
+
+    [(_id, fields)] = run(queue.client.xrange(queue.dead_stream))
+    assert len(mailgun.requests) == 3
+    assert fields[b"to"] == b"a@example.com"
+    assert fields[b"attempts"] == b"3"
+    assert run(queue.stats()).pending == 0
+
+
+def test_stopped_workers_emails_are_claimed(queue, mailer, mailgun):
+    run(queue.enqueue("a@example.com", "Subject", "Hello"))
+    # Read by a worker that stopped before delivering it.
+    assert run(queue.read("stopped", 10, 10))
+
+    work_until(make_worker(queue, mailer, claim_idle_ms=50), lambda: mailgun.emails)
+
+    assert mailgun.emails == [("a@example.com", "Subject", "Hello")]
+
+
+def test_stats_report_backlog_and_age(queue):
+    run(queue.enqueue("a@example.com", "Subject", "Hello"))
+    run(queue.enqueue("b@example.com", "Subject", "Hello"))
+    run(queue.read("worker", 1, 10))
+
+    stats = run(queue.stats())
+
+    assert (stats.backlog, stats.pending, stats.dead_letters) == (1, 1, 0)
+    assert 0 <= stats.oldest_seconds < 5
+
+
+def test_retries_are_bounded_by_concurrency():
+    class StubOutbox:
+        async def pending(self, count):
+            return [
+                {
+                    "message_id": str(i).encode(),
+                    "consumer": b"test",
+                    "times_delivered": 1,
+                    "time_since_delivered": 10 ** 6,
+                }
+                for i in range(count)
+            ]
+
+        async def claim(self, consumer, min_idle_ms, entry_id):
+            fields = {b"to": b"a@example.com", b"subject": b"Hi", b"text": b"Hi"}
+            return outbox.Entry(entry_id, fields)
+
+    class HangingMailer:
+        async def send(self, *email):
+            await asyncio.Event().wait()
+
+    worker = outbox.Worker(StubOutbox(), HangingMailer(), "test", concurrency=5)
+
+    async def retry():
+        in_flight = []
+        for _ in range(2):
+            await worker.retry_pending()
+            await asyncio.sleep(0)
+            in_flight.append(len(worker._in_flight))
+        for task in worker._tasks:
+            task.cancel()
+        await asyncio.gather(*worker._tasks, return_exceptions=True)
+        return in_flight
+
+    assert run(retry()) == [5, 5]
+
+
+def test_retry_delay_backs_off_to_a_limit(mailer):
+    worker = outbox.Worker(None, mailer, retry_delay_ms=100, retry_max_delay_ms=1000)
+
+    assert [worker.retry_delay(n) for n in range(1, 6)] == [100, 200, 400, 800, 1000]
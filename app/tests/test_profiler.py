@@ -0,0 +1,142 @@
+import asyncio
+import datetime
+import time
+
+import pytest
+from starlette.responses import PlainTextResponse
+
+from app import profiler
+from app.auth import crud, models, security
+from app.tests.conftest import run
+
+
+@pytest.fixture
+def sampler():
+    sampler = profiler.Profiler(interval=0.001)
+    yield sampler
+    sampler.stop()
+
+
+async def call(app, headers=()):
+    scope = {"type": "http", "method": "GET", "path": "/slow", "headers": list(headers)}
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+async def waiting_endpoint(scope, receive, send):
+    await asyncio.sleep(0.05)
+    await PlainTextResponse("ok")(scope, receive, send)
+
+
+async def busy_endpoint(scope, receive, send):
+    deadline = time.perf_counter() + 0.05
+    while time.perf_counter() < deadline:
+        pass
+    await PlainTextResponse("ok")(scope, receive, send)
+
+
+def profile(sampler, endpoint, **options):
+    app = profiler.ProfilerMiddleware(
+        endpoint, routes=[], profiler=sampler, header="X-Profile", **options
+    )
+    run(call(app, [(b"x-profile", b"1")]))
+
+
+def test_waiting_requests_are_sampled_where_they_await(sampler):
+    profile(sampler, waiting_endpoint)
+
+    collapsed = sampler.collapsed()
+
+    assert collapsed.startswith("GET unmatched;waiting_endpoint")
+    assert ";sleep " in collapsed
+
+
+def test_running_requests_are_sampled_from_the_loop_thread(sampler):
+    profile(sampler, busy_endpoint)
+
+    [stacks] = sampler.snapshot().values()
+    stack, count = stacks.most_common(1)[0]
+
+    assert stack[0][0] == "busy_endpoint"
+    assert count > 1
+
+
+def test_only_chosen_requests_are_profiled(sampler):
+    app = profiler.ProfilerMiddleware(
+        waiting_endpoint, routes=[], profiler=sampler, header="X-Profile"
+    )
+
+    run(call(app))
+
+    assert sampler.snapshot() == {}
+    assert profiler.ProfilerMiddleware(app, [], sample_rate=1).wants({})
+
+
+def test_speedscope_weights_samples_by_interval(sampler):
+    profile(sampler, waiting_endpoint)
+
+    speedscope = sampler.speedscope()
+
+    [profile_] = speedscope["profiles"]
+    frames = speedscope["shared"]["frames"]
+    total = sum(sampler.snapshot()["GET unmatched"].values())
+    assert profile_["name"] == "GET unmatched"
+    assert sum(profile_["weights"]) == pytest.approx(total * 1)
+    assert all(0 <= i < len(frames) for sample in profile_["samples"] for i in sample)
+
+
+def test_distinct_stacks_are_capped(sampler):
+    sampler.max_stacks = 1
+    profile(sampler, waiting_endpoint)
+    profile(sampler, busy_endpoint)
+
+    [stacks] = sampler.snapshot().values()
+
+    assert len(stacks) == 2
+    assert profiler.TRUNCATED in stacks
+
+
+@pytest.fixture
+def admin_client(test_client, monkeypatch):
+    async def get_user(email):
+        return models.UserInDB(email=email)
+
+    monkeypatch.setattr(crud, "get_cached_user_by_email", get_user)
+    monkeypatch.setattr(security, "ADMIN_EMAILS", {"admin@rickhenry.dev"})
+    profiler.profiler.clear()
+    profiler.profiler._record("GET /auth/me", [])
+
+    def login(email):
+        token = security.create_access_token(
+            data={"sub": email}, expires_delta=datetime.timedelta(minutes=5)
+        )
+        test_client.cookies["token"] = token
+        return test_client
+
+    yield login
+    profiler.profiler.clear()
+
+
+def test_profile_is_for_admins_only(admin_client):
+    response = admin_client("test@rickhenry.dev").get("/admin/profile")
+
+    assert response.status_code == 403
+
+
+def test_admin_downloads_profile(admin_client):
+    client = admin_client("admin@rickhenry.dev")
+
+    collapsed = client.get("/admin/profile", params={"format": "collapsed"})
+    speedscope = client.get("/admin/profile", params={"route": "GET /auth/me"})
+    cleared = client.delete("/admin/profile")
+
+    assert collapsed.text == "GET /auth/me 1\n"
+    assert speedscope.json()["profiles"][0]["name"] == "GET /auth/me"
+    assert cleared.status_code == 200
+    assert profiler.profiler.snapshot() == {}
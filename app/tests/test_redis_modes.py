@@ -0,0 +1,136 @@
+import asyncio
+
+import pytest
+from redis.exceptions import ConnectionError
+
+from app.auth import security, sessions, store
+from app.resources import resources
+from app.tests.conftest import redis_cli, run, wait_for
+
+
+@pytest.fixture
+def cluster_client(redis_cluster, monkeypatch):
+    monkeypatch.setattr(store, "REDIS_HOST", "127.0.0.1")
+    monkeypatch.setattr(store, "REDIS_PORT", redis_cluster)
+    client = store.create_client(mode="cluster")
+    yield client
+    run(store.close_client(client))
+
+
+@pytest.fixture
+def sentinel_client(redis_sentinel, monkeypatch):
+    monkeypatch.setattr(store, "REDIS_SENTINELS", f"127.0.0.1:{redis_sentinel}")
+    client = store.create_client(db=1, mode="sentinel")
+    yield client
+    run(store.close_client(client))
+
+
+def use_stores(client, monkeypatch):
+    monkeypatch.setattr(resources, "otps", store.SecretStore("otp", client))
+    monkeypatch.setattr(
+        resources, "url_secrets", store.SecretStore("url_secret", client)
+    )
+
+
+def test_parse_sentinels():
+    assert store.parse_sentinels("a:26379, b:26380") == [("a", 26379), ("b", 26380)]
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        store.create_client(mode="memcached")
+
+
+def test_cluster_keeps_stores_apart_by_prefix(cluster_client, monkeypatch):
+    use_stores(cluster_client, monkeypatch)
+    otp = run(security.generate_otp("test@rickhenry.dev"))
+    run(security.generate_magic_link("test@rickhenry.dev"))
+
+    assert not run(security.verify_otp("test@rickhenry.dev", "wrong"))
+    assert run(security.verify_otp("test@rickhenry.dev", otp))
+    assert not run(security.verify_otp("test@rickhenry.dev", otp))
+    assert run(resources.url_secrets.get("test@rickhenry.dev")) is not None
+
+
+def test_cluster_spreads_secrets_across_nodes(cluster_client, monkeypatch):
+    use_stores(cluster_client, monkeypatch)
+    emails = [f"{i}@rickhenry.dev" for i in range(50)]
+    for email in emails:
+        run(security.generate_otp(email))
+
+    sizes = [
+        run(cluster_client.dbsize(target_nodes=node))
+        for node in cluster_client.get_primaries()
+    ]
+
+    assert len([size for size in sizes if size]) > 1
+
+
+def test_cluster_refresh_tokens(cluster_client):
+    tokens = sessions.RefreshTokens(cluster_client)
+    token = run(tokens.issue("test@rickhenry.dev"))
+
+    rotated = run(tokens.rotate(token))
+
+    assert rotated.email == "test@rickhenry.dev"
+    assert run(tokens.rotate(token)) is None
+    assert run(tokens.rotate(rotated.token)) is None
+
+
+def test_cluster_pubsub_hears_messages_published_on_any_node(cluster_client):
+    subscriber = store.create_pubsub_client(mode="cluster")
+
+    async def publish_and_listen():
+        pubsub = subscriber.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe("news")
+        await cluster_client.initialize()
+        for node in cluster_client.get_primaries():
+            await cluster_client.execute_command(
+                "PUBLISH", "news", node.name, target_nodes=node
+            )
+        received = set()
+        for _ in range(20):
+            # None for the subscription confirmation too.
+            message = await pubsub.get_message(timeout=0.1)
+            if message is not None:
+                received.add(message["data"])
+        await pubsub.reset()
+        return received
+
+    received = run(publish_and_listen())
+    run(store.close_client(subscriber))
+
+    assert len(received) == 3
+
+
+def test_sentinel_finds_master(sentinel_client, monkeypatch):
+    use_stores(sentinel_client, monkeypatch)
+    otp = run(security.generate_otp("test@rickhenry.dev"))
+
+    assert run(security.verify_otp("test@rickhenry.dev", otp))
+
+
+def test_sentinel_follows_failover(redis_sentinel, sentinel_client, monkeypatch):
+    use_stores(sentinel_client, monkeypatch)
+    otp = run(security.generate_otp("test@rickhenry.dev"))
+    run(sentinel_client.execute_command("WAIT", 1, 1000))
+
+    def master():
+        return redis_cli(
+            redis_sentinel, "sentinel", "get-master-addr-by-name", "mymaster"
+        )
+
+    old_master = master()
+    redis_cli(redis_sentinel, "sentinel", "failover", "mymaster")
+    wait_for(lambda: master() != old_master)
+
+    # Connections to the old master fail once, after which the client asks
+    # the sentinel where the master is now.
+    for _ in range(10):
+        try:
+            assert run(security.verify_otp("test@rickhenry.dev", otp))
+            break
+        except ConnectionError:
+            run(asyncio.sleep(0.5))
+    else:
+        pytest.fail("client did not reconnect to the new master")
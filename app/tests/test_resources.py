@@ -0,0 +1,69 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from app.resources import Resources
+from app.tests.conftest import run
+
+
+@pytest.fixture
+def container():
+    return Resources()
+
+
+def test_resources_are_created_once_on_first_use(container):
+    created = []
+    container.register("client", lambda: created.append(1) or object())
+
+    assert created == []
+    assert container.client is container.client
+    assert created == [1]
+
+
+def test_unknown_resource_is_an_attribute_error(container):
+    with pytest.raises(AttributeError):
+        container.client
+
+
+def test_resources_can_be_swapped(container, monkeypatch):
+    container.register("client", lambda: "real")
+
+    monkeypatch.setattr(container, "client", "fake")
+    assert container.client == "fake"
+    monkeypatch.undo()
+
+    assert container.client == "real"
+
+
+def test_start_creates_and_close_releases_in_reverse(container):
+    events = []
+
+    async def close_second(resource):
+        events.append(("close", resource))
+
+    container.register(
+        "first",
+        lambda: "first",
+        start=lambda resource: events.append(("start", resource)),
+        close=lambda resource: events.append(("close", resource)),
+    )
+    container.register("second", lambda: "second", close=close_second)
+
+    run(container.start())
+    run(container.close())
+
+    assert container.startup_seconds is not None
+    assert events == [("start", "first"), ("close", "second"), ("close", "first")]
+
+
+def test_importing_app_needs_no_environment():
+    env = {key: value for key, value in os.environ.items() if key != "SECRET_KEY"}
+    root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+
+    result = subprocess.run(
+        [sys.executable, "-c", "import app.main"], cwd=root, env=env
+    )
+
+    assert result.returncode == 0
@@ -0,0 +1,44 @@
+from starlette.responses import JSONResponse
+
+from app import responses
+from app.auth import models
+
+
+def test_model_response_sends_response_model_fields():
+    user = models.UserInDB(email="test@rickhenry.dev", full_name="Test")
+
+    response = responses.model_response(user, models.User, 201)
+
+    assert response.status_code == 201
+    assert response.media_type == "application/json"
+    assert response.body == (
+        b'{"email":"test@rickhenry.dev","full_name":"Test","disabled":false}'
+    )
+
+
+def test_encoded_response_sends_body_as_is():
+    response = responses.EncodedJSONResponse(responses.encode({"status": "ok"}))
+
+    assert response.body == b'{"status":"ok"}'
+    assert response.headers["content-type"] == "application/json"
+
+
+def test_router_defaults_to_orjson():
+    router = responses.Router()
+
+    @router.get("/default")
+    async def default():
+        return {}
+
+    @router.get("/plain", response_class=JSONResponse)
+    async def plain():
+        return {}
+
+    @router.get("/custom", response_class=responses.EncodedJSONResponse)
+    async def custom():
+        return b"{}"
+
+    classes = {route.path: route.response_class for route in router.routes}
+    assert classes["/default"] is responses.ORJSONResponse
+    assert classes["/plain"] is responses.ORJSONResponse
+    assert classes["/custom"] is responses.EncodedJSONResponse
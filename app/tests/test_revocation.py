@@ -0,0 +1,151 @@
+import asyncio
+import datetime
+import time
+import uuid
+
+import jwt
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from redis import asyncio as aioredis
+
+from app.auth import crud, models, revocation, security
+from app.tests.conftest import run
+
+
+def make_token(email: str = "test@rickhenry.dev") -> str:
+    return security.create_access_token(
+        data={"sub": email}, expires_delta=datetime.timedelta(minutes=5)
+    )
+
+
+def claims(token: str) -> dict:
+    return jwt.decode(token, verify=False)
+
+
+@pytest.fixture
+def client(test_client, monkeypatch: MonkeyPatch):
+    async def get_user(email):
+        return models.UserInDB(email=email)
+
+    async def get_users(emails):
+        return {email: models.UserInDB(email=email) for email in emails}
+
+    monkeypatch.setattr(crud, "get_cached_user_by_email", get_user)
+    monkeypatch.setattr(crud, "get_cached_users_by_email", get_users)
+    monkeypatch.setattr(security, "ADMIN_EMAILS", {"admin@rickhenry.dev"})
+    return test_client
+
+
+def test_tokens_have_unique_ids():
+    assert claims(make_token())["jti"] != claims(make_token())["jti"]
+
+
+def test_revoked_tokens_are_checked_in_redis_until_loaded(revoked_tokens):
+    expires_at = time.time() + 60
+    run(revoked_tokens.revoke("revoked", expires_at))
+
+    assert revoked_tokens.revoked is None
+    assert run(revoked_tokens.is_revoked("revoked"))
+    assert not run(revoked_tokens.is_revoked("other"))
+
+
+def test_loaded_tokens_are_checked_locally(revoked_tokens):
+    run(revoked_tokens.revoke("before", time.time() + 60))
+    run(revoked_tokens.load())
+    run(revoked_tokens.revoke("after", time.time() + 60))
+
+    assert revoked_tokens.revoked.keys() == {"before", "after"}
+    assert run(revoked_tokens.is_revoked("after"))
+
+
+def test_expired_tokens_are_swept(revoked_tokens):
+    run(revoked_tokens.load())
+    now = time.time()
+    run(revoked_tokens.revoke("soon", now + 1))
+    run(revoked_tokens.revoke("later", now + 60))
+
+    revoked_tokens.sweep(now + 2)
+
+    assert revoked_tokens.revoked.keys() == {"later"}
+    assert run(revoked_tokens.client.ttl(revoked_tokens.key)) > 50
+
+
+def test_revoked_token_is_rejected_after_cache_hit(client, monkeypatch):
+    monkeypatch.setattr(security, "TOKEN_CACHE_ENABLED", True)
+    client.cookies["token"] = make_token()
+    assert client.get("/auth/me").status_code == 200
+
+    run(security.revoke_token(claims(client.cookies["token"])))
+
+    assert client.get("/auth/me").status_code == 401
+    security.token_cache.clear()
+
+
+def test_sign_out_revokes_access_token(client):
+    token = make_token()
+    client.cookies["token"] = token
+
+    assert client.get("/auth/sign-out").status_code == 200
+
+    client.cookies["token"] = token
+    assert client.get("/auth/me").status_code == 401
+
+
+def test_introspect_reports_revoked_tokens_inactive(client, introspect_headers):
+    token = make_token()
+    run(security.revoke_token(claims(token)))
+
+    response = client.post(
+        "/auth/introspect",
+        json={"tokens": [token, make_token()]},
+        headers=introspect_headers,
+    )
+
+    assert [result["active"] for result in response.json()] == [False, True]
+
+
+def test_admins_revoke_tokens(client):
+    leaked = make_token()
+
+    client.cookies["token"] = make_token()
+    assert client.post("/auth/revoke", json={"tokens": [leaked]}).status_code == 403
+
+    client.cookies["token"] = make_token("admin@rickhenry.dev")
+    response = client.post("/auth/revoke", json={"tokens": [leaked, "invalid"]})
+
+    assert response.json() == {"revoked": 1}
+    client.cookies["token"] = leaked
+    assert client.get("/auth/me").status_code == 401
+
+
+def test_revocations_reach_every_worker(redis_server):
+    key = str(uuid.uuid4())
+    workers = [
+        revocation.RevokedTokens(
+            aioredis.Redis(port=redis_server),
+            aioredis.Redis(port=redis_server),
+            key=key,
+            channel=key,
+        )
+        for _ in range(2)
+    ]
+
+    async def wait_until(condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise TimeoutError
+
+    async def revoke():
+        tasks = [asyncio.ensure_future(worker.run()) for worker in workers]
+        await wait_until(lambda: all(worker.revoked is not None for worker in workers))
+        await workers[0].revoke("revoked", time.time() + 60)
+        await wait_until(lambda: "revoked" in workers[1].revoked)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for worker in workers:
+            await worker.close()
+
+    run(revoke())
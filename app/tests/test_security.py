@@ -0,0 +1,124 @@
+import datetime
+
+import jwt
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+
+from app.auth import crud, models, router, security
+
+
+@pytest.fixture
+def token_cache(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(security, "TOKEN_CACHE_ENABLED", True)
+    security.token_cache.clear()
+    yield security.token_cache
+    security.token_cache.clear()
+
+
+@pytest.fixture
+def decode_calls(monkeypatch: MonkeyPatch):
+    calls = []
+    decode = jwt.decode
+
+    def counting_decode(*args, **kwargs):
+        calls.append(args)
+        return decode(*args, **kwargs)
+
+    monkeypatch.setattr(jwt, "decode", counting_decode)
+    return calls
+
+
+def make_token(**expires) -> str:
+    return security.create_access_token(
+        data={"sub": "test@rickhenry.dev"}, expires_delta=datetime.timedelta(**expires)
+    )
+
+
+def test_repeat_tokens_are_verified_once(token_cache, decode_calls):
+    token = make_token(minutes=30)
+
+    assert security.decode_token(token)["sub"] == "test@rickhenry.dev"
+    assert security.decode_token(token)["sub"] == "test@rickhenry.dev"
+    assert len(decode_calls) == 1
+    assert token_cache.hit_rate == 0.5
+
+
+def test_cached_claims_expire_with_token(token_cache, decode_calls):
+    token = make_token(minutes=30)
+    security.decode_token(token)
+    token_cache.timer = lambda: security.time.monotonic() + 30 * 60
+
+    security.decode_token(token)
+
+    assert len(decode_calls) == 2
+
+
+def test_invalid_tokens_are_not_cached(token_cache):
+    token = make_token(minutes=30) + "x"
+
+    for _ in range(2):
+        with pytest.raises(jwt.PyJWTError):
+            security.decode_token(token)
+    assert len(token_cache) == 0
+
+
+def test_cache_disabled(decode_calls):
+    token = make_token(minutes=30)
+    security.decode_token(token)
+    security.decode_token(token)
+
+    assert len(decode_calls) == 2
+
+
+def test_try_decode_token():
+    assert security.try_decode_token(make_token(minutes=5))["sub"]
+    assert security.try_decode_token(make_token(minutes=-5)) is None
+    assert security.try_decode_token("not-a-token") is None
+
+
+def test_introspect_looks_up_users_once(test_client, monkeypatch, introspect_headers):
+    lookups = []
+
+    async def get_users(emails):
+        emails = set(emails)
+        lookups.append(emails)
+        return {email: models.UserInDB(email=email) for email in emails}
+
+    monkeypatch.setattr(crud, "get_cached_users_by_email", get_users)
+    token = make_token(minutes=5)
+
+    response = test_client.post(
+        "/auth/introspect",
+        json={"tokens": [token, token, make_token(minutes=-5)]},
+        headers=introspect_headers,
+    )
+
+    assert [result["active"] for result in response.json()] == [True, True, False]
+    assert lookups == [{"test@rickhenry.dev"}]
+
+
+def test_introspect_limits_batch_size(test_client, monkeypatch, introspect_headers):
+    monkeypatch.setattr(router, "INTROSPECT_MAX", 1)
+
+    response = test_client.post(
+        "/auth/introspect", json={"tokens": ["a", "b"]}, headers=introspect_headers
+    )
+
+    assert response.status_code == 413
+
+
+def test_introspect_requires_the_gateway_secret(test_client, monkeypatch):
+    def introspect(headers: dict) -> int:
+        return test_client.post(
+            "/auth/introspect",
+            json={"tokens": [make_token(minutes=5)]},
+            headers=headers,
+        ).status_code
+
+    assert introspect({"Authorization": "Bearer anything"}) == 403
+
+    monkeypatch.setattr(security, "INTROSPECT_SECRET", "introspect-secret")
+
+    assert introspect({}) == 401
+    assert introspect({"Authorization": "Bearer wrong"}) == 401
+    assert introspect({"Authorization": f"Bearer {make_token(minutes=5)}"}) == 401
@@ -0,0 +1,87 @@
+import datetime
+
+from _pytest.monkeypatch import MonkeyPatch
+from starlette.testclient import TestClient
+
+from app.auth import crud, models
+from app.tests.conftest import run
+
+
+def test_rotate_returns_next_token(refresh_tokens):
+    token = run(refresh_tokens.issue("test@rickhenry.dev"))
+
+    rotated = run(refresh_tokens.rotate(token))
+
+    assert rotated.email == "test@rickhenry.dev"
+    assert rotated.token != token
+    assert rotated.token.split(".")[0] == token.split(".")[0]
+    assert run(refresh_tokens.rotate(rotated.token)).email == "test@rickhenry.dev"
+
+
+def test_reused_token_revokes_session(refresh_tokens):
+    token = run(refresh_tokens.issue("test@rickhenry.dev"))
+    rotated = run(refresh_tokens.rotate(token))
+
+    assert run(refresh_tokens.rotate(token)) is None
+    assert run(refresh_tokens.rotate(rotated.token)) is None
+
+
+def test_sessions_are_independent(refresh_tokens):
+    first = run(refresh_tokens.issue("test@rickhenry.dev"))
+    second = run(refresh_tokens.issue("test@rickhenry.dev"))
+    run(refresh_tokens.rotate(first))
+    run(refresh_tokens.rotate(first))
+
+    assert run(refresh_tokens.rotate(second)) is not None
+
+
+def test_invalid_and_revoked_tokens_fail(refresh_tokens):
+    token = run(refresh_tokens.issue("test@rickhenry.dev"))
+    run(refresh_tokens.revoke(token))
+
+    assert run(refresh_tokens.rotate(token)) is None
+    assert run(refresh_tokens.rotate("nonsense")) is None
+    assert run(refresh_tokens.rotate("unknown.session")) is None
+
+
+def test_sessions_expire(refresh_tokens):
+    refresh_tokens.lifetime = datetime.timedelta(days=1)
+    token = run(refresh_tokens.issue("test@rickhenry.dev"))
+    key = refresh_tokens.key(token.split(".")[0])
+
+    assert 0 < run(refresh_tokens.client.pttl(key)) <= 86400000
+
+
+def test_refresh_endpoint(
+    test_client: TestClient, refresh_tokens, monkeypatch: MonkeyPatch
+):
+    users = {"test@rickhenry.dev": models.UserInDB(email="test@rickhenry.dev")}
+
+    async def get_user(email):
+        return users.get(email)
+
+    monkeypatch.setattr(crud, "get_cached_user_by_email", get_user)
+    token = run(refresh_tokens.issue("test@rickhenry.dev"))
+
+    response = test_client.post("/auth/refresh", cookies={"refresh_token": token})
+    reused = test_client.post("/auth/refresh", cookies={"refresh_token": token})
+
+    assert response.status_code == 200
+    assert response.cookies.get("token")
+    assert response.cookies.get("refresh_token") not in (None, token)
+    assert reused.status_code == 401
+
+
+def test_refresh_rejects_disabled_user(
+    test_client: TestClient, refresh_tokens, monkeypatch: MonkeyPatch
+):
+    async def get_user(email):
+        return models.UserInDB(email=email, disabled=True)
+
+    monkeypatch.setattr(crud, "get_cached_user_by_email", get_user)
+    token = run(refresh_tokens.issue("test@rickhenry.dev"))
+
+    response = test_client.post("/auth/refresh", cookies={"refresh_token": token})
+
+    assert response.status_code == 401
+    assert test_client.post("/auth/refresh").status_code == 401
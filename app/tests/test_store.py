@@ -0,0 +1,128 @@
+import asyncio
+import datetime
+
+from redis.crc import key_slot
+
+from app.auth import hashing, models, security
+from app.tests.conftest import run
+
+
+def test_set_stores_value_with_expiry(secret_stores):
+    otps, _url_secrets = secret_stores
+    run(otps.set("test@rickhenry.dev", "hash", datetime.timedelta(minutes=5)))
+
+    assert run(otps.get("test@rickhenry.dev")) == b"hash"
+    assert 0 < run(otps.client.ttl(otps.key("test@rickhenry.dev"))) <= 300
+
+
+def test_stores_are_separate(secret_stores):
+    otps, url_secrets = secret_stores
+    run(otps.set("test@rickhenry.dev", "hash", 300))
+
+    assert run(url_secrets.get("test@rickhenry.dev")) is None
+
+
+def test_generate_and_verify_otp(secret_stores):
+    otp = run(security.generate_otp("test@rickhenry.dev"))
+
+    assert not run(security.verify_otp("test@rickhenry.dev", "wrong"))
+    assert run(security.verify_otp("test@rickhenry.dev", otp))
+
+
+def test_generate_and_verify_magic_link(secret_stores):
+    magic_url = run(security.generate_magic_link("test@rickhenry.dev"))
+    url_secret = magic_url.split("=")[-1]
+
+    assert not run(security.verify_magic_link("fail@rickhenry.dev", url_secret))
+    assert run(security.verify_magic_link("test@rickhenry.dev", url_secret))
+
+
+def test_verified_secret_cannot_be_replayed(secret_stores):
+    otp = run(security.generate_otp("test@rickhenry.dev"))
+
+    assert run(security.verify_otp("test@rickhenry.dev", otp))
+    assert not run(security.verify_otp("test@rickhenry.dev", otp))
+
+
+def test_concurrent_confirms_only_one_succeeds(secret_stores):
+    otp = run(security.generate_otp("test@rickhenry.dev"))
+
+    async def confirm_many():
+        return await asyncio.gather(
+            *(security.verify_otp("test@rickhenry.dev", otp) for _ in range(5))
+        )
+
+    assert sorted(run(confirm_many())) == [False] * 4 + [True]
+
+
+def test_failed_attempt_keeps_secret_and_expiry(secret_stores):
+    otps, _url_secrets = secret_stores
+    otp = run(security.generate_otp("test@rickhenry.dev"))
+
+    assert not run(security.verify_otp("test@rickhenry.dev", "wrong"))
+    assert 0 < run(otps.client.pttl(otps.key("test@rickhenry.dev"))) <= 300000
+    assert run(security.verify_otp("test@rickhenry.dev", otp))
+
+
+def test_too_many_failed_attempts_lock_secret(secret_stores, monkeypatch):
+    otps, _url_secrets = secret_stores
+    otp = run(security.generate_otp("test@rickhenry.dev"))
+    verified = []
+
+    async def counting_verify(secret, secret_hash):
+        verified.append(secret)
+        return secret == otp
+
+    for _ in range(otps.max_attempts):
+        run(security.verify_otp("test@rickhenry.dev", "wrong"))
+    monkeypatch.setattr(security.hashing, "verify_secret", counting_verify)
+
+    assert not run(security.verify_otp("test@rickhenry.dev", otp))
+    assert verified == []
+
+
+def test_new_secret_resets_attempts(secret_stores):
+    otps, _url_secrets = secret_stores
+    run(security.generate_otp("test@rickhenry.dev"))
+    for _ in range(otps.max_attempts):
+        run(security.verify_otp("test@rickhenry.dev", "wrong"))
+
+    otp = run(security.generate_otp("test@rickhenry.dev"))
+
+    assert run(security.verify_otp("test@rickhenry.dev", otp))
+
+
+def test_bound_secret_confirms_without_lookup(secret_stores, monkeypatch):
+    async def no_lookup(email):
+        raise AssertionError("user was looked up")
+
+    monkeypatch.setattr(security.crud, "get_user_by_email", no_lookup)
+    user = models.UserInDB(email="test@rickhenry.dev", disabled=True)
+    otp = run(security.generate_otp(user.email, "5d7a0f5e8e9b4a0001000001", user))
+
+    authenticated = run(security.authenticate_user(user.email, otp))
+
+    assert authenticated.email == "test@rickhenry.dev"
+    assert authenticated.disabled
+
+
+def test_unbound_secret_falls_back_to_lookup(secret_stores, monkeypatch):
+    otps, _url_secrets = secret_stores
+
+    async def lookup(email):
+        return models.UserInDB(email=email)
+
+    monkeypatch.setattr(security.crud, "get_user_by_email", lookup)
+    run(otps.set("test@rickhenry.dev", run(hashing.hash_secret("code")), 300))
+
+    authenticated = run(security.authenticate_user("test@rickhenry.dev", "code"))
+
+    assert authenticated.email == "test@rickhenry.dev"
+
+
+def test_secret_and_attempts_share_a_cluster_slot(secret_stores):
+    otps, _url_secrets = secret_stores
+
+    assert key_slot(otps.key("test@rickhenry.dev").encode()) == key_slot(
+        otps.attempts_key("test@rickhenry.dev").encode()
+    )
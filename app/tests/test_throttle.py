@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from app.auth import throttle
+from app.resources import resources
+from app.tests.conftest import run
+
+
+@pytest.fixture
+def clock(monkeypatch: MonkeyPatch):
+    now = [1000.0]
+    monkeypatch.setattr(throttle.time, "time", lambda: now[0])
+    return now
+
+
+def test_limiter_allows_limit_per_window(throttle_client, clock):
+    limiter = throttle.SlidingWindowLimiter(throttle_client, "test", 2, 60)
+
+    assert run(limiter.hit("a")) == 0
+    clock[0] += 10
+    assert run(limiter.hit("a")) == 0
+    assert run(limiter.hit("a")) == 50
+    assert run(limiter.hit("b")) == 0
+
+
+def test_limiter_window_slides(throttle_client, clock):
+    limiter = throttle.SlidingWindowLimiter(throttle_client, "test", 2, 60)
+    run(limiter.hit("a"))
+    clock[0] += 30
+    run(limiter.hit("a"))
+    clock[0] += 31
+
+    assert run(limiter.hit("a")) == 0
+    assert run(limiter.hit("a")) > 0
+
+
+def test_enforce_rejects_with_retry_after(throttle_client, clock):
+    for _ in range(5):
+        run(throttle.enforce("request", "test@rickhenry.dev", None))
+
+    with pytest.raises(HTTPException) as exc_info:
+        run(throttle.enforce("request", "test@rickhenry.dev", None))
+
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers == {"Retry-After": "300"}
+
+
+def test_concurrent_issues_are_coalesced(throttle_client):
+    calls = []
+
+    async def issue():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+
+    async def issue_many():
+        return await asyncio.gather(
+            *(throttle.issue_once("otp", "test@rickhenry.dev", issue) for _ in range(5))
+        )
+
+    assert run(issue_many()) == [True] * 5
+    assert len(calls) == 1
+    assert not run(throttle.issue_once("otp", "test@rickhenry.dev", issue))
+    assert run(throttle.issue_once("magic", "test@rickhenry.dev", issue))
+    assert len(calls) == 2
+
+
+def test_failed_issue_can_be_retried(throttle_client):
+    async def fail():
+        raise HTTPException(status_code=500)
+
+    async def succeed():
+        pass
+
+    with pytest.raises(HTTPException):
+        run(throttle.issue_once("otp", "test@rickhenry.dev", fail))
+
+    assert run(throttle.issue_once("otp", "test@rickhenry.dev", succeed))
+
+
+def make_request(host: str, forwarded: str = None) -> Request:
+    headers = [] if forwarded is None else [(b"x-forwarded-for", forwarded.encode())]
+    return Request({"type": "http", "client": (host, 1234), "headers": headers})
+
+
+def test_forwarded_address_is_only_believed_from_trusted_proxies():
+    request = make_request("10.0.0.2", "203.0.113.9, 198.51.100.7, 10.0.0.1")
+
+    assert throttle.client_address(request, "") == "10.0.0.2"
+    assert throttle.client_address(request, "10.0.0.0/8") == "198.51.100.7"
+    assert throttle.client_address(request, "*") == "203.0.113.9"
+    assert throttle.client_address(make_request("10.0.0.2"), "*") == "10.0.0.2"
+
+
+def test_users_behind_one_proxy_are_limited_separately(test_client, monkeypatch):
+    async def issue_once(flow, email, issue):
+        return True
+
+    monkeypatch.setattr(throttle, "issue_once", issue_once)
+    monkeypatch.setattr(throttle, "TRUSTED_PROXIES", "*")
+    limiter = throttle.SlidingWindowLimiter(resources.throttle_client, "request", 1, 60)
+    monkeypatch.setitem(resources.limiters, "request", limiter)
+
+    def request(email: str, address: str) -> int:
+        return test_client.post(
+            "/auth/request", json={"email": email}, headers={"X-Forwarded-For": address}
+        ).status_code
+
+    assert request("one@rickhenry.dev", "203.0.113.1") == 200
+    assert request("two@rickhenry.dev", "203.0.113.2") == 200
+    assert request("three@rickhenry.dev", "203.0.113.2") == 429
@@ -0,0 +1,83 @@
+import asyncio
+from types import SimpleNamespace
+
+from app.auth import crud, models
+from app.resources import resources
+from app.tests.conftest import run
+
+
+def cache(email: str):
+    crud._cache_user({"_id": email, "email": email})
+
+
+async def wait_until(condition):
+    for _ in range(200):
+        if await condition():
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError
+
+
+def test_announced_changes_are_invalidated_here_and_published(user_changes_client):
+    cache("changed@example.com")
+
+    async def announce_and_listen():
+        pubsub = user_changes_client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(crud.USER_CHANGES_CHANNEL)
+        await crud.announce_changes(["changed@example.com"])
+        for _ in range(10):
+            message = await pubsub.get_message(timeout=0.1)
+            if message is not None:
+                return message["data"]
+
+    assert run(announce_and_listen()) == b"changed@example.com"
+    assert "changed@example.com" not in crud.user_cache
+
+
+def test_changes_announced_by_other_processes_are_invalidated(user_changes_client):
+    async def follow():
+        task = asyncio.ensure_future(crud.follow_user_changes())
+
+        async def subscribed():
+            [(_channel, count)] = await user_changes_client.pubsub_numsub(
+                crud.USER_CHANGES_CHANNEL
+            )
+            return count
+
+        # Let the follower clear the cache, as it does once subscribed.
+        await wait_until(subscribed)
+        await asyncio.sleep(0.05)
+        cache("changed@example.com")
+        cache("other@example.com")
+        await user_changes_client.publish(
+            crud.USER_CHANGES_CHANNEL, "changed@example.com"
+        )
+
+        async def invalidated():
+            return "changed@example.com" not in crud.user_cache
+
+        await wait_until(invalidated)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    run(follow())
+
+    assert isinstance(crud._cached_user("other@example.com"), models.UserInDB)
+    assert "changed@example.com" in crud.recently_written
+
+
+def test_misses_are_not_checked_on_the_primary(monkeypatch):
+    queries = []
+
+    class Secondary:
+        async def find_one(self, query, projection):
+            queries.append(query)
+
+    def primary_users():
+        raise AssertionError("The primary was queried")
+
+    monkeypatch.setattr(resources, "db", SimpleNamespace(users=Secondary()))
+    monkeypatch.setattr(crud, "primary_users", primary_users)
+
+    assert run(crud.get_user_by_email("new@example.com")) is None
+    assert queries == [{"email": "new@example.com"}]
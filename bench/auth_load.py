@@ -0,0 +1,260 @@
+"""Throughput and latency of the auth endpoints against local stand-ins.
+
+    python -m bench.auth_load --requests 2000 --concurrency 50 --output run.json
+    python -m bench.auth_load --compare baseline.json
+
+Each scenario is seeded before it is timed, then driven at the given
+concurrency. Results are saved as JSON so runs can be compared; --compare
+exits non-zero when throughput or p95 latency regress beyond --tolerance.
+
+mongomock and fakeredis never yield to the event loop, so in-process runs
+measure CPU cost per request. Pass --mongo-uri to include real I/O waits.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import platform
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import httpx
+
+from app.auth import crud, models, security
+from app.main import app
+from app.resources import resources
+from bench.harness import StandIns
+
+Request = Tuple[str, str, dict]
+
+
+def emails(scenario: str, count: int) -> List[str]:
+    return [f"{scenario}-{i}@example.com" for i in range(count)]
+
+
+async def seed_users(addresses: List[str]):
+    await crud.create_users([models.UserInDB(email=email) for email in addresses])
+
+
+async def issue(generate: Callable, email: str) -> str:
+    # Issued the way /auth/request does, with the user bound to the secret.
+    user_id, user = await crud.get_user_with_id(email)
+    return await generate(email, user_id, user)
+
+
+async def prepare_register(count: int) -> List[Request]:
+    return [
+        ("POST", "/auth/register", {"json": {"email": email, "full_name": "Bench"}})
+        for email in emails("register", count)
+    ]
+
+
+async def prepare_request(count: int) -> List[Request]:
+    addresses = emails("request", count)
+    await seed_users(addresses)
+    return [
+        ("POST", "/auth/request", {"json": {"email": email}}) for email in addresses
+    ]
+
+
+async def prepare_confirm(count: int) -> List[Request]:
+    addresses = emails("confirm", count)
+    await seed_users(addresses)
+    codes = await asyncio.gather(
+        *(issue(security.generate_otp, email) for email in addresses)
+    )
+    return [
+        ("POST", "/auth/confirm", {"json": {"email": email, "code": code}})
+        for email, code in zip(addresses, codes)
+    ]
+
+
+async def prepare_confirm_magic(count: int) -> List[Request]:
+    addresses = emails("magic", count)
+    await seed_users(addresses)
+    links = await asyncio.gather(
+        *(issue(security.generate_magic_link, email) for email in addresses)
+    )
+    return [
+        (
+            "POST",
+            "/auth/confirm-magic",
+            {"json": {"email": email, "secret": link.split("=")[-1]}},
+        )
+        for email, link in zip(addresses, links)
+    ]
+
+
+async def prepare_me(count: int) -> List[Request]:
+    # Authenticated traffic is mostly repeat users, so reuse a small pool.
+    addresses = emails("me", max(count // 20, 1))
+    await seed_users(addresses)
+    cookies = [
+        {
+            security.oauth2_scheme.token_name: security.create_access_token(
+                data={"sub": email}, expires_delta=datetime.timedelta(minutes=30)
+            )
+        }
+        for email in addresses
+    ]
+    return [
+        ("GET", "/auth/me", {"cookies": cookies[i % len(cookies)]})
+        for i in range(count)
+    ]
+
+
+async def prepare_refresh(count: int) -> List[Request]:
+    addresses = emails("refresh", count)
+    await seed_users(addresses)
+    tokens = await asyncio.gather(
+        *(resources.refresh_tokens.issue(email) for email in addresses)
+    )
+    return [
+        ("POST", "/auth/refresh", {"cookies": {"refresh_token": token}})
+        for token in tokens
+    ]
+
+
+SCENARIOS: Dict[str, Callable] = {
+    "register": prepare_register,
+    "request": prepare_request,
+    "confirm": prepare_confirm,
+    "confirm-magic": prepare_confirm_magic,
+    "me": prepare_me,
+    "refresh": prepare_refresh,
+}
+
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    index = min(int(len(ordered) * fraction), len(ordered) - 1)
+    return ordered[index]
+
+
+async def drive(
+    client: httpx.AsyncClient, requests: Iterable[Request], concurrency: int
+) -> dict:
+    pending = iter(requests)
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        for method, url, kwargs in pending:
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+
+async def run(
+    scenarios: List[str], count: int, concurrency: int, mongo_uri: str
+) -> dict:
+    results = {}
+    async with StandIns(mongo_uri=mongo_uri):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench"
+        ) as client:
+            for name in scenarios:
+                requests = await SCENARIOS[name](count)
+                results[name] = await drive(client, requests, concurrency)
+                print_result(name, results[name])
+    resources.hash_backend.shutdown()
+    return results
+
+
+def print_result(name: str, result: dict):
+    print(
+        f"{name:>14}: {result['throughput']:8.1f} req/s"
+        f"  p50 {result['p50_ms']:7.2f} ms  p95 {result['p95_ms']:7.2f} ms"
+        f"  p99 {result['p99_ms']:7.2f} ms  errors {result['errors']}"
+    )
+
+
+def git_commit() -> str:
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> bool:
+    """Print the change from a baseline run. Returns whether anything regressed."""
+    regressed = False
+    for name, result in current["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+        throughput = result["throughput"] / before["throughput"] - 1
+        p95 = result["p95_ms"] / before["p95_ms"] - 1
+        flag = ""
+        if throughput < -tolerance or p95 > tolerance:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"{name:>14}: throughput {throughput:+7.1%}  p95 {p95:+7.1%}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument("--mongo-uri", help="Use a local mongod instead of mongomock")
+    parser.add_argument("--output", help="Save results to this JSON file")
+    parser.add_argument("--compare", help="Compare with a previously saved run")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    scenarios = asyncio.get_event_loop().run_until_complete(
+        run(args.scenarios, args.requests, args.concurrency, args.mongo_uri)
+    )
+    current = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "hash_backend": resources.hash_backend.name,
+            "mongo": "mongod" if args.mongo_uri else "mongomock",
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+        },
+        "scenarios": scenarios,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), current, args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Requests/sec on /auth/confirm for each hash backend.
+
+Uses the Mongo and Redis configured in the environment (see docker-compose.yml)
+and starts one uvicorn server per backend:
+
+    python -m bench.confirm_throughput --requests 500 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+import pymongo
+
+from app.auth import hashing, store
+from app.dependencies import db_name, db_uri
+from bench.harness import NO_LIMIT
+
+BACKENDS = ["inline", "process", "hmac"]
+# Every request comes from this machine, so rate limits are lifted.
+UNLIMITED = {
+    "RATE_LIMIT_REQUEST": NO_LIMIT,
+    "RATE_LIMIT_REQUEST_MAGIC": NO_LIMIT,
+    "RATE_LIMIT_CONFIRM": NO_LIMIT,
+}
+
+
+def seed_users(count: int) -> list:
+    users = pymongo.MongoClient(db_uri).get_database(db_name).users
+    emails = [f"bench-{i}@example.com" for i in range(count)]
+    users.delete_many({"email": {"$in": emails}})
+    users.insert_many([{"email": email, "full_name": "Bench"} for email in emails])
+    return emails
+
+
+async def seed_codes(backend_name: str, emails: list) -> dict:
+    backend = hashing.get_backend(backend_name)
+    otps = store.SecretStore("otp", store.create_client(db=0))
+    try:
+        code_hashes = await asyncio.gather(*(backend.hash("benchcode") for _ in emails))
+        for email, code_hash in zip(emails, code_hashes):
+            await otps.set(email, code_hash, 300)
+    finally:
+        backend.shutdown()
+        await otps.close()
+    return {email: "benchcode" for email in emails}
+
+
+async def wait_for_server(url: str, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(f"{url}/openapi.json"):
+                    return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError(f"Server at {url} did not start")
+
+
+async def drive(url: str, codes: dict, concurrency: int) -> float:
+    """Successful confirmations per second"""
+    queue = list(codes.items())
+    failures = 0
+
+    async def worker(session: aiohttp.ClientSession):
+        nonlocal failures
+        while queue:
+            email, code = queue.pop()
+            async with session.post(
+                f"{url}/auth/confirm", json={"email": email, "code": code}
+            ) as res:
+                if res.status != 200:
+                    failures += 1
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    if failures:
+        print(f"  {failures} requests failed", file=sys.stderr)
+    return (len(codes) - failures) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--backends", nargs="+", default=BACKENDS)
+    args = parser.parse_args()
+
+    url = f"http://127.0.0.1:{args.port}"
+    emails = seed_users(args.requests)
+    loop = asyncio.get_event_loop()
+    for backend_name in args.backends:
+        codes = loop.run_until_complete(seed_codes(backend_name, emails))
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "--port",
+                str(args.port),
+                "--log-level",
+                "warning",
+                "app.main:app",
+            ],
+            env={**os.environ, **UNLIMITED, "HASH_BACKEND": backend_name},
+        )
+        try:
+            loop.run_until_complete(wait_for_server(url))
+            rps = loop.run_until_complete(drive(url, codes, args.concurrency))
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{backend_name:>8}: {rps:8.1f} requests/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Runs the app in process against local stand-ins for its dependencies.
+
+Mongo is mongomock-motor, or a local mongod when a URI is given. Redis is
+fakeredis, and Mailgun is the fake Mailgun server from the test suite.
+Requested emails are queued in the outbox; no worker delivers them.
+"""
+import fakeredis
+from fakeredis import aioredis as fake_aioredis
+from motor import motor_asyncio
+from mongomock_motor import AsyncMongoMockClient
+
+from app import mail, outbox
+from app.auth import bloom, indexes, revocation, sessions, store, throttle
+from app.resources import resources
+from app.tests.fake_mailgun import FakeMailgun
+
+BENCH_DB = "bench_auth"
+NO_LIMIT = f"{10 ** 9}/1"
+
+
+class StandIns:
+    def __init__(self, mongo_uri: str = None, mail_latency: float = 0):
+        self.mongo_uri = mongo_uri
+        self.mailgun = FakeMailgun(latency=mail_latency)
+        self.db = None
+        self._patched = []
+
+    def _patch(self, target, name: str, value):
+        self._patched.append((target, name, getattr(target, name)))
+        setattr(target, name, value)
+
+    async def start(self):
+        await self.mailgun.start()
+        if self.mongo_uri:
+            self.db = motor_asyncio.AsyncIOMotorClient(self.mongo_uri)[BENCH_DB]
+            await self.db.users.drop()
+        else:
+            self.db = AsyncMongoMockClient()[BENCH_DB]
+        await indexes.ensure_indexes(self.db)
+        self._patch(resources, "db", self.db)
+
+        server = fakeredis.FakeServer()
+        self._patch(
+            resources,
+            "otps",
+            store.SecretStore("otp", fake_aioredis.FakeRedis(server=server, db=0)),
+        )
+        self._patch(
+            resources,
+            "url_secrets",
+            store.SecretStore(
+                "url_secret", fake_aioredis.FakeRedis(server=server, db=1)
+            ),
+        )
+        throttle_client = fake_aioredis.FakeRedis(server=server, db=2)
+        self._patch(resources, "throttle_client", throttle_client)
+        # Load comes from a handful of addresses, so rate limits are lifted.
+        for name in (
+            "RATE_LIMIT_REQUEST",
+            "RATE_LIMIT_REQUEST_MAGIC",
+            "RATE_LIMIT_CONFIRM",
+        ):
+            self._patch(throttle, name, NO_LIMIT)
+        self._patch(resources, "limiters", throttle.build_limiters(throttle_client))
+        self._patch(
+            resources,
+            "refresh_tokens",
+            sessions.RefreshTokens(fake_aioredis.FakeRedis(server=server, db=3)),
+        )
+        self._patch(
+            resources,
+            "outbox",
+            outbox.Outbox(fake_aioredis.FakeRedis(server=server, db=4)),
+        )
+        self._patch(
+            resources,
+            "registered_emails",
+            bloom.RegisteredEmails(client=fake_aioredis.FakeRedis(server=server)),
+        )
+        self._patch(
+            resources, "user_changes_client", fake_aioredis.FakeRedis(server=server)
+        )
+        revoked_client = fake_aioredis.FakeRedis(server=server, db=5)
+        revoked = revocation.RevokedTokens(revoked_client, revoked_client)
+        # Loaded as a worker does at startup, so checks are local.
+        await revoked.load()
+        self._patch(resources, "revoked_tokens", revoked)
+
+        self._patch(
+            resources,
+            "mail",
+            mail.MailClient(self.mailgun.url, "key", "Bench <bench@example.com>"),
+        )
+
+    async def stop(self):
+        await resources.mail.close()
+        while self._patched:
+            target, name, value = self._patched.pop()
+            setattr(target, name, value)
+        await self.mailgun.stop()
+
+    async def __aenter__(self) -> "StandIns":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
@@ -0,0 +1,61 @@
+"""Outbound Mailgun calls, connections and send latency during a login storm.
+
+Runs against the local fake Mailgun server, so no credentials are needed:
+
+    python -m bench.mail_coalescing --emails 1000 --latency 0.2 --windows 0 10 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from app import mail
+from app.tests.fake_mailgun import FakeMailgun
+
+
+async def storm(emails: int, latency: float, window_ms: float) -> dict:
+    mailgun = FakeMailgun(latency=latency)
+    await mailgun.start()
+    client = mail.MailClient(
+        mailgun.url, "key", "Bench <bench@example.com>", batch_window=window_ms / 1000
+    )
+    timings = []
+
+    async def send(i: int):
+        start = time.perf_counter()
+        await client.send(f"{i}@example.com", "Your One Time Password", f"{i:08}")
+        timings.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(i) for i in range(emails)))
+    elapsed = time.perf_counter() - start
+    await client.close()
+    await mailgun.stop()
+    return {
+        "window_ms": window_ms,
+        "requests": len(mailgun.requests),
+        "connections": len(mailgun.connections),
+        "median_ms": statistics.median(timings) * 1000,
+        "elapsed_s": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--emails", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--windows", type=float, nargs="+", default=[0, 10, 50])
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    print("window_ms  requests  connections  median_ms  elapsed_s")
+    for window_ms in args.windows:
+        result = loop.run_until_complete(storm(args.emails, args.latency, window_ms))
+        print(
+            "{window_ms:>9.0f}  {requests:>8}  {connections:>11}  "
+            "{median_ms:>9.1f}  {elapsed_s:>9.2f}".format(**result)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Per response serialisation cost of the auth endpoints, before and after
+the orjson response path.
+
+    python -m bench.serialisation --number 20000
+
+"Before" is what FastAPI and UJSONResponse did for each endpoint: validate
+the returned value against the response model, walk it with
+jsonable_encoder and encode the result. Only serialisation is timed, not
+the request handling around it.
+"""
+import argparse
+import timeit
+from typing import Callable, Dict, Tuple
+
+from fastapi.routing import serialize_response
+from starlette.responses import JSONResponse, UJSONResponse
+
+from app import responses
+from app.auth import models, router
+
+Case = Tuple[Callable, Callable]
+
+
+def response_field(path: str):
+    for route in router.auth_router.routes:
+        if route.path == path:
+            return route.response_field
+    raise LookupError(path)
+
+
+def build_cases(bulk_size: int) -> Dict[str, Case]:
+    user = models.UserInDB(email="bench@example.com", full_name="Bench User")
+    me_field = response_field("/me")
+    results = [
+        models.RegistrationResult(email=f"{i}@example.com", status="created")
+        for i in range(bulk_size)
+    ]
+    bulk_field = response_field("/register/bulk")
+    message = "Please check your email for a single use password."
+    return {
+        "confirm": (
+            lambda: UJSONResponse({"status": "authenticated"}),
+            lambda: responses.EncodedJSONResponse(router.AUTHENTICATED),
+        ),
+        "request": (
+            lambda: JSONResponse(serialize_response(response=message)),
+            lambda: responses.EncodedJSONResponse(router.CHECK_EMAIL_OTP),
+        ),
+        "me": (
+            lambda: JSONResponse(serialize_response(field=me_field, response=user)),
+            lambda: responses.model_response(user, models.User),
+        ),
+        f"bulk x{bulk_size}": (
+            lambda: JSONResponse(
+                serialize_response(field=bulk_field, response=results)
+            ),
+            lambda: responses.ORJSONResponse([result.dict() for result in results]),
+        ),
+    }
+
+
+def per_call(fn: Callable, number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--bulk-size", type=int, default=100)
+    args = parser.parse_args()
+
+    for name, (before, after) in build_cases(args.bulk_size).items():
+        assert before().body == after().body, name
+        number = args.number
+        if name.startswith("bulk"):
+            number = max(number // args.bulk_size, 1)
+        before_us = per_call(before, number) * 1e6
+        after_us = per_call(after, number) * 1e6
+        print(
+            f"{name:>10}: before {before_us:9.2f} us  after {after_us:9.2f} us"
+            f"  {before_us / after_us:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Time for a new worker process to import the app and create its resources.
+
+    python -m bench.startup --runs 10
+
+Each run is a fresh interpreter, as a newly started worker would be. Clients
+don't connect until first use, so no services need to be running.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+WORKER = """
+import asyncio, json, time
+start = time.perf_counter()
+from app.main import app
+from app.resources import resources
+imported = time.perf_counter()
+loop = asyncio.get_event_loop()
+loop.run_until_complete(resources.start())
+started = time.perf_counter()
+loop.run_until_complete(resources.close())
+print(json.dumps({"import": imported - start, "resources": started - imported}))
+"""
+
+
+def run_worker() -> dict:
+    start = time.perf_counter()
+    output = subprocess.check_output([sys.executable, "-c", WORKER])
+    timings = json.loads(output.decode().strip().splitlines()[-1])
+    timings["process"] = time.perf_counter() - start
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [run_worker() for _ in range(args.runs)]
+    for phase in ("import", "resources", "process"):
+        timings = [run[phase] * 1000 for run in runs]
+        print(
+            f"{phase:>10}: median {statistics.median(timings):8.1f} ms"
+            f"  max {max(timings):8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""User lookup latency against a large seeded users collection.
+
+Seeds a separate database on the configured Mongo and compares
+get_user_by_email style lookups with and without the declared indexes and
+projection:
+
+    python -m bench.users_index --users 1000000 --lookups 2000
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import pymongo
+from motor import motor_asyncio
+
+from app.auth import crud, indexes
+from app.dependencies import db_uri
+
+BENCH_DB = "bench_users_index"
+
+
+def seed(users: int, extra_bytes: int, batch_size: int = 10000):
+    collection = pymongo.MongoClient(db_uri)[BENCH_DB].users
+    if collection.estimated_document_count() == users:
+        return
+    collection.drop()
+    padding = "x" * extra_bytes
+    for start in range(0, users, batch_size):
+        collection.insert_many(
+            [
+                {
+                    "email": f"user-{i}@example.com",
+                    "full_name": f"User {i}",
+                    "disabled": False,
+                    "notes": padding,
+                }
+                for i in range(start, min(start + batch_size, users))
+            ],
+            ordered=False,
+        )
+        print(f"\rseeded {min(start + batch_size, users)}/{users}", end="")
+    print()
+
+
+async def lookups(collection, emails: list, projection) -> list:
+    timings = []
+    for email in emails:
+        start = time.perf_counter()
+        await collection.find_one({"email": email}, projection)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(name: str, timings: list):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95)]
+    print(
+        f"{name:>22}: median {statistics.median(timings) * 1000:8.2f} ms"
+        f"  p95 {p95 * 1000:8.2f} ms"
+    )
+
+
+async def run(users: int, lookup_count: int):
+    db = motor_asyncio.AsyncIOMotorClient(db_uri)[BENCH_DB]
+    emails = [
+        f"user-{random.randrange(users)}@example.com" for _ in range(lookup_count)
+    ]
+
+    await indexes.ensure_indexes(db, {"users": []}, drop_undeclared=True)
+    # Collection scans are slow enough that a fraction of the lookups will do.
+    report(
+        "no index", await lookups(db.users, emails[: max(lookup_count // 100, 5)], None)
+    )
+
+    await indexes.ensure_indexes(db)
+    report("email index", await lookups(db.users, emails, None))
+    report(
+        "email index+projection", await lookups(db.users, emails, crud.USER_PROJECTION)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--extra-bytes", type=int, default=512)
+    args = parser.parse_args()
+
+    seed(args.users, args.extra_bytes)
+    asyncio.get_event_loop().run_until_complete(run(args.users, args.lookups))
+
+
+if __name__ == "__main__":
+    main()